@@ -1,12 +1,28 @@
+# 起動時間 (import にかかった時間) の計測を開始する
+import time
+
+started_at = time.perf_counter()
+
 import os
 import json
-import base64
-import requests
-from datetime import datetime
+import math
+import atexit
 from dotenv import load_dotenv
 from flask import Flask, request, Response
 from utils.openai import OpenAIClient
-from utils.cosmos import CosmosContainer
+from utils.history import create_history_store
+from utils.summary import ConversationSummarizer
+from utils.persistence import WriteBehindWriter
+from utils.answer_cache import create_answer_cache, is_cacheable_turn, replay_answer
+from utils.chat import to_history_messages, build_system_message, build_context_message, build_turn_messages, parse_user_principal
+from utils.logger import logger
+from utils.startup import StartupTracker
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.cancel import TurnRegistry, GenerationCancelled, CANCEL_REQUESTED
+from utils.speech import SpeechCredentialCache
+from utils.stream import get_stream_encoder, parse_stream_version, STREAM_VERSION_CUMULATIVE
+from utils.timing import TurnTimer, TURN_COMPLETED, TURN_CANCELLED, TURN_FAILED, TURN_REJECTED
+from utils.profiler import SamplingProfiler, ProfilerBusy, PROFILE_MODE_WINDOW, PROFILE_RUNNING, FORMAT_SPEEDSCOPE
 from azure.monitor.opentelemetry import configure_azure_monitor
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 
@@ -17,7 +33,10 @@ app = Flask(__name__)
 load_dotenv()
 SPEECH_SERVICE_KEY = os.getenv("SPEECH_SERVICE_KEY")
 SPEECH_SERVICE_REGION = os.getenv("SPEECH_SERVICE_REGION")
-HISTORY_MESSAGE_COUNT = int(os.getenv("HISTORY_MESSAGE_COUNT", 4))
+STREAM_VERSION = int(os.getenv("STREAM_VERSION", STREAM_VERSION_CUMULATIVE))
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "prefix_stable")  # prefix_stable: 変化する情報を末尾に置く (プロンプトキャッシュが効く), legacy: 現在時刻をシステムメッセージに含める
+HISTORY_MODE = os.getenv("HISTORY_MODE", "window")  # window: 直近の会話のみ, summary: 会話の要約 + 直近の会話
+HISTORY_WRITE_MODE = os.getenv("HISTORY_WRITE_MODE", "write_behind")  # write_behind: バックグラウンドで書き込む, sync: 返信の後に書き込む
 
 # デバッグ実行かどうかを判定
 debug = True if os.getenv("DEBUG", "false").lower() == "true" else False
@@ -27,11 +46,46 @@ if not debug:
     configure_azure_monitor()
     FlaskInstrumentor().instrument_app(app)
 
+# 起動モード (STARTUP_MODE) に応じて、依存先のクライアントを import 時、バックグラウンド、または初めて使用した際に生成する
+startup_tracker = StartupTracker(started_at)
+
 # Azure OpenAI Service にアクセスするためのクライアントの初期化
-openai_client = OpenAIClient()
+openai_client = startup_tracker.lazy("openai", OpenAIClient)
+
+# Azure Speech Service の一時アクセストークンと TURN サーバ情報のキャッシュの初期化 (バックグラウンドで更新する)
+speech_credentials = SpeechCredentialCache(SPEECH_SERVICE_KEY, SPEECH_SERVICE_REGION)
+speech_credentials.start()
+atexit.register(speech_credentials.close)
+
+# 回答の生成の同時実行数とユーザごとの頻度を制御するクラスの初期化
+admission = AdmissionController()
+
+# ユーザごとに回答を生成中のターンを管理するクラスの初期化 (回答の途中で話しかけられた場合に中止する)
+turns = TurnRegistry()
+
+# 会話履歴を Azure Cosmos DB に格納するストアの初期化
+# (eager 以外の場合は、データベースとコンテナの作成をデプロイ時に deploy/provision.py で行う)
+history_store = startup_tracker.lazy("cosmos", lambda: create_history_store(provision=startup_tracker.provision))
+
+# 言い換えの質問に過去の回答を再利用するキャッシュの初期化 (ANSWER_CACHE_ENABLED が true の場合のみ)
+answer_cache = create_answer_cache()
+
+# 会話の要約を管理するクラスの初期化 (HISTORY_MODE が summary の場合のみ)
+summarizer = ConversationSummarizer(openai_client, history_store) if HISTORY_MODE == "summary" else None
 
-# Azure Cosmos DB にアクセスするためのクライアントの初期化
-cosmos_client = CosmosContainer()
+# 会話履歴をバックグラウンドでまとめて書き込むクラスの初期化 (HISTORY_WRITE_MODE が write_behind の場合のみ)
+# 書き込みが完了したら、要約モードの場合は要約の更新を開始する
+history_writer = None
+if HISTORY_WRITE_MODE == "write_behind":
+    history_writer = WriteBehindWriter(lambda user_id, messages: history_store.append(user_id, messages), on_written=summarizer.update_in_background if summarizer else None)
+    atexit.register(history_writer.close)
+
+# 障害調査時に有効にするサンプリングプロファイラの初期化 (PROFILER_MODE が設定されている場合は起動時から開始する)
+profiler = SamplingProfiler()
+profiler.start_from_env()
+
+# import にかかった時間を記録する (background の場合は、ここからクライアントの生成を開始する)
+startup_tracker.finish_import()
 
 
 @app.route("/", defaults={"path": "index.html"})
@@ -52,41 +106,287 @@ def get_completion_api() -> Response:
     # ユーザ情報を取得
     user_id, _ = get_user_info()
 
-    # システムメッセージを定義
-    system_message = f"""
-- あなたは、ユーザがあなたとの会話を楽しむために作成された女性の AI アバターです。
-- ユーザが使用している言語で返信してください。
-- ユーザへの質問は、外部の情報を検索し、その情報を使用して回答してください
-- 生成した文章は音声合成され再生されるため、質問に対して要約した口語体の文章を出力してください(**Markdown記法や箇条書き、URLは使用しないでください**)。
-- 必要に応じて、回答に以下の情報を使ってください
-  - 現在時刻:  {datetime.today().strftime('%Y/%m/%d %H:%M:%S')}
+    # 段階ごとの所要時間の計測を開始する (OpenTelemetry の span とメトリクス、Server-Timing ヘッダ、timing イベントで返す)
+    timer = TurnTimer()
+
+    # requests モードのプロファイルの実行中は、このリクエストを処理するスレッドをサンプリングの対象にする
+    profile_session = profiler.start_request()
+
+    # 回答を生成中のターンがあれば中止して (ユーザが回答の途中で話しかけた場合)、新しいターンを開始する
+    with timer.stage("barge_in"):
+        cancel_token = turns.start(user_id)
+
+    # 回答を生成中のリクエストが上限に達している場合は待機し、待てない場合はすぐに混雑中であることを返す
+    try:
+        with timer.stage("admission"):
+            admission.acquire(user_id, cancel_token)
+    except AdmissionRejected as e:
+        turns.finish(user_id, cancel_token)
+        timer.finish(TURN_REJECTED)
+        profiler.finish_request(profile_session)
+        return to_busy_resp(e)
+
+    try:
+        # ユーザからのメッセージと、クライアントが対応しているストリーム形式のバージョンを取得
+        message = request.json["message"]
+        stream_version = parse_stream_version(request.json.get("stream_version"), STREAM_VERSION)
+
+        # ユーザの会話履歴 (と、要約モードの場合は古い会話の要約) を取得
+        with timer.stage("load_history"):
+            history = _load_messages(user_id)
+            summary = summarizer.load_summary(user_id) if summarizer else None
+
+        # Azure OpenAI Service - Chat Completion API で回答を生成
+        # (入力トークン数の上限に収まるように、古い会話履歴から除外する)
+        # (prefix_stable の場合は、システムメッセージとツールの定義を毎回同じにし、現在時刻等はユーザのメッセージの直前に置く)
+        with timer.stage("build_context"):
+            system_message, context_message = build_system_message(PROMPT_LAYOUT), build_context_message(PROMPT_LAYOUT)
+            messages, usage = openai_client.context.build(system_message, history, message, summary, context_message)
+        chunks = _get_completion_chunks(message, messages, usage, cancel_token, timer, is_cacheable_turn(message))
+
+        encoder = get_stream_encoder(stream_version)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Stream-Version": str(stream_version), "X-Turn-Id": cancel_token.turn_id}
+
+        # ストリームの送信前に終わった段階 (LLM のリクエストより前) の所要時間を Server-Timing ヘッダで返す
+        headers["Server-Timing"] = timer.get_server_timing()
+        resp = Response(to_stream_resp(user_id, message, chunks, encoder, messages, cancel_token, timer), mimetype="text/event-stream", headers=headers)
+    except BaseException:
+        admission.release(user_id, cancel_token)
+        turns.finish(user_id, cancel_token)
+        timer.finish(TURN_FAILED)
+        profiler.finish_request(profile_session)
+        raise
+
+    # レスポンスを閉じた際 (回答の送信が終わった場合、またはクライアントが切断した場合) に解放する
+    def on_close():
+        admission.release(user_id, cancel_token)
+        turns.finish(user_id, cancel_token)
+        profiler.finish_request(profile_session)
+
+    resp.call_on_close(on_close)
+    return resp
+
+
+@app.route("/api/completion/cancel", methods=["POST"])
+def cancel_completion_api() -> dict:
     """
+    生成中の回答を中止する Web API (ユーザが回答の途中で話しかけた場合等に、クライアントから呼び出す)
+    turn_id を指定した場合は、そのターンを生成中の場合のみ中止する
 
-    # ユーザからのメッセージを取得
-    message = request.json["message"]
+    Returns:
+        dict: 中止したかどうか
+    """
+    user_id, _ = get_user_info()
+    body = request.get_json(silent=True) or {}
+    return {"cancelled": turns.cancel(user_id, CANCEL_REQUESTED, body.get("turn_id"))}
 
-    # ユーザの会話履歴を取得
-    history = _load_messages(user_id)
 
-    # Azure OpenAI Service - Chat Completion API で回答を生成
-    messages = [{"role": "system", "content": system_message}] + history + [{"role": "user", "content": message}]
-    chunks = openai_client.get_completion_with_tools(messages)
+def _get_completion_chunks(message: str, messages: list[dict], usage: dict, cancel_token=None, timer=None, cacheable: bool = False):
+    """
+    回答のチャンクを取得する
+    回答のキャッシュが有効な場合は、似た質問の回答がキャッシュにあればそれを再生し、なければ生成した回答をキャッシュに追加する
+    (キャッシュを使用できるのは、前の会話に依存せず、現在の時刻そのものを尋ねないターンのみ)
 
-    return Response(to_stream_resp(user_id, message, chunks), mimetype="text/event-stream")
+    Args:
+        message (str): ユーザからのメッセージ
+        messages (list[dict]): Chat Completion API へ送信するメッセージ
+        usage (dict): 構成要素ごとのトークン数
+        cancel_token (CancelToken): 回答の生成を中止するためのトークン
+        timer (TurnTimer): 段階ごとの所要時間を計測するクラス
+        cacheable (bool): 回答のキャッシュを使用できるターンか (is_cacheable_turn を参照)
 
+    Returns:
+        回答のチャンクを返すジェネレータ
+    """
+    if not answer_cache or not cacheable:
+        return openai_client.get_completion_with_tools(messages, usage, cancel_token, timer)
 
-def to_stream_resp(user_id: str, message: str, chunks):
+    # 埋め込みベクトルの生成に失敗した場合は、キャッシュを使用せずに回答を生成する
+    try:
+        with timer.stage("embedding"):
+            vector = openai_client.get_embedding(message)
+    except Exception:
+        logger.exception("failed to get embedding for answer cache")
+        return openai_client.get_completion_with_tools(messages, usage, cancel_token, timer)
+
+    answer = answer_cache.find(vector)
+    if answer is not None:
+        return replay_answer(answer)
+    return answer_cache.record(openai_client.get_completion_with_tools(messages, usage, cancel_token, timer), vector, message, messages)
+
+
+def to_stream_resp(user_id: str, message: str, chunks, encoder, messages: list[dict], cancel_token, timer):
     """
     チャンクをストリーム形式に変換する
+    回答の生成が中止された場合やクライアントが切断した場合は、上流のストリームとツール呼び出しを止めて、送信した分の回答のみを保存する
+
+    Args:
+        user_id (str): ユーザID
+        message (str): ユーザからのメッセージ
+        chunks: Azure OpenAI Service から返されるチャンク
+        encoder: ストリーム形式のエンコーダ (utils.stream を参照)
+        messages (list[dict]): Chat Completion API へ送信したメッセージ (ツール呼び出しのループで追加される)
+        cancel_token (CancelToken): 回答の生成を中止するためのトークン
+        timer (TurnTimer): 段階ごとの所要時間を計測するクラス (最後に timing イベントで内訳を返す)
+    """
+    turn_start = len(messages)
+    completed = False
+    status = TURN_CANCELLED
+    try:
+        for chunk in chunks:
+            if cancel_token.cancelled:
+                break
+            if not chunk or chunk == "[DONE]":
+                continue
+            frame = encoder.delta(chunk)
+            if frame:
+                timer.mark("first_frame")
+                yield frame
+        else:
+            completed = True
+            status = TURN_COMPLETED
+            done = encoder.done()
+            if done:
+                yield done
+
+            # 段階ごとの所要時間の内訳を最後のイベントとして返す (クライアントで読み上げの開始時刻と突き合わせる)
+            timing = encoder.timing(timer.get_summary())
+            if timing:
+                yield timing
+    except GenerationCancelled:
+        pass
+    except Exception:
+        status = TURN_FAILED
+        raise
+    finally:
+        chunks.close()
+        if not completed:
+            logger.info(f"completion interrupted: user_id={user_id}, reason={cancel_token.reason or 'disconnected'}, delivered={len(encoder.content)}")
+        try:
+            # 途中で中止された場合は、何も送信していなければ保存しない
+            if completed or encoder.content:
+                with timer.stage("save"):
+                    _save_messages(user_id, build_turn_messages(message, encoder.content, messages[turn_start:]))
+
+                # 要約モードの場合は、直近の会話より古い会話を要約にバックグラウンドで畳み込む
+                # (遅延書き込みの場合は、書き込みの完了後に開始する)
+                if summarizer and not history_writer:
+                    summarizer.update_in_background(user_id)
+        finally:
+            timer.finish(status)
+
+
+def to_busy_resp(error: AdmissionRejected) -> Response:
+    """
+    混雑中のため回答の生成を受け付けなかったことを返す
+
+    Args:
+        error (AdmissionRejected): 受付を拒否した理由
+
+    Returns:
+        Response: HTTP 429 のレスポンス
+    """
+    headers = {"Retry-After": str(max(math.ceil(error.retry_after), 1))}
+    return Response(json.dumps({"error": "busy", "reason": error.reason}), status=429, mimetype="application/json", headers=headers)
+
+
+@app.route("/api/metrics/admission", methods=["GET"])
+def get_admission_metrics_api() -> dict:
+    """
+    回答の生成の受付制御の状態 (実行中・待機中のリクエスト数、待機時間等) を取得する Web API
+
+    Returns:
+        dict: 受付制御の状態と統計情報
     """
-    content = ""
-    for chunk in chunks:
-        if not chunk or chunk == "[DONE]":
-            continue
-        content += chunk
-        yield json.dumps({"content": content}).replace("\n", "\\n") + "\n"
-    _save_message(user_id, {"role": "user", "content": message})
-    _save_message(user_id, {"role": "assistant", "content": content})
+    return admission.get_metrics()
+
+
+@app.route("/api/admin/profile", methods=["POST"])
+def start_profile_api() -> Response:
+    """
+    サンプリングプロファイラを開始する Web API (管理者用, X-Admin-Token ヘッダに PROFILER_ADMIN_TOKEN の値を指定する)
+    mode が window の場合は duration 秒の間、requests の場合は requests 件の /api/completion のリクエストを処理している間サンプリングする
+
+    Returns:
+        Response: 開始したプロファイルの状態
+    """
+    if not profiler.is_authorized(request.headers.get("X-Admin-Token")):
+        return to_json_resp({"error": "forbidden"}, 403)
+    body = request.get_json(silent=True) or {}
+    try:
+        session = profiler.start(body.get("mode", PROFILE_MODE_WINDOW), body.get("duration"), body.get("requests", 1), body.get("interval_ms"))
+    except ValueError as e:
+        return to_json_resp({"error": str(e)}, 400)
+    except ProfilerBusy:
+        return to_json_resp(profiler.session.get_status(), 409)
+    return to_json_resp(session.get_status(), 202)
+
+
+@app.route("/api/admin/profile", methods=["GET"])
+def get_profile_api() -> Response:
+    """
+    最後に実行したプロファイルの結果を取得する Web API (管理者用)
+    format に speedscope (https://www.speedscope.app で開く JSON) または collapsed (flamegraph.pl 等で使用するテキスト) を指定する
+
+    Returns:
+        Response: プロファイルの結果 (実行中の場合は 202 で状態を返す)
+    """
+    if not profiler.is_authorized(request.headers.get("X-Admin-Token")):
+        return to_json_resp({"error": "forbidden"}, 403)
+    if profiler.session is None:
+        return to_json_resp({"error": "not found"}, 404)
+    if profiler.session.state == PROFILE_RUNNING:
+        return to_json_resp(profiler.session.get_status(), 202)
+    try:
+        output, mimetype = profiler.get_output(request.args.get("format", FORMAT_SPEEDSCOPE))
+    except ValueError as e:
+        return to_json_resp({"error": str(e)}, 400)
+    return Response(output, mimetype=mimetype, headers={"X-Profile-Id": profiler.session.id})
+
+
+@app.route("/api/admin/profile", methods=["DELETE"])
+def stop_profile_api() -> Response:
+    """
+    実行中のプロファイルを終了する Web API (管理者用, 結果は GET で取得する)
+
+    Returns:
+        Response: 終了したプロファイルの状態
+    """
+    if not profiler.is_authorized(request.headers.get("X-Admin-Token")):
+        return to_json_resp({"error": "forbidden"}, 403)
+    session = profiler.stop()
+    if session is None:
+        return to_json_resp({"error": "not found"}, 404)
+    return to_json_resp(session.get_status())
+
+
+def to_json_resp(data: dict, status: int = 200) -> Response:
+    """
+    JSON 形式のレスポンスを生成する
+
+    Args:
+        data (dict): レスポンスのデータ
+        status (int): HTTP ステータスコード
+
+    Returns:
+        Response: レスポンス
+    """
+    return Response(json.dumps(data, ensure_ascii=False), status=status, mimetype="application/json")
+
+
+@app.route("/api/ready", methods=["GET"])
+def get_readiness_api() -> Response:
+    """
+    起動状況 (import にかかった時間と、依存先のクライアントの生成状況) を取得する Web API
+    生成していない依存先がある場合は、バックグラウンドで生成を開始して 503 を返す (ウォームアップ用のヘルスチェックに使用する)
+
+    Returns:
+        Response: 起動状況
+    """
+    status = startup_tracker.get_status()
+    if not status["ready"]:
+        startup_tracker.warm_in_background()
+    return Response(json.dumps(status), status=200 if status["ready"] else 503, mimetype="application/json")
 
 
 @app.route("/api/turnServer", methods=["GET"])
@@ -97,9 +397,7 @@ def get_turn_server_info_api() -> dict:
     Returns:
         dict: TURN サーバ情報
     """
-    url = f"https://{SPEECH_SERVICE_REGION}.tts.speech.microsoft.com/cognitiveservices/avatar/relay/token/v1"
-    resp = requests.get(url, headers={"Ocp-Apim-Subscription-Key": SPEECH_SERVICE_KEY}).json()
-    return {"urls": [resp["Urls"][0]], "username": resp["Username"], "credential": resp["Password"]}
+    return speech_credentials.get_ice_server()
 
 
 @app.route("/api/token", methods=["GET"])
@@ -108,37 +406,43 @@ def publish_access_token_api() -> dict:
     Azure Speech Service への一時アクセストークンを発行する Web API
 
     Returns:
-        dict: Azure Speech Service のアクセストークンとリージョン情報
+        dict: Azure Speech Service のアクセストークン、残りの有効期間(秒)、リージョン情報
     """
-    url = f"https://{SPEECH_SERVICE_REGION}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
-    headers = {"Ocp-Apim-Subscription-Key": SPEECH_SERVICE_KEY, "Content-type": "application/x-www-form-urlencoded"}
-    token = requests.post(url, headers=headers).text
-    return {"token": token, "region": SPEECH_SERVICE_REGION}
+    token, expires_in = speech_credentials.get_token()
+    return {"token": token, "expires_in": int(expires_in), "region": SPEECH_SERVICE_REGION}
 
 
 def _load_messages(user_id: str) -> list[dict]:
     """
-    会話履歴を Azure Cosmos DB から取得する
+    会話履歴を Azure Cosmos DB (またはキャッシュ) から取得する
+    遅延書き込みの場合は、まだ書き込みが完了していないメッセージも含める
 
     Returns:
         list[dict]: 会話履歴
     """
-    query = "SELECT * FROM c WHERE c.user_id = @user_id ORDER BY c._ts DESC OFFSET 0 LIMIT @limit"
-    params = [{"name": "@user_id", "value": user_id}, {"name": "@limit", "value": HISTORY_MESSAGE_COUNT}]
-    items = cosmos_client.query_items(query, params)
-    items = sorted(items, key=lambda x: x["_ts"])
-    return [{key: item[key] for key in {"role", "content"}} for item in items]
+    if not history_writer:
+        return history_store.load(user_id)
+
+    # 書き込み待ちのメッセージを先に取得し、その後に書き込みが完了したメッセージは ID で重複を除く
+    # (逆の順序では、2回の取得の間に書き込みが完了したメッセージがどちらにも含まれない)
+    pending = history_writer.get_pending(user_id)
+    items = history_store.load_items(user_id)
+    ids = {item["id"] for item in items}
+    items = (items + [m for m in pending if m["id"] not in ids])[-history_store.recent_count :]
+    return to_history_messages(items)
 
 
-def _save_message(user_id: str, message: dict):
+def _save_messages(user_id: str, messages: list[dict]):
     """
-    会話履歴を Azure Cosmos DB へ格納する
+    会話履歴を Azure Cosmos DB へ格納する (遅延書き込みの場合はキューに入れるのみで、すぐに戻る)
 
     Args:
-        message (list[dict]): 会話履歴
+        messages (list[dict]): 会話履歴
     """
-    message["user_id"] = user_id
-    cosmos_client.upsert_item(message)
+    if history_writer:
+        history_writer.submit(user_id, messages)
+    else:
+        history_store.append(user_id, messages)
 
 
 def get_user_info() -> tuple[str, str]:
@@ -151,28 +455,7 @@ def get_user_info() -> tuple[str, str]:
     # ヘッダーに付与されているEntra認証に関するプリンシパル情報を取得する
     # 参考: http://schemas.microsoft.com/identity/claims/objectidentifier
     principal = request.headers.get("X-Ms-Client-Principal", "")
-
-    # プリンシパルが設定されていない場合のユーザIDとユーザ名を定義
-    user_id = "00000000-0000-0000-0000-000000000000"
-    user_name = ""
-
-    # プリンシパルが設定されている場合のユーザIDとユーザ名を取得
-    if principal:
-
-        # プリンシパルをBase64デコードする
-        principal = base64.b64decode(principal).decode("utf-8")
-        principal = json.loads(principal)
-
-        # プリンシパルから特定のキーの値を取得する関数を定義
-        def get_princival_value(key, default):
-            claims = [c["val"] for c in principal["claims"] if c["typ"] == key]
-            return claims[0] if claims else default
-
-        # ユーザーIDとユーザー名を取得する
-        user_id = get_princival_value("http://schemas.microsoft.com/identity/claims/objectidentifier", "00000000-0000-0000-0000-000000000000")
-        user_name = get_princival_value("http://schemas.xmlsoap.org/ws/2005/05/identity/claims/emailaddress", "unknown")
-
-    return (user_id, user_name)
+    return parse_user_principal(principal)
 
 
 if __name__ == "__main__":
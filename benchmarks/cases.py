@@ -0,0 +1,245 @@
+"""
+ベンチマークの計測対象 (アプリケーションのホットパス) の定義
+各ケースは、準備 (計測に含めない) を行って、1回分の処理を実行する関数を返す
+1回分の処理を実行する関数は、送信 (または出力) したバイト数を返す
+"""
+
+import os
+import json
+from dataclasses import dataclass
+from typing import Callable
+from unittest import mock
+
+# アプリケーションの import 時に読み込まれる設定 (.env の設定に左右されないよう、計測に影響する設定は固定する)
+BENCHMARK_ENV = {
+    "DEBUG": "true",  # Azure Application Insights へのログ出力とトレースを無効にする
+    "STARTUP_MODE": "lazy",
+    "STREAM_VERSION": "1",
+    "PROMPT_LAYOUT": "prefix_stable",
+    "HISTORY_MODE": "window",
+    "HISTORY_STORE": "messages",
+    "HISTORY_WRITE_MODE": "sync",
+    "HISTORY_MESSAGE_COUNT": "4",
+    "ANSWER_CACHE_ENABLED": "false",
+    "PROFILER_MODE": "",
+    "OPENAI_ENDPOINT": "https://benchmark.openai.azure.com/",
+    "OPENAI_ENDPOINTS": "",
+    "OPENAI_API_KEY": "benchmark",
+    "OPENAI_STREAM_INCLUDE_USAGE": "false",
+    "AI_SEARCH_BACKEND": "azure",
+    "AI_SEARCH_ENDPOINT": "https://benchmark.search.windows.net",
+    "AI_SEARCH_API_KEY": "benchmark",
+    "AI_SEARCH_INDEX_NAME": "benchmark",
+    "AI_SEARCH_USE_SEMANTIC_SEARCH": "false",
+    "AI_SEARCH_CACHE_SIZE": "0",
+    "BING_SEARCH_API_KEY": "benchmark",
+    "SPEECH_SERVICE_KEY": "",
+}
+
+# 計測に使用するユーザとメッセージ
+USER_ID = "bench-user"
+MESSAGE = "今日の東京の天気と、在宅勤務の申請方法を教えて"
+
+# timing イベントは計測した所要時間を含み、実行のたびに長さが変わるため、送信したバイト数に含めない
+TIMING_EVENT = "\nevent: timing\n"
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    """
+    ベンチマークのケース
+    """
+
+    name: str
+    description: str
+    setup: Callable[[], Callable[[], int]]
+
+
+def import_app():
+    """
+    計測用の設定でアプリケーション (app.py) を import する
+    外部サービスへ接続するバックグラウンドの処理 (Azure Speech Service のトークンの更新) は開始しない
+    """
+    os.environ.update(BENCHMARK_ENV)
+    with mock.patch("dotenv.load_dotenv"), mock.patch("utils.speech.SpeechCredentialCache.start"):
+        import app
+    return app
+
+
+app = import_app()
+
+from utils.cache import LRUCache
+from utils.cancel import CancelToken
+from utils.chat import build_system_message, build_context_message, with_message_ids
+from utils.history import MessageHistoryStore, PartitionedHistoryStore, WINDOW_ITEM_ID
+from utils.openai_stream import CompletionStreamAssembler
+from utils.persistence import WriteBehindWriter
+from utils.stream import get_stream_encoder, STREAM_VERSION_CUMULATIVE, STREAM_VERSION_DELTA, STREAM_VERSION_PHRASE
+from utils.timing import TurnTimer
+from stubs import create_openai_client, create_cosmos_container, load_chunk_rounds, load_fixture
+
+
+def _use_history_store(store, history_writer=None):
+    """
+    アプリケーションが使用する会話履歴ストアを差し替える
+    """
+    app.history_store = store
+    app.history_writer = history_writer
+    app.summarizer = None
+
+
+def _create_message_store(cached: bool = True) -> MessageHistoryStore:
+    """
+    記録したクエリ結果を返す、従来の形式の会話履歴ストアを生成する
+
+    Args:
+        cached (bool): キャッシュを使用するか (使用しない場合は、毎回クエリの結果を変換する)
+    """
+    store = MessageHistoryStore(create_cosmos_container(items=load_fixture("cosmos_history")["items"]))
+    if not cached:
+        # 空の LRUCache は偽と評価されるため、コンストラクタではなく生成後に差し替える
+        store.cache = LRUCache(maxsize=0)
+    return store
+
+
+def _build_messages(client) -> tuple[list[dict], dict]:
+    """
+    記録した会話履歴から、Chat Completion API へ送信するメッセージを組み立てる (計測の準備として1回だけ行う)
+    """
+    history = app._load_messages(USER_ID)
+    system_message, context_message = build_system_message(app.PROMPT_LAYOUT), build_context_message(app.PROMPT_LAYOUT)
+    return client.context.build(system_message, history, MESSAGE, None, context_message)
+
+
+def stream_resp(chunks_name: str, version: int) -> Callable[[], Callable[[], int]]:
+    """
+    記録したストリームから回答を生成し、ストリーム形式に変換して送信するまで (to_stream_resp) を計測する
+    会話履歴の保存 (スタブの Azure Cosmos DB への書き込み) と timing イベントを含む
+    """
+
+    def setup():
+        client = create_openai_client(chunks_name)
+        app.openai_client = client
+        app.answer_cache = None
+        _use_history_store(_create_message_store())
+        base_messages, base_usage = _build_messages(client)
+
+        def run() -> int:
+            messages, usage = list(base_messages), dict(base_usage)
+            timer = TurnTimer()
+            cancel_token = CancelToken()
+            chunks = app._get_completion_chunks(MESSAGE, messages, usage, cancel_token, timer)
+            encoder = get_stream_encoder(version)
+            frames = app.to_stream_resp(USER_ID, MESSAGE, chunks, encoder, messages, cancel_token, timer)
+            return sum(len(frame.encode("utf-8")) for frame in frames if TIMING_EVENT not in frame)
+
+        return run
+
+    return setup
+
+
+def completion_with_tools(chunks_name: str) -> Callable[[], Callable[[], int]]:
+    """
+    記録したストリームの組み立てとツール呼び出しのループ (get_completion_with_tools) を計測する
+    """
+
+    def setup():
+        client = create_openai_client(chunks_name)
+        _use_history_store(_create_message_store())
+        base_messages, base_usage = _build_messages(client)
+
+        def run() -> int:
+            messages, usage = list(base_messages), dict(base_usage)
+            return sum(len(content.encode("utf-8")) for content in client.get_completion_with_tools(messages, usage))
+
+        return run
+
+    return setup
+
+
+def load_messages(store_name: str) -> Callable[[], Callable[[], int]]:
+    """
+    会話履歴の取得 (_load_messages) を計測する
+    """
+
+    def setup():
+        history = load_fixture("cosmos_history")
+        if store_name == "query":
+            _use_history_store(_create_message_store(cached=False))
+        elif store_name == "cached":
+            _use_history_store(_create_message_store())
+        elif store_name == "partitioned":
+            store = PartitionedHistoryStore(create_cosmos_container(documents={WINDOW_ITEM_ID: history["window"]}))
+            store.cache = LRUCache(maxsize=0)
+            _use_history_store(store)
+        elif store_name == "write_behind":
+            # 書き込みが完了していないメッセージを、キューを経由せずに登録しておく (書き込みは行わない)
+            writer = WriteBehindWriter(lambda user_id, messages: None)
+            writer.pending[USER_ID] = [(USER_ID, with_message_ids(history["pending"]))]
+            _use_history_store(_create_message_store(cached=False), writer)
+        else:
+            raise ValueError(f"Unknown history store: {store_name}")
+
+        def run() -> int:
+            return len(json.dumps(app._load_messages(USER_ID), ensure_ascii=False).encode("utf-8"))
+
+        return run
+
+    return setup
+
+
+def tool_json(tool_name: str) -> Callable[[], Callable[[], int]]:
+    """
+    ツールの実行結果の JSON への変換 (OpenAITools の各ツール) を計測する
+    Bing Search API と気象庁の API の結果は、実際の運用と同様に、2回目以降はキャッシュから返す
+    """
+
+    def setup():
+        tools = create_openai_client("chunks_multi_tool_calls").tools
+        if tool_name == "run_tool_calls":
+            # 記録したストリームのツール呼び出しを、スレッドプールで並列に実行する
+            assembler = CompletionStreamAssembler()
+            for chunk in load_chunk_rounds("chunks_multi_tool_calls")[0]:
+                assembler.feed(chunk)
+            tool_calls = assembler.get_tool_calls()
+
+            def run() -> int:
+                return sum(len(m["content"].encode("utf-8")) for m in tools.run_tool_calls(tool_calls))
+
+            return run
+
+        calls = {
+            "search_documents": lambda: tools.search_documents("在宅勤務 申請 期限", count=3),
+            "search_news": lambda: tools.search_news("Business", count=3),
+            "get_weather": lambda: tools.get_weather("東京"),
+        }
+        call = calls[tool_name]
+
+        def run() -> int:
+            return len(call().encode("utf-8"))
+
+        return run
+
+    return setup
+
+
+CASES = [
+    BenchmarkCase("stream_resp/v1/plain", "短い回答を累積形式 (v1) で送信する", stream_resp("chunks_plain_answer", STREAM_VERSION_CUMULATIVE)),
+    BenchmarkCase("stream_resp/v2/plain", "短い回答を差分形式 (v2) で送信する", stream_resp("chunks_plain_answer", STREAM_VERSION_DELTA)),
+    BenchmarkCase("stream_resp/v3/plain", "短い回答をフレーズ形式 (v3) で送信する", stream_resp("chunks_plain_answer", STREAM_VERSION_PHRASE)),
+    BenchmarkCase("stream_resp/v1/long", "長い回答を累積形式 (v1) で送信する", stream_resp("chunks_long_answer", STREAM_VERSION_CUMULATIVE)),
+    BenchmarkCase("stream_resp/v2/long", "長い回答を差分形式 (v2) で送信する", stream_resp("chunks_long_answer", STREAM_VERSION_DELTA)),
+    BenchmarkCase("stream_resp/v3/long", "長い回答をフレーズ形式 (v3) で送信する", stream_resp("chunks_long_answer", STREAM_VERSION_PHRASE)),
+    BenchmarkCase("stream_resp/v3/multi_tool", "3つのツールを呼び出した後の回答をフレーズ形式 (v3) で送信する", stream_resp("chunks_multi_tool_calls", STREAM_VERSION_PHRASE)),
+    BenchmarkCase("completion_with_tools/plain", "ツール呼び出しのない短い回答を生成する", completion_with_tools("chunks_plain_answer")),
+    BenchmarkCase("completion_with_tools/multi_tool", "3つのツールを並列に呼び出した後に回答を生成する", completion_with_tools("chunks_multi_tool_calls")),
+    BenchmarkCase("completion_with_tools/long", "長い回答を生成する", completion_with_tools("chunks_long_answer")),
+    BenchmarkCase("load_messages/query", "従来の形式の会話履歴を、キャッシュを使用せずにクエリの結果から取得する", load_messages("query")),
+    BenchmarkCase("load_messages/cached", "従来の形式の会話履歴をキャッシュから取得する", load_messages("cached")),
+    BenchmarkCase("load_messages/partitioned", "ユーザごとの会話履歴を、キャッシュを使用せずにポイント読み取りで取得する", load_messages("partitioned")),
+    BenchmarkCase("load_messages/write_behind", "書き込みが完了していないメッセージを含めて会話履歴を取得する", load_messages("write_behind")),
+    BenchmarkCase("tools_json/search_documents", "Azure AI Search の検索結果を整形して JSON に変換する", tool_json("search_documents")),
+    BenchmarkCase("tools_json/search_news", "Bing News Search API の結果 (キャッシュ) を JSON に変換する", tool_json("search_news")),
+    BenchmarkCase("tools_json/get_weather", "天気予報 (キャッシュ) を JSON に変換する", tool_json("get_weather")),
+    BenchmarkCase("tools_json/run_tool_calls", "3つのツールをスレッドプールで並列に呼び出し、結果をメッセージに変換する", tool_json("run_tool_calls")),
+]
@@ -0,0 +1,190 @@
+"""
+アプリケーションのホットパス (ストリームの変換、ツール呼び出しのループ、会話履歴の取得、ツールの実行結果の JSON への変換) のマイクロベンチマーク
+外部サービスへのリクエストは、記録したレスポンス (benchmarks/fixtures) を返すスタブに置き換えて、プロセス内の処理のみを計測する
+1回あたりの所要時間、メモリ割り当てのピーク、送信したバイト数を出力し、保存したベースラインと比較できる
+ベースラインと比較して、所要時間またはメモリ割り当てが閾値を超えて増えた場合や、送信したバイト数が変わった場合は終了コード 1 で終了する
+
+使い方 (リポジトリのルートディレクトリで実行する):
+    python benchmarks/run_benchmarks.py [--filter stream_resp] [--iterations 100] [--save]
+    python benchmarks/run_benchmarks.py --compare [--threshold 0.1]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import fnmatch
+import argparse
+import platform
+import datetime
+import statistics
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.logger import logger
+
+# アプリケーションの import 時とケースごとの INFO ログ (起動時間、ターンの所要時間の内訳等) は出力しない
+logger.setLevel(logging.WARNING)
+
+from cases import CASES, BenchmarkCase
+
+# ベースラインの保存先 (計測した環境に依存するため、リポジトリには含めない)
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "baseline.json")
+
+
+def measure(case: BenchmarkCase, iterations: int, warmup: int, alloc_iterations: int) -> dict:
+    """
+    ケースを繰り返し実行し、所要時間とメモリ割り当てを計測する
+    所要時間への影響を避けるため、メモリ割り当ては所要時間とは別に tracemalloc を有効にして計測する
+
+    Args:
+        case (BenchmarkCase): 計測するケース
+        iterations (int): 所要時間を計測する回数
+        warmup (int): 計測前に実行する回数 (キャッシュへの格納等、初回のみの処理を除く)
+        alloc_iterations (int): メモリ割り当てを計測する回数
+
+    Returns:
+        dict: 所要時間(マイクロ秒)の統計値、メモリ割り当てのピーク(バイト)、呼び出し後も残ったメモリ(バイト)、送信したバイト数
+    """
+    run = case.setup()
+    for _ in range(warmup):
+        run()
+
+    durations = []
+    emitted = None
+    for _ in range(iterations):
+        started_at = time.perf_counter_ns()
+        emitted = run()
+        durations.append((time.perf_counter_ns() - started_at) / 1000)
+
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_iterations):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            run()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+
+    durations.sort()
+    return {
+        "iterations": iterations,
+        "median_us": round(statistics.median(durations), 1),
+        "mean_us": round(statistics.fmean(durations), 1),
+        "p95_us": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 1),
+        "min_us": round(durations[0], 1),
+        "alloc_peak_bytes": int(statistics.median(peaks)) if peaks else None,
+        "alloc_retained_bytes": int(statistics.median(retained)) if retained else None,
+        "bytes": emitted,
+    }
+
+
+def compare(result: dict, baseline: dict | None, threshold: float, alloc_threshold: float) -> tuple[str, list[str]]:
+    """
+    計測結果をベースラインと比較する
+
+    Args:
+        result (dict): 計測結果
+        baseline (dict | None): ベースラインの計測結果 (ベースラインにないケースの場合は None)
+        threshold (float): 所要時間 (中央値) の増加の許容割合
+        alloc_threshold (float): メモリ割り当てのピークの増加の許容割合
+
+    Returns:
+        tuple[str, list[str]]: 比較結果の表示と、劣化した項目の一覧
+    """
+    if baseline is None:
+        return "new", []
+    regressions = []
+    time_ratio = result["median_us"] / baseline["median_us"] - 1 if baseline["median_us"] else 0
+    if time_ratio > threshold:
+        regressions.append(f"time +{time_ratio:.1%}")
+    alloc_ratio = 0
+    if result["alloc_peak_bytes"] is not None and baseline.get("alloc_peak_bytes"):
+        alloc_ratio = result["alloc_peak_bytes"] / baseline["alloc_peak_bytes"] - 1
+        if alloc_ratio > alloc_threshold:
+            regressions.append(f"alloc +{alloc_ratio:.1%}")
+    if result["bytes"] != baseline["bytes"]:
+        regressions.append(f"bytes {baseline['bytes']} -> {result['bytes']}")
+    return f"time {time_ratio:+.1%}, alloc {alloc_ratio:+.1%}", regressions
+
+
+def load_baseline(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: dict, args: argparse.Namespace):
+    """
+    計測結果をベースラインとして保存する (既存のベースラインに含まれる、今回計測しなかったケースは残す)
+    """
+    cases = load_baseline(path)["cases"] if os.path.exists(path) else {}
+    cases.update(results)
+    baseline = {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "cases": cases,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def select_cases(patterns: list[str] | None) -> list[BenchmarkCase]:
+    """
+    名前がパターン (ワイルドカードまたは部分一致) に一致するケースを選択する
+    """
+    if not patterns:
+        return CASES
+    return [case for case in CASES if any(fnmatch.fnmatch(case.name, p) or p in case.name for p in patterns)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="アプリケーションのホットパスのマイクロベンチマークを実行する")
+    parser.add_argument("--filter", action="append", help="実行するケースの名前 (ワイルドカードまたは部分一致, 複数指定可)")
+    parser.add_argument("--list", action="store_true", help="ケースの一覧を表示して終了する")
+    parser.add_argument("--iterations", type=int, default=100, help="所要時間を計測する回数")
+    parser.add_argument("--warmup", type=int, default=10, help="計測前に実行する回数")
+    parser.add_argument("--alloc-iterations", type=int, default=5, help="メモリ割り当てを計測する回数 (0 の場合は計測しない)")
+    parser.add_argument("--save", nargs="?", const=DEFAULT_BASELINE_PATH, help="計測結果をベースラインとして保存する (パスを省略した場合は benchmarks/baselines/baseline.json)")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE_PATH, help="ベースラインと比較する (パスを省略した場合は benchmarks/baselines/baseline.json)")
+    parser.add_argument("--threshold", type=float, default=0.1, help="所要時間 (中央値) の増加の許容割合")
+    parser.add_argument("--alloc-threshold", type=float, default=0.1, help="メモリ割り当てのピークの増加の許容割合")
+    args = parser.parse_args()
+
+    cases = select_cases(args.filter)
+    if args.list or not cases:
+        for case in cases:
+            print(f"{case.name}: {case.description}")
+        sys.exit(0 if cases else 1)
+
+    baseline = load_baseline(args.compare)["cases"] if args.compare else None
+
+    results, regressed = {}, []
+    print(f"{'case':<36} {'median(us)':>12} {'p95(us)':>12} {'alloc(KiB)':>11} {'bytes':>8}")
+    for case in cases:
+        result = measure(case, args.iterations, args.warmup, args.alloc_iterations)
+        results[case.name] = result
+        alloc = f"{result['alloc_peak_bytes'] / 1024:,.1f}" if result["alloc_peak_bytes"] is not None else "-"
+        line = f"{case.name:<36} {result['median_us']:>12,.1f} {result['p95_us']:>12,.1f} {alloc:>11} {result['bytes']:>8,}"
+        if baseline is not None:
+            summary, regressions = compare(result, baseline.get(case.name), args.threshold, args.alloc_threshold)
+            line += f"  [{summary}]"
+            if regressions:
+                line += f"  REGRESSION: {', '.join(regressions)}"
+                regressed.append(case.name)
+        print(line, flush=True)
+
+    if args.save:
+        save_baseline(args.save, results, args)
+        print(f"baseline saved: {args.save}")
+    if regressed:
+        print(f"{len(regressed)} case(s) regressed: {', '.join(regressed)}", file=sys.stderr)
+        sys.exit(1)
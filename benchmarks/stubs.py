@@ -0,0 +1,183 @@
+"""
+ベンチマークで使用する、外部サービスの代わりに記録したレスポンスを返すスタブ
+Azure OpenAI Service、Azure Cosmos DB、Azure AI Search、Bing Search API、気象庁の API の通信部分のみを置き換え、
+それより内側の処理 (ストリームの組み立て、ツール呼び出し、JSON への変換等) はアプリケーションのコードをそのまま実行する
+"""
+
+import os
+import json
+import time
+from unittest import mock
+from openai.types.chat import ChatCompletionChunk
+from utils.cosmos import CosmosContainer
+from utils.openai import OpenAIClient
+
+# 記録したレスポンスを格納するディレクトリ
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name: str) -> dict:
+    """
+    記録したレスポンスを読み込む
+
+    Args:
+        name (str): ファイル名 (拡張子を除く)
+
+    Returns:
+        dict: 記録したレスポンス
+    """
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_chunk_rounds(name: str) -> list[list[ChatCompletionChunk]]:
+    """
+    記録した Chat Completion API のストリームを読み込む (計測に含めないよう、チャンクは事前に型に変換しておく)
+    Azure OpenAI Service は choices が空のチャンク等、スキーマに厳密には従わないチャンクを返すため、
+    openai パッケージのストリームと同様に検証せずに変換する
+
+    Args:
+        name (str): ファイル名 (拡張子を除く)
+
+    Returns:
+        list[list[ChatCompletionChunk]]: リクエストごとのチャンクのリスト (ツール呼び出しのループの回数分)
+    """
+    fixture = load_fixture(name)
+    return [[ChatCompletionChunk.construct(**chunk) for chunk in chunks] for chunks in fixture["rounds"]]
+
+
+class ReplayStream:
+    """
+    記録したチャンクを順に返すストリーム (openai.Stream の代わり)
+    """
+
+    def __init__(self, chunks: list[ChatCompletionChunk]):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayRouter:
+    """
+    記録したストリームを返す OpenAIRouter の代わり
+    リクエストのたびに次のストリームを返し、最後まで返したら最初に戻る (1回の回答の生成で、ツール呼び出しのループの回数分のリクエストを送信する)
+    """
+
+    def __init__(self, rounds: list[list[ChatCompletionChunk]]):
+        self.rounds = rounds
+        self.position = 0
+
+    def create_chat_completion(self, **kwargs) -> ReplayStream:
+        chunks = self.rounds[self.position]
+        self.position = (self.position + 1) % len(self.rounds)
+        return ReplayStream(chunks)
+
+
+class StubCosmosSDKContainer:
+    """
+    Azure Cosmos DB の SDK のコンテナクライアント (ContainerProxy) の代わり
+    """
+
+    def __init__(self, items: list[dict] = None, documents: dict[str, dict] = None):
+        """
+        Args:
+            items (list[dict]): クエリの結果として返すアイテム
+            documents (dict[str, dict]): ポイント読み取りで返すアイテム (アイテムIDがキー)
+        """
+        self.items = items or []
+        self.documents = documents or {}
+
+    def query_items(self, query: str, parameters: list[dict] = None, **kwargs):
+        return iter(self.items)
+
+    def read_item(self, item: str, partition_key: str):
+        return self.documents[item]
+
+    def upsert_item(self, body: dict, **kwargs) -> dict:
+        return {**body, "_ts": int(time.time())}
+
+    def create_item(self, body: dict, **kwargs) -> dict:
+        return {**body, "_ts": int(time.time())}
+
+
+def create_cosmos_container(items: list[dict] = None, documents: dict[str, dict] = None) -> CosmosContainer:
+    """
+    SDK のコンテナクライアントのみをスタブに置き換えた CosmosContainer を生成する (Azure Cosmos DB には接続しない)
+    """
+    container = CosmosContainer.__new__(CosmosContainer)
+    container.container = StubCosmosSDKContainer(items, documents)
+    return container
+
+
+class StubSearchSDKClient:
+    """
+    Azure AI Search の SDK の検索クライアント (SearchClient) の代わり
+    """
+
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    def search(self, **params):
+        return iter(self.docs)
+
+
+class StubResponse:
+    """
+    requests.Response の代わり
+    """
+
+    def __init__(self, data, status_code: int = 200, headers: dict = None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession:
+    """
+    requests.Session の代わり (URL に関わらず、同じレスポンスを返す)
+    """
+
+    def __init__(self, data, headers: dict = None):
+        self.response = StubResponse(data, headers=headers)
+
+    def get(self, url: str, **kwargs) -> StubResponse:
+        return self.response
+
+    def close(self):
+        pass
+
+
+def create_openai_client(chunks_name: str) -> OpenAIClient:
+    """
+    Chat Completion API のストリームと、ツールが呼び出す外部サービスをスタブに置き換えた OpenAIClient を生成する
+
+    Args:
+        chunks_name (str): 返すストリームを記録したファイル名 (拡張子を除く)
+
+    Returns:
+        OpenAIClient: クライアント
+    """
+    # 埋め込みベクトルの生成には使用しないため、Azure OpenAI Service のクライアントは生成しない
+    with mock.patch("utils.openai.AzureOpenAI"):
+        client = OpenAIClient()
+    client.router = ReplayRouter(load_chunk_rounds(chunks_name))
+
+    tools = client.tools
+    tools.search_client.search_client = StubSearchSDKClient(load_fixture("search_documents")["value"])
+    tools.bing_client.session = StubSession(load_fixture("bing_news")["response"])
+    tools.weather_client.session = StubSession(load_fixture("jma_forecast")["response"], headers={"ETag": '"bench"'})
+    return client
@@ -0,0 +1,51 @@
+"""
+Web アプリケーションの起動時間 (app.py の import にかかる時間) を計測し、目標 (STARTUP_TIME_BUDGET) に収まるか確認する
+別のプロセスで複数回 import し、中央値が目標を超えた場合は終了コード 1 で終了する (CI やデプロイ前の確認に使用する)
+
+使い方 (リポジトリのルートディレクトリで実行する):
+    python deploy/check_startup.py [--module app] [--mode lazy] [--runs 5] [--budget 2.0]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from dotenv import load_dotenv
+
+# 別のプロセスで実行するスクリプト (import にかかった時間をアプリケーション自身が計測した値を出力する)
+MEASURE_SCRIPT = "import json, {module}; print(json.dumps({module}.startup_tracker.get_status()))"
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Web アプリケーションの起動時間を計測し、目標に収まるか確認する")
+    parser.add_argument("--module", default="app", help="計測するモジュール (app または app_async)")
+    parser.add_argument("--mode", default=os.getenv("STARTUP_MODE", "lazy"), help="起動モード (eager, background, lazy)")
+    parser.add_argument("--runs", type=int, default=5, help="計測する回数")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("STARTUP_TIME_BUDGET", 2.0)), help="import にかかる時間の目標(秒)")
+    args = parser.parse_args()
+
+    root = os.path.join(os.path.dirname(__file__), "..")
+    env = {**os.environ, "STARTUP_MODE": args.mode, "STARTUP_TIME_BUDGET": str(args.budget)}
+    import_seconds, process_seconds = [], []
+    for i in range(args.runs):
+        started_at = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", MEASURE_SCRIPT.format(module=args.module)], cwd=root, env=env, capture_output=True, text=True)
+        elapsed = time.perf_counter() - started_at
+        if result.returncode != 0:
+            print(result.stderr, file=sys.stderr)
+            sys.exit(result.returncode)
+        status = json.loads(result.stdout.strip().splitlines()[-1])
+        import_seconds.append(status["import_seconds"])
+        process_seconds.append(elapsed)
+        states = {name: resource["state"] for name, resource in status["resources"].items()}
+        print(f"run {i + 1}: import={status['import_seconds']:.3f}s, process={elapsed:.3f}s, resources={states}")
+
+    median = statistics.median(import_seconds)
+    print(f"mode={args.mode}, import median={median:.3f}s, max={max(import_seconds):.3f}s, process median={statistics.median(process_seconds):.3f}s, budget={args.budget:.3f}s")
+    if median > args.budget:
+        print("startup time exceeded the budget", file=sys.stderr)
+        sys.exit(1)
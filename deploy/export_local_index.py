@@ -0,0 +1,94 @@
+"""
+インデックス定義 (deploy/search_index.json) に従って、ローカルのベクトルインデックスのファイルを作成する
+作成したファイルは、AI_SEARCH_BACKEND="local" と LOCAL_SEARCH_INDEX_DIR を設定すると検索に使用される (utils/local_search.py を参照)
+
+ドキュメントは JSON Lines 形式のファイル、または Azure AI Search のインデックスから読み込む
+埋め込みベクトルが含まれていないドキュメントは、Azure OpenAI Service でベクトル化する
+
+使い方 (リポジトリのルートディレクトリで実行する):
+    python deploy/export_local_index.py --source docs.jsonl [--output local_index]
+    python deploy/export_local_index.py --from-index [--output local_index]
+"""
+
+import os
+import sys
+import json
+import argparse
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.ingest import read_jsonl
+from utils.search import AzureSearchClient
+from utils.local_search import LocalIndexWriter, EmbeddingClient, get_index_fields
+
+
+def export(docs, definition: dict, output: str, index_name: str, batch_size: int = 16) -> dict:
+    """
+    ドキュメントを埋め込みベクトルとともにローカルのインデックスへ書き込む
+
+    Args:
+        docs: ドキュメント (リストまたはジェネレータ)
+        definition (dict): インデックス定義
+        output (str): ファイルを作成するディレクトリ
+        index_name (str): インデックス名
+        batch_size (int): 一度にベクトル化するドキュメント数
+
+    Returns:
+        dict: インデックスの情報
+    """
+    writer = LocalIndexWriter(output, definition, index_name=index_name)
+    fields = get_index_fields(definition)
+    embedding_client = None
+
+    def flush(batch: list[dict]):
+        nonlocal embedding_client
+        missing = [d for d in batch if not d.get(fields["vector"])]
+        if missing:
+            embedding_client = embedding_client or EmbeddingClient()
+            texts = [str(d.get(fields["source"]) or "") if fields["source"] else " ".join(str(d.get(n) or "") for n in fields["searchable"]) for d in missing]
+            for doc, vector in zip(missing, embedding_client.embed(texts)):
+                doc[fields["vector"]] = vector
+        for doc in batch:
+            writer.add(doc, doc[fields["vector"]])
+
+    batch = []
+    for doc in tqdm(docs, unit="doc"):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return writer.close()
+
+
+def read_index(client: AzureSearchClient, fields: dict):
+    """
+    Azure AI Search のインデックスから、すべてのドキュメントを読み込む (ベクトルは保存されていない場合があるため取得しない)
+    """
+    yield from client.search_client.search(search_text="*", select=fields["retrievable"])
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="ローカルのベクトルインデックスのファイルを作成する")
+    parser.add_argument("--definition", default=os.path.join(os.path.dirname(__file__), "search_index.json"), help="インデックス定義のJSONファイルパス")
+    parser.add_argument("--source", help="ドキュメントのファイルパス (1行に1ドキュメントの JSON)")
+    parser.add_argument("--from-index", action="store_true", help="Azure AI Search のインデックスからドキュメントを読み込む")
+    parser.add_argument("--index-name", default=os.getenv("AI_SEARCH_INDEX_NAME"), help="インデックス名")
+    parser.add_argument("--output", default=os.getenv("LOCAL_SEARCH_INDEX_DIR", "local_index"), help="ファイルを作成するディレクトリ")
+    parser.add_argument("--batch-size", type=int, default=16, help="一度にベクトル化するドキュメント数")
+    args = parser.parse_args()
+    if not args.source and not args.from_index:
+        parser.error("--source または --from-index を指定してください")
+
+    with open(args.definition, "r") as f:
+        definition = json.load(f)
+    if args.from_index:
+        docs = read_index(AzureSearchClient(index_name=args.index_name), get_index_fields(definition))
+    else:
+        docs = read_jsonl(args.source)
+    manifest = export(docs, definition, args.output, args.index_name, batch_size=args.batch_size)
+    print(f"done: {manifest}")
@@ -0,0 +1,41 @@
+"""
+JSON Lines 形式のファイルのドキュメントを、Azure AI Search のインデックスへ登録する
+ファイルは1行ずつ読み込むため、ドキュメント数が多くてもメモリ使用量は一定に収まる
+
+使い方 (リポジトリのルートディレクトリで実行する):
+    python deploy/ingest_documents.py docs.jsonl [--recreate-index] [--max-batch-bytes 8388608] [--max-concurrency 8]
+"""
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.search import AzureSearchClient
+from utils.ingest import SearchIngestionPipeline, read_jsonl
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="JSON Lines 形式のファイルのドキュメントを、Azure AI Search のインデックスへ登録する")
+    parser.add_argument("path", help="ドキュメントのファイルパス (1行に1ドキュメントの JSON)")
+    parser.add_argument("--index-name", default=os.getenv("AI_SEARCH_INDEX_NAME"), help="インデックス名")
+    parser.add_argument("--recreate-index", action="store_true", help="登録する前にインデックスを再作成する (deploy/search_index.json を使用する)")
+    parser.add_argument("--max-batch-bytes", type=int, default=None, help="1つのバッチの JSON のバイト数の上限")
+    parser.add_argument("--max-batch-documents", type=int, default=None, help="1つのバッチのドキュメント数の上限")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="同時に送信するバッチ数の上限")
+    args = parser.parse_args()
+
+    client = AzureSearchClient(index_name=args.index_name)
+    if args.recreate_index:
+        client.recreate_index(os.path.join(os.path.dirname(__file__), "search_index.json"))
+
+    pipeline = SearchIngestionPipeline(
+        client.search_client,
+        max_batch_bytes=args.max_batch_bytes,
+        max_batch_documents=args.max_batch_documents,
+        max_concurrency=args.max_concurrency,
+    )
+    stats = pipeline.run(read_jsonl(args.path))
+    print(f"done: {stats}")
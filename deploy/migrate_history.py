@@ -0,0 +1,82 @@
+"""
+1メッセージ1アイテムの (従来の形式の) 会話履歴を、ユーザごとにパーティション分割した会話履歴のコンテナへ移行する
+
+使い方 (リポジトリのルートディレクトリで実行する):
+    python deploy/migrate_history.py [--max-messages 50] [--dry-run]
+"""
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.cosmos import CosmosContainer
+from utils.chat import expand_history_items
+from utils.history import PartitionedHistoryStore, WINDOW_ITEM_ID, get_partitioned_container_name
+
+# 会話履歴を持つユーザの一覧を取得するクエリ
+USERS_QUERY = "SELECT DISTINCT VALUE c.user_id FROM c WHERE IS_DEFINED(c.user_id) AND (IS_DEFINED(c.role) OR IS_DEFINED(c.messages))"
+
+# ユーザの直近の会話履歴を取得するクエリ (1メッセージ1アイテムの形式と、1ターン1アイテムの形式の両方)
+USER_MESSAGES_QUERY = "SELECT * FROM c WHERE c.user_id = @user_id AND (IS_DEFINED(c.role) OR IS_DEFINED(c.messages)) ORDER BY c._ts DESC OFFSET 0 LIMIT @limit"
+
+# 会話の要約の一覧を取得するクエリ
+SUMMARIES_QUERY = "SELECT * FROM c WHERE IS_DEFINED(c.summary_of)"
+
+
+def migrate(source: CosmosContainer, target: CosmosContainer, max_messages: int, dry_run: bool = False) -> dict:
+    """
+    会話履歴と会話の要約を移行する (ユーザ単位で処理するため、メモリ使用量はユーザ1人分の会話履歴に収まる)
+
+    Args:
+        source (CosmosContainer): 従来の形式の会話履歴のコンテナ
+        target (CosmosContainer): ユーザごとにパーティション分割した会話履歴のコンテナ
+        max_messages (int): ユーザごとに移行するメッセージ数の上限 (新しいものから)
+        dry_run (bool): True の場合は移行先に書き込まない
+
+    Returns:
+        dict: 移行したユーザ数、メッセージ数、会話の要約の数
+    """
+    store = PartitionedHistoryStore(target, max_messages=max_messages)
+    stats = {"users": 0, "messages": 0, "summaries": 0}
+
+    # 会話履歴を移行する
+    for user_id in source.query_items(USERS_QUERY):
+        params = [{"name": "@user_id", "value": user_id}, {"name": "@limit", "value": max_messages}]
+        items = expand_history_items(source.query_items(USER_MESSAGES_QUERY, params))[-max_messages:]
+        doc = {
+            "id": WINDOW_ITEM_ID,
+            "user_id": user_id,
+            "messages": [{"id": i["id"], "role": i["role"], "content": i["content"], "ts": i["_ts"]} for i in items],
+        }
+        if not dry_run:
+            target.upsert_item(doc)
+        stats["users"] += 1
+        stats["messages"] += len(items)
+        print(f"migrated: user_id={user_id}, messages={len(items)}")
+
+    # 会話の要約を移行する
+    for doc in source.query_items(SUMMARIES_QUERY):
+        doc = {key: value for key, value in doc.items() if not key.startswith("_")}
+        if not dry_run:
+            store.save_summary(doc["summary_of"], doc)
+        stats["summaries"] += 1
+
+    return stats
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="会話履歴を、ユーザごとにパーティション分割したコンテナへ移行する")
+    parser.add_argument("--source-container", default=os.getenv("COSMOS_CONTAINER_NAME"), help="移行元のコンテナ名")
+    parser.add_argument("--target-container", default=get_partitioned_container_name(), help="移行先のコンテナ名")
+    parser.add_argument("--max-messages", type=int, default=int(os.getenv("HISTORY_STORE_MAX_MESSAGES", 50)), help="ユーザごとに移行するメッセージ数の上限")
+    parser.add_argument("--dry-run", action="store_true", help="移行先に書き込まずに件数のみを確認する")
+    args = parser.parse_args()
+
+    source = CosmosContainer(container_name=args.source_container)
+    target = CosmosContainer(container_name=args.target_container, partition_key_path="/user_id")
+    stats = migrate(source, target, args.max_messages, dry_run=args.dry_run)
+    print(f"done: {stats}")
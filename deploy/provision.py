@@ -0,0 +1,54 @@
+"""
+Azure Cosmos DB のデータベースと会話履歴のコンテナを作成する (存在する場合は何もしない)
+STARTUP_MODE が eager 以外の場合、Web アプリケーションは起動時にこれらを作成しないため、デプロイ時に実行しておく
+--token-encoding を指定した場合は、tiktoken のエンコーディングのファイルを TIKTOKEN_CACHE_DIR にダウンロードしておく
+
+使い方 (リポジトリのルートディレクトリで実行する):
+    python deploy/provision.py [--all-stores] [--search-index] [--token-encoding]
+"""
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.cosmos import CosmosContainer
+from utils.history import get_partitioned_container_name
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Azure Cosmos DB のデータベースと会話履歴のコンテナを作成する")
+    parser.add_argument("--all-stores", action="store_true", help="HISTORY_STORE の設定に関わらず、両方の形式の会話履歴のコンテナを作成する")
+    parser.add_argument("--search-index", action="store_true", help="Azure AI Search のインデックスが存在しない場合に作成する (deploy/search_index.json を使用する)")
+    parser.add_argument("--token-encoding", action="store_true", help="tiktoken のエンコーディングのファイルを TIKTOKEN_CACHE_DIR にダウンロードしておく (起動時にダウンロードしない)")
+    args = parser.parse_args()
+
+    # 会話履歴のコンテナを作成する (messages: /id でパーティション分割, partitioned: /user_id でパーティション分割)
+    store = os.getenv("HISTORY_STORE", "messages")
+    if args.all_stores or store == "messages":
+        CosmosContainer()
+        print(f"provisioned: {os.getenv('COSMOS_DB_NAME')}/{os.getenv('COSMOS_CONTAINER_NAME')}")
+    if args.all_stores or store == "partitioned":
+        CosmosContainer(container_name=get_partitioned_container_name(), partition_key_path="/user_id")
+        print(f"provisioned: {os.getenv('COSMOS_DB_NAME')}/{get_partitioned_container_name()}")
+
+    # 検索インデックスを作成する
+    if args.search_index:
+        from utils.search import AzureSearchClient
+
+        client = AzureSearchClient(index_name=os.getenv("AI_SEARCH_INDEX_NAME"))
+        if client.check_index_exists():
+            print(f"search index already exists: {client.index_name}")
+        else:
+            client.create_index(os.path.join(os.path.dirname(__file__), "search_index.json"))
+            print(f"provisioned: search index {client.index_name}")
+
+    # トークン数を数えるエンコーディングのファイルをダウンロードしておく (キャッシュのディレクトリにある場合は何もしない)
+    if args.token_encoding:
+        import tiktoken
+        from utils.context import get_encoding_name
+
+        tiktoken.get_encoding(get_encoding_name())
+        print(f"provisioned: token encoding {get_encoding_name()} ({os.getenv('TIKTOKEN_CACHE_DIR') or 'default cache dir'})")
@@ -3,6 +3,8 @@ let avatarSynthesizer;
 let isSpeaking = false;
 let generatingAnswer = false;
 let enableMicrophone = true;
+let currentTurnId = null;
+let answerController = null;
 const speakTextQueue = [];
 
 let speechServiceToken;
@@ -14,11 +16,13 @@ const talkingAvatarStyle = "casual-sitting"
 const sttLocales = ["ja-JP"]
 const ttsVoice = "ja-JP-NanamiNeural";
 const speakRate = "50%";
+const enableBargeIn = true; // アバターが話している間に話しかけた場合、回答を中止して新しい質問に答える
+
+// 一時アクセストークンの有効期限が切れる前に取得し直す (残りの有効期間がこの時間(秒)になったら)
+const tokenRefreshMargin = 60;
 
 async function init() {
-    let resp = await (await fetch("/api/token")).json();
-    speechServiceToken = resp.token;
-    speechServiceRegion = resp.region;
+    await refreshToken();
 
     const iceServer = (await (await fetch("/api/turnServer")).json());
     iceServers.push(iceServer);
@@ -26,6 +30,22 @@ async function init() {
     document.getElementById("btnStart").disabled = false;
 }
 
+// Azure Speech Service の一時アクセストークンを取得し、接続中のアバターと音声認識にも設定する
+async function refreshToken() {
+    let expiresIn = tokenRefreshMargin * 2;
+    try {
+        const resp = await (await fetch("/api/token")).json();
+        speechServiceToken = resp.token;
+        speechServiceRegion = resp.region;
+        expiresIn = resp.expires_in ?? 600;
+        if (avatarSynthesizer) avatarSynthesizer.authorizationToken = speechServiceToken;
+        if (speechRecognizer) speechRecognizer.authorizationToken = speechServiceToken;
+    } catch (e) {
+        console.error("failed to refresh speech service token", e);
+    }
+    setTimeout(refreshToken, Math.max(expiresIn - tokenRefreshMargin, 10) * 1000);
+}
+
 async function connectAvatar() {
     document.getElementById("btnStart").disabled = true;
 
@@ -70,17 +90,18 @@ async function connectAvatar() {
     await startMicrophone();
 }
 
-function speak(text) {
+function speak(text, onStart) {
     if (!text) return;
     if (isSpeaking) {
-        speakTextQueue.push(text);
+        speakTextQueue.push({ text, onStart });
     } else {
-        speakNext(text);
+        speakNext({ text, onStart });
     }
 }
 
-async function speakNext(text) {
+async function speakNext({ text, onStart }) {
     isSpeaking = true;
+    if (onStart) onStart();
     const ssml = `<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='http://www.w3.org/2001/mstts' xml:lang='ja-JP'><voice name='${ttsVoice}'><prosody rate='${speakRate}'><mstts:ttsembedding><mstts:leadingsilence-exact value='0'/>${escapeHtml(text)}</mstts:ttsembedding></prosody></voice></speak>`;
     await avatarSynthesizer.speakSsmlAsync(ssml);
     if (speakTextQueue.length > 0) {
@@ -114,8 +135,11 @@ async function startMicrophone() {
         if (e.result.reason === SpeechSDK.ResultReason.RecognizedSpeech) {
             const recognized = e.result.text.trim()
             if (!enableMicrophone) return; // マイクが無効化されている場合は無視する
-            if (isSpeaking || generatingAnswer) return; // アバターが話している間は無視する
             if (!recognized) return;
+            if (isSpeaking || generatingAnswer) {
+                if (!enableBargeIn) return; // アバターが話している間は無視する
+                await interrupt();
+            }
             getResponse(recognized)
             speak("はい。少々お待ちください。")
         }
@@ -137,55 +161,120 @@ function toggleMic() {
     }
 }
 
+async function interrupt() {
+
+    // 読み上げを止め、受信中の回答のストリームを切断する
+    speakTextQueue.length = 0;
+    avatarSynthesizer.stopSpeakingAsync();
+    if (answerController) answerController.abort();
+
+    // サーバ側でも回答の生成 (ツール呼び出しを含む) を中止する
+    if (currentTurnId) {
+        await fetch("/api/completion/cancel", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ turn_id: currentTurnId }),
+        });
+        currentTurnId = null;
+    }
+}
+
 async function getResponse(message) {
+    try {
+        await readResponse(message);
+    } catch (e) {
+        if (e.name !== "AbortError") throw e; // 話しかけられて中止した場合は何もしない
+    }
+}
+
+async function readResponse(message) {
 
     // Web API 経由で Azure OpenAI Service からメッセージの返信を取得する
+    // stream_version: 3 を指定すると、読み上げる単位に区切られたフレーズが SSE 形式の phrase イベントで返ってくる
     generatingAnswer = true;
-    const resp = await fetch(`/api/completion`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ message }),
-    });
-    generatingAnswer = false;
+    const timing = { requestedAt: performance.now() };
+    const controller = new AbortController();
+    answerController = controller;
+    let resp;
+    try {
+        resp = await fetch(`/api/completion`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ message, stream_version: 3 }),
+            signal: controller.signal,
+        });
+    } finally {
+        generatingAnswer = false;
+    }
+    currentTurnId = resp.headers.get("X-Turn-Id");
+
+    // 混雑中で回答の生成が受け付けられなかった場合は、時間をおいて話しかけるよう伝える
+    if (resp.status === 429) {
+        speak("ただいま混み合っています。少し時間をおいてお話しください。");
+        return;
+    }
 
-    // ストリーム形式で返ってくる Completion を逐次読み取る
+    // ストリーム形式で返ってくるイベントを逐次読み取る
     const reader = resp.body.getReader();
-    let queuedText = "";
-    let lastContent = "";
+    const decoder = new TextDecoder("utf-8");
+    let buffer = "";
     while (true) {
         const { done, value } = await reader.read();
-        const text = new TextDecoder("utf-8").decode(value);
-        const jsonVal = text.split("\n").filter(s => s).pop(); // 複数行のJSONが返ってくる場合があるので最後の行を取得
-        if (!jsonVal) break;
-
-        // 句読点等で分割し、逐次読み上げる処理をする
-        try {
-            const result = JSON.parse(jsonVal);
-            let content = result.content.replaceAll("\n", "");
-            lastContent = content;
-            content = content.replace(queuedText, "");
-            const phrases = this.splitSentence(content);
-            for (const phrase of phrases) {
-                speak(phrase);
-                queuedText += phrase;
+        if (done) break;
+
+        // イベントは空行で区切られるため、区切りまで読み取れたイベントのみを処理する
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split("\n\n");
+        buffer = frames.pop();
+        for (const frame of frames) {
+            const event = parseEvent(frame);
+            if (!event) continue;
+
+            // サーバで句読点等で区切られたフレーズを、受け取った順に読み上げる
+            if (event.type === "phrase") {
+                timing.firstPhrase ??= performance.now() - timing.requestedAt;
+                speak(event.data.text, () => {
+                    timing.speechStart ??= performance.now() - timing.requestedAt;
+                    reportTiming(timing);
+                });
+            }
+
+            // サーバでの段階ごとの所要時間 (ストリームの最後に返ってくる)
+            if (event.type === "timing") {
+                timing.server = event.data;
+                reportTiming(timing);
             }
-        } catch { } // JSONパースに失敗した場合は無視する(入力途中はあり得る)
+        }
+    }
+    if (answerController === controller) {
+        answerController = null;
+        currentTurnId = null;
     }
-    // 最後の文章(区切り)を読み上げる
-    const phrase = lastContent.replace(queuedText, "");
-    if (phrase)
-        speak(phrase);
 }
 
-function splitSentence(s) {
-    // 句読点のリスト
-    const speakTextSplitChars = ['.', '?', '!', ':', ';', '。', '？', '！', '：', '；'];
-
-    // 句読点を正規表現の形式に変換し、キャプチャグループを追加
-    const splitCharsRegex = new RegExp(`([^${speakTextSplitChars.join('')}]+[${speakTextSplitChars.join('')}])`, 'g');
+function reportTiming(timing) {
+    // サーバでの段階ごとの所要時間と、最初のフレーズを受信・読み上げ開始した時刻 (リクエストからの経過ミリ秒) を出力する
+    // (trace_id で Application Insights のトレースと突き合わせる)
+    if (timing.reported || !timing.server || timing.speechStart === undefined) return;
+    timing.reported = true;
+    console.info("answer timing", {
+        trace_id: timing.server.trace_id,
+        first_phrase: Math.round(timing.firstPhrase),
+        speech_start: Math.round(timing.speechStart),
+        server: timing.server,
+    });
+}
 
-    // 文字列を分割し、空白をトリム
-    return s.match(splitCharsRegex).map(str => str.trim());
+function parseEvent(frame) {
+    // SSE のフレームからイベント名とデータを取得する
+    let type = "message";
+    let data = "";
+    for (const line of frame.split("\n")) {
+        if (line.startsWith("event:")) type = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+    }
+    if (!data) return null;
+    return { type, data: JSON.parse(data) };
 }
 
 
@@ -0,0 +1,348 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from opentelemetry import metrics
+from utils.cache import LRUCache
+from utils.logger import logger
+
+# 受付を拒否した理由
+REJECT_RATE_LIMITED = "rate_limited"  # ユーザのリクエストの頻度が上限を超えた
+REJECT_USER_BUSY = "user_busy"  # ユーザの回答の生成中 (または待機中) のリクエストが上限に達している
+REJECT_QUEUE_FULL = "queue_full"  # 待機中のリクエストが上限に達している
+REJECT_TIMEOUT = "timeout"  # 待機時間の上限までに受け付けられなかった
+REJECT_CANCELLED = "cancelled"  # 待機中にターンが中止された (ユーザが新しく話しかけた場合等)
+
+
+class AdmissionRejected(Exception):
+    """
+    回答の生成の受付を拒否した場合の例外
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionConfig:
+    """
+    回答の生成の受付制御の設定 (環境変数から取得する)
+    """
+
+    def __init__(self):
+        self.max_concurrency = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 16))
+        self.max_queue = int(os.environ.get("ADMISSION_MAX_QUEUE", 32))
+        self.queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 5))
+        self.user_max_concurrency = int(os.environ.get("ADMISSION_USER_MAX_CONCURRENCY", 1))
+        self.user_rate = float(os.environ.get("ADMISSION_USER_RATE", 0.5))
+        self.user_burst = float(os.environ.get("ADMISSION_USER_BURST", 3))
+
+
+class TokenBucket:
+    """
+    ユーザごとのリクエストの頻度を制限するトークンバケット
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def check(self) -> float:
+        """
+        トークンを取り出せるか確認する (取り出さない)
+
+        Returns:
+            float: 取り出せる場合は 0、取り出せない場合は次に取り出せるまでの時間(秒)
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self):
+        """
+        トークンを1つ取り出す (受け付けた時点で取り出すため、確認した後に他のリクエストが取り出していた場合は負になる)
+        """
+        self.check()
+        self.tokens -= 1
+
+
+class AdmissionController:
+    """
+    回答の生成 (/api/completion のストリーム) の同時実行数を制御する
+    - 全体の同時実行数の上限を超えた分は、待機列に入れて上限の時間だけ待つ
+    - 待機列はユーザごとに分け、ユーザを順番に巡回して受け付ける (一部のユーザが大量にリクエストしても、他のユーザが待たされない)
+    - ユーザごとの頻度 (トークンバケット) と同時実行数の上限、待機列の長さの上限を超えた場合は、待たずにすぐに拒否する
+    - トークンバケットのトークンは、受け付けた時点で消費する (拒否したリクエストや待機中に中止されたリクエストは消費しない)
+    - 中止されたターン (ユーザが新しく話しかけた場合) はユーザごとの同時実行数に数えず、そのターンが実行中であれば、新しいターンが実行枠を引き継ぐ
+      (中止されたターンがストリームを閉じるまでの間は、全体の同時実行数の上限をユーザごとに最大1つ超える)
+    """
+
+    def __init__(self, config: AdmissionConfig = None):
+        self.config = config or AdmissionConfig()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.user_turns = {}  # ユーザID -> 実行中と待機中のリクエストのターンのトークン (CancelToken) のリスト
+        self.handed_over = set()  # 新しいターンに実行枠を引き継いだ、中止されたターンのトークン
+        self.queues = OrderedDict()  # ユーザID -> 待機中のリクエスト (待機用のオブジェクトとトークンの組) の deque (巡回順)
+        self.queued = 0
+        self.buckets = LRUCache(maxsize=10000, ttl=max(self.config.user_burst / self.config.user_rate, 60) if self.config.user_rate > 0 else None)
+        self.stats = {"admitted": 0, "rejected": {}, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+        self._register_metrics()
+
+    def acquire(self, user_id: str, cancel_token=None) -> float:
+        """
+        回答の生成を開始してよいか確認し、必要であれば受け付けられるまで待つ
+        待機中にターンが中止された場合は、待機をやめてすぐに拒否する
+
+        Args:
+            user_id (str): ユーザID
+            cancel_token (CancelToken): ターンのトークン
+
+        Returns:
+            float: 待機した時間(秒)
+
+        Raises:
+            AdmissionRejected: 受付を拒否した場合
+        """
+        started_at = time.monotonic()
+        waiter = self._enter(user_id, cancel_token, threading.Event)
+        if waiter is not None:
+            if cancel_token is not None:
+                cancel_token.cancelled_future.add_done_callback(lambda _: waiter.set())
+            waiter.wait(self.config.queue_timeout)
+            self._finish_wait(user_id, waiter, cancel_token)
+        return self._admitted(started_at)
+
+    def release(self, user_id: str, cancel_token=None):
+        """
+        回答の生成が終わったことを記録し、待機中のリクエストがあれば次のリクエストを受け付ける
+        (実行枠を新しいターンに引き継いでいた場合は何もしない)
+
+        Args:
+            user_id (str): ユーザID
+            cancel_token (CancelToken): acquire に渡したターンのトークン
+        """
+        with self.lock:
+            if cancel_token in self.handed_over:
+                self.handed_over.discard(cancel_token)
+                return
+            self.active -= 1
+            self._remove_user_turn(user_id, cancel_token)
+            waiter = self._pop_next_waiter()
+        if waiter is not None:
+            self._wake(waiter)
+
+    def get_metrics(self) -> dict:
+        """
+        受付制御の状態と統計情報を取得する
+
+        Returns:
+            dict: 実行中・待機中のリクエスト数、受付・拒否した数、待機時間
+        """
+        with self.lock:
+            admitted = self.stats["admitted"]
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "max_concurrency": self.config.max_concurrency,
+                "max_queue": self.config.max_queue,
+                "admitted": admitted,
+                "rejected": dict(self.stats["rejected"]),
+                "wait_ms_avg": round(self.stats["wait_seconds_total"] / admitted * 1000, 1) if admitted else 0.0,
+                "wait_ms_max": round(self.stats["wait_seconds_max"] * 1000, 1),
+            }
+
+    def _enter(self, user_id: str, cancel_token, new_waiter):
+        """
+        リクエストを受け付けるか、待機列に入れるか、拒否するかを判定する
+
+        Returns:
+            すぐに受け付けた場合は None、待機列に入れた場合は待機用のオブジェクト
+        """
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.config.user_rate, self.config.user_burst)
+                self.buckets.set(user_id, bucket)
+            retry_after = bucket.check()
+            if retry_after > 0:
+                self._reject(REJECT_RATE_LIMITED, retry_after)
+            turns = self.user_turns.get(user_id, [])
+            if sum(1 for t in turns if not _is_cancelled(t)) >= self.config.user_max_concurrency:
+                self._reject(REJECT_USER_BUSY, 1.0)
+
+            # 中止されたターンが実行中であれば、その実行枠を引き継いですぐに受け付ける
+            superseded = next((t for t in turns if _is_cancelled(t) and self._is_running(user_id, t)), None)
+            if superseded is not None:
+                turns[turns.index(superseded)] = cancel_token
+                self.handed_over.add(superseded)
+                bucket.take()
+                return None
+
+            # 実行数に空きがあり、待機中のリクエストがなければすぐに受け付ける
+            if self.active < self.config.max_concurrency and self.queued == 0:
+                self.active += 1
+                self.user_turns[user_id] = turns + [cancel_token]
+                bucket.take()
+                return None
+            if self.queued >= self.config.max_queue:
+                self._reject(REJECT_QUEUE_FULL, self.config.queue_timeout)
+
+            waiter = new_waiter()
+            self.queues.setdefault(user_id, deque()).append((waiter, cancel_token))
+            self.queued += 1
+            self.user_turns[user_id] = turns + [cancel_token]
+            return waiter
+
+    def _leave_queue(self, user_id: str, waiter, cancel_token, reject: bool = True) -> bool:
+        """
+        待機時間の上限を超えた (または中止された) リクエストを待機列から取り除く
+
+        Returns:
+            bool: 取り除いた場合は True (直前に受け付けられていた場合は False)
+        """
+        with self.lock:
+            queue = self.queues.get(user_id)
+            entry = (waiter, cancel_token)
+            if queue is None or entry not in queue:
+                return False
+            queue.remove(entry)
+            if not queue:
+                del self.queues[user_id]
+            self.queued -= 1
+            self._remove_user_turn(user_id, cancel_token)
+            if reject:
+                if _is_cancelled(cancel_token):
+                    self._reject(REJECT_CANCELLED, 0)
+                self._reject(REJECT_TIMEOUT, self.config.queue_timeout)
+            return True
+
+    def _finish_wait(self, user_id: str, waiter, cancel_token):
+        """
+        待機を終えたリクエストが受け付けられていなければ、待機列から取り除いて拒否する
+        受け付けられていても、その時点でターンが中止されていれば、実行枠を解放して拒否する
+        """
+        self._leave_queue(user_id, waiter, cancel_token)
+        if _is_cancelled(cancel_token):
+            self.release(user_id, cancel_token)
+            with self.lock:
+                self._reject(REJECT_CANCELLED, 0)
+
+    def _pop_next_waiter(self):
+        """
+        待機列の先頭のユーザから次のリクエストを取り出して受け付ける (取り出したユーザは巡回順の末尾に回す)
+        """
+        if not self.queues or self.active >= self.config.max_concurrency:
+            return None
+        user_id, queue = next(iter(self.queues.items()))
+        waiter, _ = queue.popleft()
+        del self.queues[user_id]
+        if queue:
+            self.queues[user_id] = queue
+        self.queued -= 1
+        self.active += 1
+        bucket = self.buckets.get(user_id)
+        if bucket is not None:
+            bucket.take()
+        return waiter
+
+    def _is_running(self, user_id: str, cancel_token) -> bool:
+        # ロックを取得した状態で呼び出す
+        return all(token is not cancel_token for _, token in self.queues.get(user_id, ()))
+
+    def _wake(self, waiter):
+        waiter.set()
+
+    def _admitted(self, started_at: float) -> float:
+        wait_seconds = time.monotonic() - started_at
+        with self.lock:
+            self.stats["admitted"] += 1
+            self.stats["wait_seconds_total"] += wait_seconds
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], wait_seconds)
+        self.wait_histogram.record(wait_seconds * 1000)
+        return wait_seconds
+
+    def _reject(self, reason: str, retry_after: float):
+        # ロックを取得した状態で呼び出す
+        self.stats["rejected"][reason] = self.stats["rejected"].get(reason, 0) + 1
+        self.rejected_counter.add(1, {"reason": reason})
+        logger.warning(f"completion rejected: reason={reason}, active={self.active}, queued={self.queued}")
+        raise AdmissionRejected(reason, retry_after)
+
+    def _remove_user_turn(self, user_id: str, cancel_token):
+        # ロックを取得した状態で呼び出す
+        turns = self.user_turns.get(user_id, [])
+        if cancel_token in turns:
+            turns.remove(cancel_token)
+        if not turns:
+            self.user_turns.pop(user_id, None)
+
+    def _register_metrics(self):
+        """
+        OpenTelemetry のメトリクスとして、実行中・待機中のリクエスト数と待機時間を記録する
+        """
+        meter = metrics.get_meter(__name__)
+        meter.create_observable_gauge("admission.active", callbacks=[lambda _: [metrics.Observation(self.active)]])
+        meter.create_observable_gauge("admission.queue_depth", callbacks=[lambda _: [metrics.Observation(self.queued)]])
+        self.wait_histogram = meter.create_histogram("admission.wait_time", unit="ms")
+        self.rejected_counter = meter.create_counter("admission.rejected")
+
+
+class AsyncAdmissionController(AdmissionController):
+    """
+    AdmissionController の非同期版 (待機はイベントループ上の Future で行う)
+    """
+
+    async def acquire(self, user_id: str, cancel_token=None) -> float:
+        """
+        回答の生成を開始してよいか確認し、必要であれば受け付けられるまで待つ (非同期版)
+        待機中にターンが中止された場合は、待機をやめてすぐに拒否する
+
+        Args:
+            user_id (str): ユーザID
+            cancel_token (CancelToken): ターンのトークン
+
+        Returns:
+            float: 待機した時間(秒)
+
+        Raises:
+            AdmissionRejected: 受付を拒否した場合
+        """
+        started_at = time.monotonic()
+        waiter = self._enter(user_id, cancel_token, asyncio.get_running_loop().create_future)
+        if waiter is not None:
+            try:
+                await self._wait(waiter, cancel_token)
+            except asyncio.CancelledError:
+                # 待機中にクライアントが切断した場合は、待機列から取り除く (直前に受け付けられていた場合は解放する)
+                if not self._leave_queue(user_id, waiter, cancel_token, reject=False):
+                    self.release(user_id, cancel_token)
+                raise
+            self._finish_wait(user_id, waiter, cancel_token)
+        return self._admitted(started_at)
+
+    async def _wait(self, waiter: asyncio.Future, cancel_token):
+        """
+        受け付けられるか、ターンが中止されるか、待機時間の上限を超えるまで待つ (待機用の Future はキャンセルしない)
+        """
+        cancelled = asyncio.ensure_future(cancel_token.wait_cancelled_async()) if cancel_token is not None else None
+        try:
+            await asyncio.wait([f for f in (waiter, cancelled) if f is not None], timeout=self.config.queue_timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if cancelled is not None:
+                cancelled.cancel()
+
+    def _wake(self, waiter):
+        if not waiter.done():
+            waiter.set_result(True)
+
+
+def _is_cancelled(cancel_token) -> bool:
+    return cancel_token is not None and cancel_token.cancelled
@@ -0,0 +1,236 @@
+import os
+import re
+import time
+import threading
+import numpy as np
+from datetime import datetime
+from utils.logger import logger
+
+# キャッシュした回答を再生する際に、チャンクに区切る位置 (句読点や改行の直後)
+REPLAY_SPLIT_PATTERN = re.compile(r"(?<=[。！？!?\n])")
+
+# 現在の時刻そのものを尋ねる質問 (例: 「今何時？」) はキャッシュしない (回答の時刻が、再生する時点では古くなっているため)
+CLOCK_TIME_PATTERN = re.compile(r"(今何時|何時何分|現在時刻|今の時刻|時刻を|\bwhat time\b|\btime is it\b)", re.IGNORECASE)
+
+# 現在の日付に依存する質問と回答 (例: 「今日の天気は？」、回答に含まれる日付や時刻)
+# キャッシュするが、有効期限を日付が変わる時刻と、有効期限の長さで区切った時間帯の終わりまでに短くする (_get_window_ttl を参照)
+TIME_DEPENDENT_PATTERN = re.compile(
+    r"(今日|本日|明日|明後日|昨日|今朝|今夜|今晩|今週|来週|先週|今月|来月|先月|今年|来年|去年|現在|何日|何曜|曜日"
+    r"|\b(today|tomorrow|yesterday|tonight|now|this (week|month|year))\b"
+    r"|\d{1,2}\s*[:：時]\s*\d{1,2}|\d{1,2}\s*月\s*\d{1,2}\s*日|\d{4}\s*[/年-]\s*\d{1,2})",
+    re.IGNORECASE,
+)
+
+# 前の会話に依存する質問 (例: 「それは何？」「もっと詳しく」「大阪は？」)
+# 指示語や、前の会話を受ける接続詞で始まる質問と、名詞だけを主題にした短い質問が対象
+CONTEXT_DEPENDENT_PATTERN = re.compile(
+    r"(それ|その|そこ|そちら|これ|この|ここ|こちら|あれ|あの|あそこ|さっき|先ほど|先程|前の|上の|続き|同じ|もう一度|もう少し|もっと|他に|ほかに|他の|ほかの|詳しく"
+    r"|\b(it|its|that|this|these|those|them|they|again|more|else)\b"
+    r"|^\s*(じゃあ|ちなみに|ところで)|^\s*(で|じゃ|では|あと)[、,\s]"
+    r"|^\s*[^\sのをにがでと、,]{1,8}[はも]\s*[？?]?\s*$)",
+    re.IGNORECASE,
+)
+
+
+class SemanticAnswerCache:
+    """
+    ユーザのメッセージの埋め込みベクトルの類似度で、過去の回答を再利用するキャッシュ
+    言い換えの質問 (例: 「今日の天気は？」と「今日の東京の天気を教えて」) に対して、ツール呼び出しと回答の生成を省略する
+    回答の有効期限は、回答の生成に使用したツールごとに設定できる (例: 天気の回答は1時間で期限切れにする)
+    現在の日付に依存する回答は、有効期限の長さで区切った時間帯 (例: 毎時0分から1時間) の終わりに、一斉に期限切れにする
+    キャッシュはすべてのユーザで共有するため、前の会話に依存しない質問のみを対象にする (is_cacheable_turn を参照)
+    """
+
+    def __init__(self, maxsize: int = None, threshold: float = None, ttl: float = None, tool_ttls: dict[str, float] = None):
+        self.maxsize = maxsize or int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+        self.threshold = threshold or float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+        self.ttl = ttl if ttl is not None else float(os.getenv("ANSWER_CACHE_TTL", 3600))
+
+        # ツールごとの回答の有効期限(秒) (例: ANSWER_CACHE_TOOL_TTLS="get_weather=3600,search_news=0")
+        # 0 を指定したツールを使用した回答はキャッシュしない
+        if tool_ttls is None:
+            tool_ttls = [t.split("=") for t in os.getenv("ANSWER_CACHE_TOOL_TTLS", "").split(",") if "=" in t]
+            tool_ttls = {name.strip(): float(value) for name, value in tool_ttls}
+        self.tool_ttls = tool_ttls
+
+        # 埋め込みベクトル (正規化済み) は行列にまとめて保持し、類似度を1回の行列積で計算する
+        self.vectors = None
+        self.expires_at = np.full(self.maxsize, -np.inf)
+        self.answers = [None] * self.maxsize
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def find(self, vector: list[float]) -> str | None:
+        """
+        類似度がしきい値以上で、有効期限内の回答を検索する
+
+        Args:
+            vector (list[float]): ユーザのメッセージの埋め込みベクトル
+
+        Returns:
+            str | None: キャッシュされた回答 (見つからない場合は None)
+        """
+        if vector is None or self.vectors is None:
+            return None
+        query = normalize_vector(vector)
+        with self.lock:
+            if self.count == 0:
+                return None
+            similarities = self.vectors[: self.count] @ query
+            similarities[self.expires_at[: self.count] < time.monotonic()] = -np.inf
+            index = int(np.argmax(similarities))
+            if similarities[index] < self.threshold:
+                return None
+            logger.info(f"answer cache hit: similarity={similarities[index]:.3f}")
+            return self.answers[index]
+
+    def add(self, vector: list[float], answer: str, tool_names: list[str] = None, time_dependent: bool = False):
+        """
+        回答をキャッシュに追加する (件数の上限を超える場合は、有効期限が最も近い回答を置き換える)
+
+        Args:
+            vector (list[float]): ユーザのメッセージの埋め込みベクトル
+            answer (str): 回答
+            tool_names (list[str]): 回答の生成に使用したツール名
+            time_dependent (bool): 質問が現在の日付に依存するか (回答に日付や時刻が含まれる場合も、依存するものとして扱う)
+        """
+        ttl = self.get_ttl(tool_names or [])
+        if vector is None or not answer or ttl <= 0:
+            return
+        if time_dependent or TIME_DEPENDENT_PATTERN.search(answer):
+            ttl = _get_window_ttl(ttl)
+        vector = normalize_vector(vector)
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+            if self.count < self.maxsize:
+                index = self.count
+                self.count += 1
+            else:
+                index = int(np.argmin(self.expires_at))
+            self.vectors[index] = vector
+            self.expires_at[index] = time.monotonic() + ttl
+            self.answers[index] = answer
+
+    def get_ttl(self, tool_names: list[str]) -> float:
+        """
+        回答の有効期限を取得する (使用したツールの有効期限のうち、最も短いもの)
+
+        Args:
+            tool_names (list[str]): 回答の生成に使用したツール名
+
+        Returns:
+            float: 有効期限(秒)
+        """
+        return min([self.ttl] + [self.tool_ttls.get(name, self.ttl) for name in tool_names])
+
+    def record(self, chunks, vector: list[float], message: str, messages: list[dict]):
+        """
+        回答のチャンクをそのまま返しながら、回答が完了したらキャッシュに追加する
+
+        Args:
+            chunks: Azure OpenAI Service から返されるチャンク
+            vector (list[float]): ユーザのメッセージの埋め込みベクトル
+            message (str): ユーザからのメッセージ
+            messages (list[dict]): Chat Completion API へ送信したメッセージ (ツール呼び出しのループで追加される)
+        """
+        turn_start = len(messages)
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        answer = "".join(c for c in parts if c and c != "[DONE]")
+        self.add(vector, answer, get_tool_names(messages[turn_start:]), bool(TIME_DEPENDENT_PATTERN.search(message)))
+
+    async def record_async(self, chunks, vector: list[float], message: str, messages: list[dict]):
+        """
+        record の非同期版
+        """
+        turn_start = len(messages)
+        parts = []
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        answer = "".join(c for c in parts if c and c != "[DONE]")
+        self.add(vector, answer, get_tool_names(messages[turn_start:]), bool(TIME_DEPENDENT_PATTERN.search(message)))
+
+
+def is_cacheable_turn(message: str) -> bool:
+    """
+    回答をキャッシュから検索し、生成した回答をキャッシュに追加できるターンか判定する
+    会話履歴の有無ではなく、メッセージそのものから判定する (会話履歴のあるユーザでも、よくある質問はキャッシュを使用する)
+    - 前の会話に依存する質問は対象外 (例: 「それは何？」。回答が前の会話に依存し、他のユーザに再生すると会話の内容が漏れるため)
+    - 現在の時刻そのものを尋ねる質問は対象外 (現在の日付に依存する質問は、有効期限を短くしてキャッシュする)
+    対象外のターンでは埋め込みベクトルを生成しないため、回答の生成までの時間も増えない
+
+    Args:
+        message (str): ユーザからのメッセージ
+
+    Returns:
+        bool: キャッシュを使用できる場合は True
+    """
+    return not CONTEXT_DEPENDENT_PATTERN.search(message) and not CLOCK_TIME_PATTERN.search(message)
+
+
+def replay_answer(answer: str):
+    """
+    キャッシュした回答を、Azure OpenAI Service から返されるチャンクと同じように文単位で返す
+
+    Args:
+        answer (str): キャッシュした回答
+    """
+    for part in REPLAY_SPLIT_PATTERN.split(answer):
+        if part:
+            yield part
+
+
+async def replay_answer_async(answer: str):
+    """
+    replay_answer の非同期版
+    """
+    for part in replay_answer(answer):
+        yield part
+
+
+def get_tool_names(tool_messages: list[dict]) -> list[str]:
+    """
+    ツール呼び出しのループで追加されたメッセージから、呼び出したツール名を取得する
+    """
+    return [call["function"]["name"] for m in tool_messages for call in m.get("tool_calls") or []]
+
+
+def _get_window_ttl(ttl: float) -> float:
+    """
+    現在の日付に依存する回答の有効期限を、有効期限の長さで区切った時間帯の終わりまでに短くする
+    時間帯は (ローカル時刻の) 0時から区切るため、日付が変わる時刻をまたがない
+
+    Args:
+        ttl (float): 有効期限(秒)
+
+    Returns:
+        float: 現在の時間帯の終わりまでの秒数
+    """
+    now = datetime.now()
+    elapsed = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+    return min(ttl - elapsed % ttl, 24 * 60 * 60 - elapsed)
+
+
+def normalize_vector(vector: list[float]) -> np.ndarray:
+    """
+    ベクトルを長さ1に正規化する (内積がコサイン類似度になるようにする)
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def create_answer_cache() -> SemanticAnswerCache | None:
+    """
+    環境変数の設定に従って、回答のキャッシュを生成する (ANSWER_CACHE_ENABLED が true でない場合は None)
+
+    Returns:
+        SemanticAnswerCache | None: 回答のキャッシュ
+    """
+    if os.getenv("ANSWER_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    return SemanticAnswerCache()
@@ -1,6 +1,10 @@
 import os
 import requests
 from enum import Enum
+from utils.cache import LRUCache, SingleFlight, MISSING
+
+# Bing Search API のエンドポイント
+BING_SEARCH_ENDPOINT = "https://api.bing.microsoft.com/v7.0"
 
 
 # Bing Search API で検索するニュースカテゴリ
@@ -17,9 +21,17 @@ class BingSearchNewsCategory(Enum):
 
 class BingSearchClient:
 
-    def __init__(self):
+    def __init__(self, session: requests.Session = None):
         self.api_key = os.environ.get("BING_SEARCH_API_KEY")
 
+        # 接続を再利用するための HTTP セッション
+        self.session = session or requests.Session()
+        self.session.headers.update({"Ocp-Apim-Subscription-Key": self.api_key or ""})
+
+        # 同じ条件の検索結果は有効期限 (TTL) まで再利用し、同時に同じ条件で検索された場合は1回のリクエストにまとめる
+        self.cache = LRUCache(maxsize=int(os.environ.get("BING_CACHE_SIZE", 256)), ttl=float(os.environ.get("BING_CACHE_TTL", 300)))
+        self.single_flight = SingleFlight()
+
     def search_web_pages(self, query: str, mkt: str = "ja-JP", count: int = 10, offset: int = 0) -> list[dict]:
         """
         Bing Web Search API を利用して、指定されたクエリに一致するWebページを検索する。
@@ -34,10 +46,7 @@ class BingSearchClient:
             list[dict]: 検索結果のリスト
         """
         params = {"q": query, "mkt": mkt, "count": count, "offset": offset, "sortby": "date"}
-        headers = {"Ocp-Apim-Subscription-Key": self.api_key}
-        resp = requests.get(f"https://api.bing.microsoft.com/v7.0/search", params=params, headers=headers)
-        resp.raise_for_status()
-        resp = resp.json()
+        resp = self._get("/search", params)
         return resp["webPages"]["value"] if "webPages" in resp else []
 
     def search_news(
@@ -64,10 +73,7 @@ class BingSearchClient:
             list[dict]: 検索結果のリスト
         """
         params = {"q": query, "mkt": mkt, "count": count, "offset": offset, "sortby": sortby, "freshness": freshness}
-        headers = {"Ocp-Apim-Subscription-Key": self.api_key}
-        resp = requests.get(f"https://api.bing.microsoft.com/v7.0//news/search", params=params, headers=headers)
-        resp.raise_for_status()
-        return resp.json()["value"]
+        return self._get("/news/search", params)["value"]
 
     def search_news_by_category(
         self,
@@ -93,7 +99,28 @@ class BingSearchClient:
             list[dict]: 検索結果のリスト
         """
         params = {"category": category.value, "mkt": mkt, "count": count, "offset": offset, "sortby": sortby, "freshness": freshness}
-        headers = {"Ocp-Apim-Subscription-Key": self.api_key}
-        resp = requests.get(f"https://api.bing.microsoft.com/v7.0/news", params=params, headers=headers)
+        return self._get("/news", params)["value"]
+
+    def _get(self, path: str, params: dict) -> dict:
+        """
+        Bing Search API を呼び出す (同じパスとパラメータの結果はキャッシュから返す)
+
+        Args:
+            path (str): API のパス
+            params (dict): クエリパラメータ
+
+        Returns:
+            dict: レスポンスの JSON
+        """
+        key = (path, tuple(sorted(params.items())))
+        result = self.cache.get(key, MISSING)
+        if result is not MISSING:
+            return result
+        return self.single_flight.do(key, lambda: self._fetch(key, path, params))
+
+    def _fetch(self, key: tuple, path: str, params: dict) -> dict:
+        resp = self.session.get(f"{BING_SEARCH_ENDPOINT}{path}", params=params, timeout=10)
         resp.raise_for_status()
-        return resp.json()["value"]
+        result = resp.json()
+        self.cache.set(key, result)
+        return result
@@ -0,0 +1,152 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict
+
+# キャッシュに存在しないことを表す値
+MISSING = object()
+
+
+class LRUCache:
+    """
+    件数の上限と有効期限 (TTL) を持つ、スレッドセーフな LRU キャッシュ
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        キャッシュから値を取得する (有効期限が切れている場合は削除して default を返す)
+
+        Args:
+            key: キー
+            default: キャッシュに存在しない場合に返す値
+
+        Returns:
+            キャッシュされた値
+        """
+        with self.lock:
+            item = self.items.get(key, MISSING)
+            if item is MISSING:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        キャッシュに値を格納する (件数の上限を超えた場合は、最も長く使われていない値を削除する)
+
+        Args:
+            key: キー
+            value: 値
+            ttl (float): 有効期限(秒) (省略した場合はキャッシュ全体の有効期限を使用する)
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.items[key] = (value, expires_at)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        キャッシュから値を削除する
+
+        Args:
+            key: キー
+            default: キャッシュに存在しない場合に返す値
+
+        Returns:
+            削除した値
+        """
+        with self.lock:
+            item = self.items.pop(key, MISSING)
+            return default if item is MISSING else item[0]
+
+    def clear(self):
+        """
+        キャッシュをすべて削除する
+        """
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class SingleFlight:
+    """
+    同じキーに対する同時の呼び出しを1回にまとめる (最初の呼び出しの結果を、待っていた呼び出し元にも返す)
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        キーに対する呼び出しが実行中であればその結果を待ち、そうでなければ func を実行する
+
+        Args:
+            key: キー
+            func: 実行する関数 (引数なし)
+
+        Returns:
+            func の戻り値
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+
+        try:
+            result = func()
+            call.set_result(result)
+            return result
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight の非同期版
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func):
+        """
+        キーに対する呼び出しが実行中であればその結果を待ち、そうでなければ func を実行する
+
+        Args:
+            key: キー
+            func: 実行するコルーチン関数 (引数なし)
+
+        Returns:
+            func の戻り値
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+
+        # 呼び出し元がキャンセルされても、他の呼び出し元が待っている処理は継続する
+        return await asyncio.shield(task)
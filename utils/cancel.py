@@ -0,0 +1,179 @@
+import os
+import uuid
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# 回答の生成を中止した理由
+CANCEL_BARGE_IN = "barge_in"  # ユーザが新しく話しかけた
+CANCEL_REQUESTED = "requested"  # クライアントから中止のリクエストがあった
+
+
+class GenerationCancelled(Exception):
+    """
+    回答の生成が中止された場合の例外
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    1ターン分の回答の生成を中止するためのトークン
+    中止された場合と、生成が終わった (ストリームを閉じた) 場合をそれぞれ Future で通知する
+    """
+
+    def __init__(self, turn_id: str = None):
+        self.turn_id = turn_id or uuid.uuid4().hex
+        self.reason = None
+        self.cancelled_future = Future()
+        self.finished_future = Future()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_future.done()
+
+    def cancel(self, reason: str) -> bool:
+        """
+        回答の生成を中止する
+
+        Args:
+            reason (str): 中止した理由
+
+        Returns:
+            bool: 中止した場合は True (既に中止または終了していた場合は False)
+        """
+        if self.cancelled or self.finished_future.done():
+            return False
+        self.reason = reason
+        self.cancelled_future.set_result(reason)
+        return True
+
+    def raise_if_cancelled(self):
+        """
+        中止されている場合は GenerationCancelled を送出する
+        """
+        if self.cancelled:
+            raise GenerationCancelled(self.reason)
+
+    def finish(self):
+        """
+        回答の生成が終わったことを通知する
+        """
+        if not self.finished_future.done():
+            self.finished_future.set_result(True)
+
+    async def wait_cancelled_async(self):
+        """
+        中止されるまで待つ (非同期版)
+        """
+        await _wait_future_async(self.cancelled_future)
+
+
+class TurnRegistry:
+    """
+    ユーザごとに回答を生成中のターンを管理する
+    新しいターンを開始した場合 (ユーザが回答の途中で話しかけた場合) は、生成中のターンを中止する
+    """
+
+    def __init__(self, wait_timeout: float = None):
+        self.wait_timeout = wait_timeout if wait_timeout is not None else float(os.environ.get("CANCEL_WAIT_TIMEOUT", 2))
+        self.turns = {}  # ユーザID -> CancelToken
+        self.lock = threading.Lock()
+
+    def start(self, user_id: str) -> CancelToken:
+        """
+        ユーザの新しいターンを開始する (生成中のターンがあれば中止し、ストリームを閉じるまで待つ)
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            CancelToken: 新しいターンのトークン
+        """
+        self.cancel(user_id, CANCEL_BARGE_IN)
+        return self._register(user_id)
+
+    def cancel(self, user_id: str, reason: str = CANCEL_REQUESTED, turn_id: str = None) -> bool:
+        """
+        ユーザの生成中のターンを中止し、ストリームを閉じるまで (上限の時間まで) 待つ
+
+        Args:
+            user_id (str): ユーザID
+            reason (str): 中止した理由
+            turn_id (str): 中止するターンのID (指定した場合は、生成中のターンと一致する場合のみ中止する)
+
+        Returns:
+            bool: 中止した場合は True
+        """
+        token = self._get(user_id, turn_id)
+        if token is None or not token.cancel(reason):
+            return False
+        try:
+            token.finished_future.result(timeout=self.wait_timeout)
+        except TimeoutError:
+            pass
+        return True
+
+    def finish(self, user_id: str, token: CancelToken):
+        """
+        ターンの回答の生成が終わったことを記録する
+
+        Args:
+            user_id (str): ユーザID
+            token (CancelToken): ターンのトークン
+        """
+        token.finish()
+        with self.lock:
+            if self.turns.get(user_id) is token:
+                del self.turns[user_id]
+
+    def _register(self, user_id: str) -> CancelToken:
+        token = CancelToken()
+        with self.lock:
+            self.turns[user_id] = token
+        return token
+
+    def _get(self, user_id: str, turn_id: str = None) -> CancelToken | None:
+        with self.lock:
+            token = self.turns.get(user_id)
+        if token is None or (turn_id and token.turn_id != turn_id):
+            return None
+        return token
+
+
+class AsyncTurnRegistry(TurnRegistry):
+    """
+    TurnRegistry の非同期版 (ストリームを閉じるまでの待機をイベントループ上で行う)
+    """
+
+    async def start(self, user_id: str) -> CancelToken:
+        await self.cancel(user_id, CANCEL_BARGE_IN)
+        return self._register(user_id)
+
+    async def cancel(self, user_id: str, reason: str = CANCEL_REQUESTED, turn_id: str = None) -> bool:
+        token = self._get(user_id, turn_id)
+        if token is None or not token.cancel(reason):
+            return False
+        try:
+            await asyncio.wait_for(_wait_future_async(token.finished_future), timeout=self.wait_timeout)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+
+async def _wait_future_async(future: Future):
+    """
+    concurrent.futures.Future の完了を待つ
+    (asyncio.wrap_future は待機側がキャンセルされると元の Future もキャンセルするため使用しない)
+    """
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def wake(_):
+        loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+    future.add_done_callback(wake)
+    await waiter
@@ -0,0 +1,153 @@
+import json
+import uuid
+import base64
+from datetime import datetime
+
+# 会話履歴を取得するクエリ
+HISTORY_QUERY = "SELECT * FROM c WHERE c.user_id = @user_id ORDER BY c._ts DESC OFFSET 0 LIMIT @limit"
+
+# プリンシパルが設定されていない場合のユーザID
+ANONYMOUS_USER_ID = "00000000-0000-0000-0000-000000000000"
+
+
+# プロンプトの構成
+# prefix_stable: 固定の指示のみをシステムメッセージとし、現在時刻等の変化する情報はユーザのメッセージの直前に置く
+#                (リクエストの先頭部分が毎回同じになり、Azure OpenAI Service のプロンプトキャッシュが効く)
+# legacy: 現在時刻をシステムメッセージに含める (従来の構成)
+PROMPT_LAYOUT_PREFIX_STABLE = "prefix_stable"
+PROMPT_LAYOUT_LEGACY = "legacy"
+
+# システムメッセージのうち、リクエストごとに変化しない指示
+SYSTEM_INSTRUCTIONS = """
+- あなたは、ユーザがあなたとの会話を楽しむために作成された女性の AI アバターです。
+- ユーザが使用している言語で返信してください。
+- ユーザへの質問は、外部の情報を検索し、その情報を使用して回答してください
+- 生成した文章は音声合成され再生されるため、質問に対して要約した口語体の文章を出力してください(**Markdown記法や箇条書き、URLは使用しないでください**)。
+"""
+
+
+def build_system_message(layout: str = PROMPT_LAYOUT_LEGACY) -> str:
+    """
+    システムメッセージを生成する
+
+    Args:
+        layout (str): プロンプトの構成 (prefix_stable の場合は、毎回同じ文字列を返す)
+
+    Returns:
+        str: システムメッセージ
+    """
+    if layout == PROMPT_LAYOUT_PREFIX_STABLE:
+        return SYSTEM_INSTRUCTIONS + "- 必要に応じて、ユーザのメッセージの直前にある参考情報 (現在時刻等) を回答に使ってください\n"
+    return f"""{SYSTEM_INSTRUCTIONS}- 必要に応じて、回答に以下の情報を使ってください
+  - 現在時刻:  {datetime.today().strftime('%Y/%m/%d %H:%M:%S')}
+    """
+
+
+def build_context_message(layout: str = PROMPT_LAYOUT_LEGACY) -> str | None:
+    """
+    リクエストごとに変化する参考情報 (現在時刻等) のメッセージを生成する
+
+    Args:
+        layout (str): プロンプトの構成 (legacy の場合はシステムメッセージに含めるため None を返す)
+
+    Returns:
+        str | None: 参考情報のメッセージ
+    """
+    if layout != PROMPT_LAYOUT_PREFIX_STABLE:
+        return None
+    return f"参考情報:\n- 現在時刻: {datetime.today().strftime('%Y/%m/%d %H:%M')}"
+
+
+def to_history_messages(items: list[dict]) -> list[dict]:
+    """
+    メッセージ単位のアイテム (expand_history_items を参照) を、プロンプトに含める会話履歴へ変換する
+
+    Args:
+        items (list[dict]): メッセージ単位のアイテム (古い順)
+
+    Returns:
+        list[dict]: 会話履歴 (role と content のみ)
+    """
+    return [{"role": item["role"], "content": item["content"]} for item in items]
+
+
+def expand_history_items(items: list[dict]) -> list[dict]:
+    """
+    Azure Cosmos DB から取得したアイテムを、古い順に並べたメッセージ単位のアイテムへ展開する
+    1ターン分のメッセージを1アイテムにまとめた形式 (messages を持つ) と、1メッセージ1アイテムの従来の形式の両方に対応する
+
+    Args:
+        items (list[dict]): Azure Cosmos DB から取得したアイテム
+
+    Returns:
+        list[dict]: メッセージ (id, role, content と、格納したアイテムの _ts を持つ)
+    """
+    expanded = []
+    for item in sorted(items, key=lambda x: x["_ts"]):
+        messages = item["messages"] if "messages" in item else [item]
+        expanded += [{"id": m["id"], "role": m["role"], "content": m["content"], "_ts": item["_ts"]} for m in messages]
+    return expanded
+
+
+def with_message_ids(messages: list[dict]) -> list[dict]:
+    """
+    会話履歴に格納するメッセージに ID を付与する (付与済みのメッセージはそのまま)
+    書き込みをリトライした場合や、書き込み待ちのメッセージと格納済みのメッセージを突き合わせる場合に、同じメッセージを同じ ID で扱う
+
+    Args:
+        messages (list[dict]): メッセージ
+
+    Returns:
+        list[dict]: ID を付与したメッセージ
+    """
+    return [m if "id" in m else {"id": str(uuid.uuid4()), **m} for m in messages]
+
+
+def build_turn_messages(message: str, content: str, tool_messages: list[dict]) -> list[dict]:
+    """
+    会話履歴に格納する1ターン分のメッセージを生成する
+    呼び出したツールの名前と引数を、アシスタントのメッセージの tool_calls に記録する
+    (ツールの実行結果は会話履歴から読み込まず、アイテムが大きくなるため格納しない)
+
+    Args:
+        message (str): ユーザからのメッセージ
+        content (str): アシスタントの回答
+        tool_messages (list[dict]): ツール呼び出しのループで追加されたメッセージ
+
+    Returns:
+        list[dict]: ユーザとアシスタントのメッセージ
+    """
+    tool_calls = [{"name": call["function"]["name"], "arguments": call["function"]["arguments"]} for m in tool_messages for call in m.get("tool_calls") or []]
+    assistant = {"role": "assistant", "content": content}
+    if tool_calls:
+        assistant["tool_calls"] = tool_calls
+    return [{"role": "user", "content": message}, assistant]
+
+
+def parse_user_principal(principal: str) -> tuple[str, str]:
+    """
+    Easy Auth が付与するプリンシパル情報 (X-Ms-Client-Principal ヘッダー) からユーザ情報を取得する
+
+    Args:
+        principal (str): Base64 エンコードされたプリンシパル情報
+
+    Returns:
+        tuple[str, str]: ログインユーザのIDと名前
+    """
+    # プリンシパルが設定されていない場合のユーザIDとユーザ名を定義
+    if not principal:
+        return (ANONYMOUS_USER_ID, "")
+
+    # プリンシパルをBase64デコードする
+    principal = base64.b64decode(principal).decode("utf-8")
+    principal = json.loads(principal)
+
+    # プリンシパルから特定のキーの値を取得する関数を定義
+    def get_princival_value(key, default):
+        claims = [c["val"] for c in principal["claims"] if c["typ"] == key]
+        return claims[0] if claims else default
+
+    # ユーザーIDとユーザー名を取得する
+    user_id = get_princival_value("http://schemas.microsoft.com/identity/claims/objectidentifier", ANONYMOUS_USER_ID)
+    user_name = get_princival_value("http://schemas.xmlsoap.org/ws/2005/05/identity/claims/emailaddress", "unknown")
+    return (user_id, user_name)
@@ -0,0 +1,356 @@
+import os
+import json
+from utils.logger import logger
+
+# tiktoken がインストールされていない場合は、文字数から概算したトークン数を使用する
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# メッセージ1件あたりに加算されるトークン数 (ロールや区切りの分)
+MESSAGE_OVERHEAD_TOKENS = 3
+
+# 切り詰めた文字列の末尾に付与する文字列
+TRUNCATED_MARK = "…"
+
+
+def get_encoding_name() -> str:
+    """
+    トークン数を数えるエンコーディングの名前を取得する
+
+    Returns:
+        str: エンコーディングの名前
+    """
+    return os.environ.get("OPENAI_TOKEN_ENCODING", "o200k_base")
+
+
+class TokenCounter:
+    """
+    ローカルでトークン数を数える
+    tiktoken のエンコーディングのファイルは初回の読み込み時にダウンロードされるため、デプロイ時に取得しておく (deploy/provision.py を参照)
+    読み込みに失敗した場合は、文字数から概算したトークン数を使用する
+    """
+
+    def __init__(self, encoding_name: str = None):
+        self.encoding = None
+        if tiktoken:
+            encoding_name = encoding_name or get_encoding_name()
+            try:
+                self.encoding = tiktoken.get_encoding(encoding_name)
+            except Exception:
+                logger.exception(f"failed to load token encoding: {encoding_name}, using approximate token counts")
+
+    def count(self, text: str) -> int:
+        """
+        テキストのトークン数を数える
+
+        Args:
+            text (str): テキスト
+
+        Returns:
+            int: トークン数
+        """
+        if not text:
+            return 0
+        if self.encoding:
+            return len(self.encoding.encode(text))
+
+        # ASCII 文字は4文字で1トークン、それ以外 (日本語等) は1文字で1トークンとして概算する
+        ascii_count = sum(1 for c in text if c.isascii())
+        return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+    def count_message(self, message: dict) -> int:
+        """
+        Chat Completion API に送信するメッセージ1件のトークン数を数える
+
+        Args:
+            message (dict): メッセージ
+
+        Returns:
+            int: トークン数
+        """
+        tokens = MESSAGE_OVERHEAD_TOKENS + self.count(message.get("content") or "") + self.count(message.get("name") or "")
+        for tool_call in message.get("tool_calls") or []:
+            tokens += self.count(tool_call["function"]["name"]) + self.count(tool_call["function"]["arguments"])
+        return tokens
+
+    def count_messages(self, messages: list[dict]) -> int:
+        """
+        メッセージのリストのトークン数を数える
+
+        Args:
+            messages (list[dict]): メッセージのリスト
+
+        Returns:
+            int: トークン数
+        """
+        return sum(self.count_message(m) for m in messages)
+
+
+class ContextBuilder:
+    """
+    入力トークン数の上限 (予算) に収まるように、Chat Completion API へ送信するメッセージを組み立てる
+    """
+
+    def __init__(self, tools_definition: list[dict] = None, budget: int = None, tool_result_max_tokens: int = None, tool_result_min_tokens: int = None):
+        self.counter = TokenCounter()
+        self.budget = budget or int(os.environ.get("CONTEXT_TOKEN_BUDGET", 8000))
+        self.tool_result_max_tokens = tool_result_max_tokens or int(os.environ.get("CONTEXT_TOOL_RESULT_MAX_TOKENS", 1500))
+        # 1件あたりの上限を超えないように、最低限確保するトークン数も上限以下にする
+        min_tokens = tool_result_min_tokens or int(os.environ.get("CONTEXT_TOOL_RESULT_MIN_TOKENS", 200))
+        self.tool_result_min_tokens = min(min_tokens, self.tool_result_max_tokens)
+
+        # ツールの定義はリクエストごとに毎回送信されるため、予算から差し引いておく
+        self.tools_tokens = self.counter.count(json.dumps(tools_definition, ensure_ascii=False)) if tools_definition else 0
+
+    def build(self, system_message: str, history: list[dict], message: str, summary: str = None, context_message: str = None) -> tuple[list[dict], dict]:
+        """
+        システムメッセージ、会話履歴、ユーザのメッセージから、予算に収まるメッセージのリストを組み立てる
+        会話履歴は新しいものから順に、予算に収まる分だけ含める
+
+        Args:
+            system_message (str): システムメッセージ
+            history (list[dict]): 会話履歴 (古い順)
+            message (str): ユーザからのメッセージ
+            summary (str): これまでの会話の要約 (utils.summary を参照)
+            context_message (str): リクエストごとに変化する参考情報 (ユーザのメッセージの直前に置き、先頭部分を毎回同じにする)
+
+        Returns:
+            tuple[list[dict], dict]: メッセージのリストと、構成要素ごとのトークン数
+        """
+        system = {"role": "system", "content": system_message}
+        user = {"role": "user", "content": message}
+        prefix = [system]
+        suffix = [user]
+        usage = {
+            "budget": self.budget,
+            "tools": self.tools_tokens,
+            "system": self.counter.count_message(system),
+            "context": 0,
+            "summary": 0,
+            "user": self.counter.count_message(user),
+            "history": 0,
+            "history_dropped": 0,
+            "tool_calls": 0,
+            "tool_results": 0,
+            "tool_results_truncated": 0,
+        }
+
+        # ユーザのメッセージだけで予算を超える場合は、メッセージを切り詰める
+        remaining = self.budget - usage["tools"] - usage["system"]
+        if context_message:
+            context = {"role": "system", "content": context_message}
+            usage["context"] = self.counter.count_message(context)
+            remaining -= usage["context"]
+            suffix.insert(0, context)
+        if usage["user"] > remaining:
+            user["content"] = self.truncate(message, max(remaining - MESSAGE_OVERHEAD_TOKENS, 0))
+            usage["user"] = self.counter.count_message(user)
+        remaining -= usage["user"]
+
+        # 会話の要約がある場合は、予算の半分までを上限としてシステムメッセージの後に含める
+        if summary:
+            summary_message = {"role": "system", "content": f"これまでの会話の要約:\n{summary}"}
+            max_tokens = remaining // 2
+            if self.counter.count_message(summary_message) > max_tokens:
+                summary_message["content"] = self.truncate(summary_message["content"], max(max_tokens - MESSAGE_OVERHEAD_TOKENS, 0))
+            usage["summary"] = self.counter.count_message(summary_message)
+            remaining -= usage["summary"]
+            prefix.append(summary_message)
+
+        # 会話履歴を新しいものから順に追加する
+        included = []
+        for item in reversed(history):
+            tokens = self.counter.count_message(item)
+            if tokens > remaining:
+                break
+            included.insert(0, item)
+            remaining -= tokens
+            usage["history"] += tokens
+        usage["history_dropped"] = len(history) - len(included)
+
+        usage["total"] = usage["tools"] + usage["system"] + usage["context"] + usage["summary"] + usage["user"] + usage["history"]
+        return prefix + included + suffix, usage
+
+    def fit_tool_results(self, messages: list[dict], tool_messages: list[dict], usage: dict = None) -> tuple[list[dict], list[dict]]:
+        """
+        ツールの実行結果を、1件あたりの上限と残りの予算に収まるように圧縮する
+        残りの予算が1件あたりの最低限のトークン数に満たない場合は、次のリクエストで送信するメッセージから会話履歴を古いものから除く
+        (渡されたメッセージのリストは変更しないため、呼び出し元は保存する会話の範囲をそのまま使用できる)
+
+        Args:
+            messages (list[dict]): 次のリクエストで送信するメッセージのリスト (末尾はツール呼び出しのメッセージ)
+            tool_messages (list[dict]): ツールの実行結果のメッセージ
+            usage (dict): 構成要素ごとのトークン数 (ツール呼び出しとツールの実行結果の分を加算する)
+
+        Returns:
+            tuple[list[dict], list[dict]]: 会話履歴を除いたメッセージのリスト (除いていない場合は渡されたリスト) と、圧縮したツールの実行結果のメッセージ
+        """
+        if not tool_messages:
+            return messages, tool_messages
+
+        # ツール呼び出しのメッセージ (直前に追加したアシスタントのメッセージ) も送信するトークン数に含める
+        if usage is not None and messages and messages[-1].get("tool_calls"):
+            tokens = self.counter.count_message(messages[-1])
+            usage["tool_calls"] += tokens
+            usage["total"] += tokens
+
+        # 残りの予算が足りない場合は、会話履歴を古いものから除く
+        remaining = self.budget - self.tools_tokens - self.counter.count_messages(messages)
+        required = self.tool_result_min_tokens * len(tool_messages)
+        start, end = _find_history(messages)
+        dropped = start
+        while remaining < required and dropped < end:
+            tokens = self.counter.count_message(messages[dropped])
+            dropped += 1
+            remaining += tokens
+            if usage is not None:
+                usage["history"] -= tokens
+                usage["history_dropped"] += 1
+                usage["total"] -= tokens
+        if dropped > start:
+            messages = messages[:start] + messages[dropped:]
+
+        # 残りの予算をツールの実行結果で均等に分ける
+        max_tokens = max(min(self.tool_result_max_tokens, remaining // len(tool_messages)), 0)
+
+        results = []
+        for tool_message in tool_messages:
+            content = tool_message["content"]
+            compacted = self.compact(content, max_tokens)
+            results.append({**tool_message, "content": compacted})
+            if usage is not None:
+                usage["tool_results"] += self.counter.count(compacted)
+                usage["tool_results_truncated"] += 1 if compacted != content else 0
+                usage["total"] += self.counter.count_message(results[-1])
+        return messages, results
+
+    def compact(self, content: str, max_tokens: int) -> str:
+        """
+        ツールの実行結果 (JSON 文字列) を、JSON として有効なまま指定したトークン数に収まるように圧縮する
+        長い文字列の値を短くし、それでも収まらない場合はリストの末尾の要素を削除する
+
+        Args:
+            content (str): ツールの実行結果
+            max_tokens (int): トークン数の上限
+
+        Returns:
+            str: 圧縮したツールの実行結果
+        """
+        if self.counter.count(content) <= max_tokens:
+            return content
+        try:
+            value = json.loads(content)
+        except (json.JSONDecodeError, TypeError):
+            return self.truncate(content, max_tokens)
+
+        # 文字列の値の最大長を半分ずつにしながら、上限に収まるまで圧縮する
+        max_length = max(len(content), 1)
+        while max_length >= 32:
+            max_length //= 2
+            compacted = json.dumps(_truncate_strings(value, max_length), ensure_ascii=False)
+            if self.counter.count(compacted) <= max_tokens:
+                return compacted
+
+        # それでも収まらない場合は、リストの末尾の要素から削除する
+        value = _truncate_strings(value, max_length)
+        while isinstance(value, list) and len(value) > 1:
+            value = value[:-1]
+            compacted = json.dumps(value, ensure_ascii=False)
+            if self.counter.count(compacted) <= max_tokens:
+                return compacted
+        return self.truncate(json.dumps(value, ensure_ascii=False), max_tokens)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        テキストを指定したトークン数に収まるように末尾から切り詰める
+
+        Args:
+            text (str): テキスト
+            max_tokens (int): トークン数の上限
+
+        Returns:
+            str: 切り詰めたテキスト
+        """
+        if self.counter.count(text) <= max_tokens:
+            return text
+        if self.counter.encoding:
+            return self.counter.encoding.decode(self.counter.encoding.encode(text)[: max(max_tokens - 1, 0)]) + TRUNCATED_MARK
+
+        # トークン数が上限に収まるまで、文字数を減らす
+        length = len(text)
+        while length > 0 and self.counter.count(text[:length]) > max_tokens - 1:
+            length = length * 3 // 4
+        return text[:length] + TRUNCATED_MARK
+
+
+def _find_history(messages: list[dict]) -> tuple[int, int]:
+    """
+    ContextBuilder.build で組み立てたメッセージのリストから、会話履歴の範囲を探す
+    会話履歴は、先頭のシステムメッセージ (と会話の要約) の後から、参考情報とユーザのメッセージの前まで
+
+    Returns:
+        tuple[int, int]: 会話履歴の開始位置と終了位置 (終了位置は含まない)
+    """
+    start = 0
+    while start < len(messages) and messages[start]["role"] == "system":
+        start += 1
+    end = max((i for i, m in enumerate(messages) if m["role"] == "user"), default=start)
+    while end > start and messages[end - 1]["role"] == "system":
+        end -= 1
+    return start, max(start, end)
+
+
+def _truncate_strings(value, max_length: int):
+    """
+    JSON の値に含まれる文字列を、指定した長さに切り詰める
+    """
+    if isinstance(value, str):
+        return value if len(value) <= max_length else value[:max_length] + TRUNCATED_MARK
+    if isinstance(value, list):
+        return [_truncate_strings(v, max_length) for v in value]
+    if isinstance(value, dict):
+        return {k: _truncate_strings(v, max_length) for k, v in value.items()}
+    return value
+
+
+def add_completion_usage(usage: dict, completion_usage):
+    """
+    Chat Completion API が返したトークン数 (プロンプトキャッシュから読み込んだトークン数を含む) を加算する
+    ツール呼び出しのループで複数回呼び出した場合は、その合計となる
+
+    Args:
+        usage (dict): 構成要素ごとのトークン数
+        completion_usage: Chat Completion API の応答の usage (CompletionUsage または dict)
+    """
+    completion_usage = _to_dict(completion_usage)
+    details = _to_dict(completion_usage.get("prompt_tokens_details"))
+    usage["requests"] = usage.get("requests", 0) + 1
+    usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + (completion_usage.get("prompt_tokens") or 0)
+    usage["cached_tokens"] = usage.get("cached_tokens", 0) + (details.get("cached_tokens") or 0)
+    usage["completion_tokens"] = usage.get("completion_tokens", 0) + (completion_usage.get("completion_tokens") or 0)
+
+
+def log_context_usage(usage: dict):
+    """
+    構成要素ごとのトークン数をログに出力する
+    Chat Completion API が返したトークン数がある場合は、プロンプトキャッシュのヒット率も出力する
+
+    Args:
+        usage (dict): 構成要素ごとのトークン数
+    """
+    if usage.get("prompt_tokens"):
+        usage["cached_ratio"] = round(usage["cached_tokens"] / usage["prompt_tokens"], 3)
+    logger.info(f"context tokens: {json.dumps(usage)}")
+
+
+def _to_dict(value) -> dict:
+    """
+    openai のモデル (未定義のフィールドは dict のまま保持される) を dict に変換する
+    """
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return value
+    return value.model_dump() if hasattr(value, "model_dump") else vars(value)
@@ -3,6 +3,7 @@ import uuid
 from typing import List, Dict
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import TokenCredential
+from azure.core import MatchConditions
 from azure.cosmos import PartitionKey
 from azure.cosmos.cosmos_client import CosmosClient
 from azure.cosmos.exceptions import CosmosResourceNotFoundError
@@ -16,8 +17,15 @@ class CosmosContainer:
         db_name: str = None,
         container_name: str = None,
         connection_string: str = None,
-        credential: TokenCredential = DefaultAzureCredential(),
+        partition_key_path: str = "/id",
+        credential: TokenCredential = None,
+        provision: bool = True,
     ):
+        """
+        Args:
+            provision (bool): データベースとコンテナが存在しない場合に作成するか
+                              (False の場合は作成のためのリクエストを送信しない。デプロイ時に deploy/provision.py で作成しておく)
+        """
         account_name = account_name or os.getenv("COSMOS_ACCOUNT_NAME")
         db_name = db_name or os.getenv("COSMOS_DB_NAME")
         container_name = container_name or os.getenv("COSMOS_CONTAINER_NAME")
@@ -29,18 +37,20 @@ class CosmosContainer:
         else:
             client = CosmosClient(
                 url=f"https://{account_name}.documents.azure.com:443/",
-                credential=credential,
+                credential=credential or DefaultAzureCredential(),
             )
 
         # データベースを参照する (存在しない場合は作成する)
-        client.create_database_if_not_exists(id=db_name)
+        if provision:
+            client.create_database_if_not_exists(id=db_name)
         database = client.get_database_client(db_name)
 
         # コンテナを参照する (存在しない場合は作成する)
-        database.create_container_if_not_exists(id=container_name, partition_key=PartitionKey(path=f"/id"))
+        if provision:
+            database.create_container_if_not_exists(id=container_name, partition_key=PartitionKey(path=partition_key_path))
         self.container = database.get_container_client(container_name)
 
-    def query_items(self, query: str, parameters: List[Dict] = None, enable_cross_partition_query: bool = True) -> List[Dict]:
+    def query_items(self, query: str, parameters: List[Dict] = None, enable_cross_partition_query: bool = True, partition_key: str = None) -> List[Dict]:
         """
         Azure Cosmos DB にクエリを実行する
 
@@ -48,47 +58,65 @@ class CosmosContainer:
             query (str): クエリ文字列
             parameters (list[dict]): クエリパラメータ
             enable_cross_partition_query (bool): クロスパーティションクエリを許可するか
+            partition_key (str): パーティションキー (指定した場合は単一パーティションに対するクエリになる)
 
         Returns:
             list[dict]: クエリ結果
         """
+        if partition_key is not None:
+            items = self.container.query_items(query, parameters=parameters, partition_key=partition_key)
+            return [i for i in items]
         items = self.container.query_items(query, parameters=parameters, enable_cross_partition_query=enable_cross_partition_query)
         return [i for i in items]
 
-    def get_item(self, id: str) -> Dict:
+    def get_item(self, id: str, partition_key: str = None) -> Dict:
         """
         Azure Cosmos DB から指定されたIDのアイテムを取得する
 
         Args:
             id (str): アイテムID
+            partition_key (str): パーティションキー (省略した場合はアイテムIDを使用する)
         """
         try:
-            return self.container.read_item(item=id, partition_key=id)
+            return self.container.read_item(item=id, partition_key=partition_key if partition_key is not None else id)
         except CosmosResourceNotFoundError:
             return None
 
-    def upsert_item(self, item: dict):
+    def upsert_item(self, item: dict, etag: str = None):
         """
         Azure Cosmos DB にアイテムを追加または更新する
 
         Args:
             item (dict): 追加または更新するアイテム
+            etag (str): 指定した場合は、アイテムがこの ETag から変更されていない場合のみ更新する (楽観的同時実行制御)
         """
         try:
             if "id" not in item:
                 item["id"] = str(uuid.uuid4())
+            if etag:
+                return self.container.upsert_item(item, etag=etag, match_condition=MatchConditions.IfNotModified)
             return self.container.upsert_item(item)
         except CosmosResourceNotFoundError:
             return None
 
-    def delete_item(self, id: str):
+    def create_item(self, item: dict):
+        """
+        Azure Cosmos DB にアイテムを追加する (同じIDのアイテムが既に存在する場合は CosmosResourceExistsError を送出する)
+
+        Args:
+            item (dict): 追加するアイテム
+        """
+        return self.container.create_item(item)
+
+    def delete_item(self, id: str, partition_key: str = None):
         """
         Azure Cosmos DB から指定されたIDのアイテムを削除する
 
         Args:
             id (str): アイテムID
+            partition_key (str): パーティションキー (省略した場合はアイテムIDを使用する)
         """
         try:
-            self.container.delete_item(item=id, partition_key=id)
+            self.container.delete_item(item=id, partition_key=partition_key if partition_key is not None else id)
         except CosmosResourceNotFoundError:
             pass
@@ -0,0 +1,138 @@
+import os
+import uuid
+from typing import List, Dict
+from azure.identity.aio import DefaultAzureCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.core import MatchConditions
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+
+class AsyncCosmosContainer:
+    """
+    Azure Cosmos DB のコンテナを操作するクライアント (非同期版)
+    接続はイベントループ上で open() を呼び出した際に確立する
+    """
+
+    def __init__(
+        self,
+        account_name: str = None,
+        db_name: str = None,
+        container_name: str = None,
+        connection_string: str = None,
+        partition_key_path: str = "/id",
+        credential: AsyncTokenCredential = None,
+        provision: bool = True,
+    ):
+        """
+        Args:
+            provision (bool): データベースとコンテナが存在しない場合に作成するか (False の場合は作成のためのリクエストを送信しない)
+        """
+        self.account_name = account_name or os.getenv("COSMOS_ACCOUNT_NAME")
+        self.db_name = db_name or os.getenv("COSMOS_DB_NAME")
+        self.container_name = container_name or os.getenv("COSMOS_CONTAINER_NAME")
+        self.connection_string = connection_string or os.getenv("COSMOS_CONNECTION_STRING")
+        self.partition_key_path = partition_key_path
+        self.credential = credential
+        self.provision = provision
+        self.client = None
+        self.container = None
+
+    async def open(self):
+        """
+        Azure Cosmos DB アカウントへ接続し、データベースとコンテナを参照する
+        """
+        # Azure Cosmos DB アカウントを参照する
+        if self.connection_string:
+            self.client = CosmosClient.from_connection_string(self.connection_string)
+        else:
+            self.client = CosmosClient(
+                url=f"https://{self.account_name}.documents.azure.com:443/",
+                credential=self.credential or DefaultAzureCredential(),
+            )
+
+        # データベースとコンテナを参照する (存在しない場合は作成する)
+        if self.provision:
+            database = await self.client.create_database_if_not_exists(id=self.db_name)
+            self.container = await database.create_container_if_not_exists(id=self.container_name, partition_key=PartitionKey(path=self.partition_key_path))
+        else:
+            self.container = self.client.get_database_client(self.db_name).get_container_client(self.container_name)
+
+    async def close(self):
+        """
+        Azure Cosmos DB アカウントへの接続を閉じる
+        """
+        if self.client:
+            await self.client.close()
+            self.client = None
+
+    async def query_items(self, query: str, parameters: List[Dict] = None, partition_key: str = None) -> List[Dict]:
+        """
+        Azure Cosmos DB にクエリを実行する
+
+        Args:
+            query (str): クエリ文字列
+            parameters (list[dict]): クエリパラメータ
+            partition_key (str): パーティションキー (指定した場合は単一パーティションに対するクエリになる)
+
+        Returns:
+            list[dict]: クエリ結果
+        """
+        if partition_key is not None:
+            items = self.container.query_items(query, parameters=parameters, partition_key=partition_key)
+        else:
+            items = self.container.query_items(query, parameters=parameters)
+        return [i async for i in items]
+
+    async def get_item(self, id: str, partition_key: str = None) -> Dict:
+        """
+        Azure Cosmos DB から指定されたIDのアイテムを取得する
+
+        Args:
+            id (str): アイテムID
+            partition_key (str): パーティションキー (省略した場合はアイテムIDを使用する)
+        """
+        try:
+            return await self.container.read_item(item=id, partition_key=partition_key if partition_key is not None else id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def upsert_item(self, item: dict, etag: str = None):
+        """
+        Azure Cosmos DB にアイテムを追加または更新する
+
+        Args:
+            item (dict): 追加または更新するアイテム
+            etag (str): 指定した場合は、アイテムがこの ETag から変更されていない場合のみ更新する (楽観的同時実行制御)
+        """
+        try:
+            if "id" not in item:
+                item["id"] = str(uuid.uuid4())
+            if etag:
+                return await self.container.upsert_item(item, etag=etag, match_condition=MatchConditions.IfNotModified)
+            return await self.container.upsert_item(item)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def create_item(self, item: dict):
+        """
+        Azure Cosmos DB にアイテムを追加する (同じIDのアイテムが既に存在する場合は CosmosResourceExistsError を送出する)
+
+        Args:
+            item (dict): 追加するアイテム
+        """
+        return await self.container.create_item(item)
+
+    async def delete_item(self, id: str, partition_key: str = None):
+        """
+        Azure Cosmos DB から指定されたIDのアイテムを削除する
+
+        Args:
+            id (str): アイテムID
+            partition_key (str): パーティションキー (省略した場合はアイテムIDを使用する)
+        """
+        try:
+            await self.container.delete_item(item=id, partition_key=partition_key if partition_key is not None else id)
+        except CosmosResourceNotFoundError:
+            pass
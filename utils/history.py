@@ -0,0 +1,410 @@
+import os
+import time
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError
+from utils.cache import LRUCache
+from utils.chat import HISTORY_QUERY, to_history_messages, expand_history_items, with_message_ids
+from utils.summary import UNSUMMARIZED_QUERY, get_summary_id
+
+# ユーザごとのパーティションに格納する、直近の会話履歴のアイテムIDと会話の要約のアイテムID
+WINDOW_ITEM_ID = "window"
+SUMMARY_ITEM_ID = "summary"
+
+# 楽観的同時実行制御で更新が競合した場合のリトライ回数
+MAX_CONFLICT_RETRIES = 3
+
+
+class MessageHistoryStore:
+    """
+    /id でパーティション分割した (従来の) コンテナに、1ターン分のメッセージを1アイテムとして格納する会話履歴ストア
+    (1メッセージ1アイテムの従来の形式のアイテムも読み込める)
+    会話履歴の取得はクロスパーティションクエリになる
+    """
+
+    def __init__(self, cosmos_client, recent_count: int = None, cache: LRUCache = None):
+        self.cosmos_client = cosmos_client
+        self.recent_count = recent_count or int(os.environ.get("HISTORY_MESSAGE_COUNT", 4))
+        self.cache = cache or create_history_cache()
+
+    def load(self, user_id: str) -> list[dict]:
+        """
+        直近の会話履歴を取得する (キャッシュにある場合は Azure Cosmos DB にアクセスしない)
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            list[dict]: 会話履歴 (古い順)
+        """
+        return to_history_messages(self.load_items(user_id))
+
+    def load_items(self, user_id: str) -> list[dict]:
+        """
+        直近の会話履歴を、メッセージの ID を含めて取得する (書き込み待ちのメッセージとの重複を除くために使用する)
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            list[dict]: メッセージ (古い順, id を含む)
+        """
+        items = self.cache.get(user_id)
+        if items is None:
+            params = [{"name": "@user_id", "value": user_id}, {"name": "@limit", "value": self.recent_count}]
+            items = self.cosmos_client.query_items(HISTORY_QUERY, params)
+            self.cache.set(user_id, items)
+        return expand_history_items(items)[-self.recent_count :]
+
+    def append(self, user_id: str, messages: list[dict]):
+        """
+        会話履歴を追加する (キャッシュにも反映する)
+        1ターン分のメッセージを1アイテムとして1回で書き込み、アイテムIDはメッセージの ID から決めるため、書き込み直しても重複しない
+
+        Args:
+            user_id (str): ユーザID
+            messages (list[dict]): 追加するメッセージ (古い順)
+        """
+        item = self.cosmos_client.upsert_item(new_turn_item(user_id, messages))
+        if item:
+            self.cache_appended(user_id, [item])
+
+    def cache_appended(self, user_id: str, items: list[dict]):
+        """
+        追加した会話履歴を、キャッシュされている直近の会話履歴に反映する
+        """
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            self.cache.set(user_id, (cached + items)[-self.recent_count :])
+
+    def load_since(self, user_id: str, ts: int) -> list[dict]:
+        """
+        指定した時刻以降の会話履歴を取得する
+
+        Args:
+            user_id (str): ユーザID
+            ts (int): 時刻 (UNIX 時間)
+
+        Returns:
+            list[dict]: 会話履歴のアイテム (古い順, id と _ts を含む)
+        """
+        params = [{"name": "@user_id", "value": user_id}, {"name": "@ts", "value": ts}]
+        return expand_history_items(self.cosmos_client.query_items(UNSUMMARIZED_QUERY, params))
+
+    def get_summary(self, user_id: str) -> dict:
+        """
+        会話の要約のアイテムを取得する
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            dict: 会話の要約のアイテム (存在しない場合は None)
+        """
+        return self.cosmos_client.get_item(get_summary_id(user_id))
+
+    def save_summary(self, user_id: str, doc: dict):
+        """
+        会話の要約のアイテムを格納する
+
+        Args:
+            user_id (str): ユーザID
+            doc (dict): 会話の要約のアイテム
+        """
+        self.cosmos_client.upsert_item(doc)
+
+
+class PartitionedHistoryStore:
+    """
+    /user_id でパーティション分割したコンテナに、ユーザごとの直近の会話履歴を1アイテムとして格納する会話履歴ストア
+    会話履歴の取得は、キャッシュにない場合でも1回のポイント読み取りで済む
+    """
+
+    def __init__(self, cosmos_client, recent_count: int = None, max_messages: int = None, cache: LRUCache = None):
+        self.cosmos_client = cosmos_client
+        self.recent_count = recent_count or int(os.environ.get("HISTORY_MESSAGE_COUNT", 4))
+        self.max_messages = max(max_messages or int(os.environ.get("HISTORY_STORE_MAX_MESSAGES", 50)), self.recent_count)
+        self.cache = cache or create_history_cache()
+
+    def load(self, user_id: str) -> list[dict]:
+        """
+        直近の会話履歴を取得する (キャッシュにある場合は Azure Cosmos DB にアクセスしない)
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            list[dict]: 会話履歴 (古い順)
+        """
+        return to_history_messages(self.load_items(user_id))
+
+    def load_items(self, user_id: str) -> list[dict]:
+        """
+        直近の会話履歴を、メッセージの ID を含めて取得する (書き込み待ちのメッセージとの重複を除くために使用する)
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            list[dict]: メッセージ (古い順, id を含む)
+        """
+        doc = self._load_window(user_id)
+        return to_window_messages(doc, self.recent_count)
+
+    def append(self, user_id: str, messages: list[dict]):
+        """
+        会話履歴を追加する (キャッシュにも反映する)
+        他のインスタンスと更新が競合した場合は、最新のアイテムを読み直して追加し直す
+
+        Args:
+            user_id (str): ユーザID
+            messages (list[dict]): 追加するメッセージ (古い順)
+        """
+        for _ in range(MAX_CONFLICT_RETRIES):
+            doc = self._load_window(user_id)
+            try:
+                saved = self._save_window(doc, append_window(doc, messages, self.max_messages))
+                self.cache.set(user_id, saved)
+                return
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+                self.cache.pop(user_id)
+        raise RuntimeError(f"failed to append history due to conflicts: user_id={user_id}")
+
+    def load_since(self, user_id: str, ts: int) -> list[dict]:
+        """
+        指定した時刻以降の会話履歴を取得する
+
+        Args:
+            user_id (str): ユーザID
+            ts (int): 時刻 (UNIX 時間)
+
+        Returns:
+            list[dict]: 会話履歴のアイテム (古い順, id と _ts を含む)
+        """
+        doc = self._load_window(user_id)
+        return to_window_items(doc, ts)
+
+    def get_summary(self, user_id: str) -> dict:
+        """
+        会話の要約のアイテムを取得する
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            dict: 会話の要約のアイテム (存在しない場合は None)
+        """
+        return self.cosmos_client.get_item(SUMMARY_ITEM_ID, partition_key=user_id)
+
+    def save_summary(self, user_id: str, doc: dict):
+        """
+        会話の要約のアイテムを格納する
+
+        Args:
+            user_id (str): ユーザID
+            doc (dict): 会話の要約のアイテム
+        """
+        self.cosmos_client.upsert_item({**doc, "id": SUMMARY_ITEM_ID, "user_id": user_id})
+
+    def _save_window(self, doc: dict, updated: dict) -> dict:
+        """
+        直近の会話履歴のアイテムを書き込む
+        読み込んだアイテムが存在しなかった場合は追加し (他のインスタンスが先に追加していた場合は競合として扱う)、
+        存在した場合は読み込んだ時点から変更されていない場合のみ更新する
+        """
+        if "_etag" not in doc:
+            return self.cosmos_client.create_item(updated)
+        return self.cosmos_client.upsert_item(updated, etag=doc["_etag"])
+
+    def _load_window(self, user_id: str) -> dict:
+        """
+        直近の会話履歴のアイテムを、キャッシュまたはポイント読み取りで取得する
+        """
+        doc = self.cache.get(user_id)
+        if doc is None:
+            doc = self.cosmos_client.get_item(WINDOW_ITEM_ID, partition_key=user_id) or new_window(user_id)
+            self.cache.set(user_id, doc)
+        return doc
+
+
+class AsyncMessageHistoryStore(MessageHistoryStore):
+    """
+    MessageHistoryStore の非同期版
+    """
+
+    async def open(self):
+        await self.cosmos_client.open()
+
+    async def close(self):
+        await self.cosmos_client.close()
+
+    async def load(self, user_id: str) -> list[dict]:
+        return to_history_messages(await self.load_items(user_id))
+
+    async def load_items(self, user_id: str) -> list[dict]:
+        items = self.cache.get(user_id)
+        if items is None:
+            params = [{"name": "@user_id", "value": user_id}, {"name": "@limit", "value": self.recent_count}]
+            items = await self.cosmos_client.query_items(HISTORY_QUERY, params)
+            self.cache.set(user_id, items)
+        return expand_history_items(items)[-self.recent_count :]
+
+    async def append(self, user_id: str, messages: list[dict]):
+        item = await self.cosmos_client.upsert_item(new_turn_item(user_id, messages))
+        if item:
+            self.cache_appended(user_id, [item])
+
+    async def load_since(self, user_id: str, ts: int) -> list[dict]:
+        params = [{"name": "@user_id", "value": user_id}, {"name": "@ts", "value": ts}]
+        return expand_history_items(await self.cosmos_client.query_items(UNSUMMARIZED_QUERY, params))
+
+    async def get_summary(self, user_id: str) -> dict:
+        return await self.cosmos_client.get_item(get_summary_id(user_id))
+
+    async def save_summary(self, user_id: str, doc: dict):
+        await self.cosmos_client.upsert_item(doc)
+
+
+class AsyncPartitionedHistoryStore(PartitionedHistoryStore):
+    """
+    PartitionedHistoryStore の非同期版
+    """
+
+    async def open(self):
+        await self.cosmos_client.open()
+
+    async def close(self):
+        await self.cosmos_client.close()
+
+    async def load(self, user_id: str) -> list[dict]:
+        return to_history_messages(await self.load_items(user_id))
+
+    async def load_items(self, user_id: str) -> list[dict]:
+        doc = await self._load_window(user_id)
+        return to_window_messages(doc, self.recent_count)
+
+    async def append(self, user_id: str, messages: list[dict]):
+        for _ in range(MAX_CONFLICT_RETRIES):
+            doc = await self._load_window(user_id)
+            try:
+                saved = await self._save_window(doc, append_window(doc, messages, self.max_messages))
+                self.cache.set(user_id, saved)
+                return
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+                self.cache.pop(user_id)
+        raise RuntimeError(f"failed to append history due to conflicts: user_id={user_id}")
+
+    async def load_since(self, user_id: str, ts: int) -> list[dict]:
+        doc = await self._load_window(user_id)
+        return to_window_items(doc, ts)
+
+    async def get_summary(self, user_id: str) -> dict:
+        return await self.cosmos_client.get_item(SUMMARY_ITEM_ID, partition_key=user_id)
+
+    async def save_summary(self, user_id: str, doc: dict):
+        await self.cosmos_client.upsert_item({**doc, "id": SUMMARY_ITEM_ID, "user_id": user_id})
+
+    async def _save_window(self, doc: dict, updated: dict) -> dict:
+        if "_etag" not in doc:
+            return await self.cosmos_client.create_item(updated)
+        return await self.cosmos_client.upsert_item(updated, etag=doc["_etag"])
+
+    async def _load_window(self, user_id: str) -> dict:
+        doc = self.cache.get(user_id)
+        if doc is None:
+            doc = await self.cosmos_client.get_item(WINDOW_ITEM_ID, partition_key=user_id) or new_window(user_id)
+            self.cache.set(user_id, doc)
+        return doc
+
+
+def create_history_cache() -> LRUCache:
+    """
+    会話履歴のキャッシュを生成する
+    複数インスタンスで動作させる場合に古い履歴を使い続けないように、有効期限を設定する
+    """
+    return LRUCache(maxsize=int(os.environ.get("HISTORY_CACHE_SIZE", 1000)), ttl=float(os.environ.get("HISTORY_CACHE_TTL", 600)))
+
+
+def create_history_store(provision: bool = True) -> MessageHistoryStore | PartitionedHistoryStore:
+    """
+    環境変数 HISTORY_STORE の設定に応じた会話履歴ストアを生成する
+    messages: 1メッセージ1アイテムの従来の形式, partitioned: ユーザごとにパーティション分割した形式
+
+    Args:
+        provision (bool): データベースとコンテナが存在しない場合に作成するか
+    """
+    from utils.cosmos import CosmosContainer
+
+    if os.environ.get("HISTORY_STORE", "messages") == "partitioned":
+        container = CosmosContainer(container_name=get_partitioned_container_name(), partition_key_path="/user_id", provision=provision)
+        return PartitionedHistoryStore(container)
+    return MessageHistoryStore(CosmosContainer(provision=provision))
+
+
+def create_async_history_store(provision: bool = True) -> AsyncMessageHistoryStore | AsyncPartitionedHistoryStore:
+    """
+    環境変数 HISTORY_STORE の設定に応じた会話履歴ストアを生成する (非同期版)
+
+    Args:
+        provision (bool): データベースとコンテナが存在しない場合に作成するか
+    """
+    from utils.cosmos_async import AsyncCosmosContainer
+
+    if os.environ.get("HISTORY_STORE", "messages") == "partitioned":
+        container = AsyncCosmosContainer(container_name=get_partitioned_container_name(), partition_key_path="/user_id", provision=provision)
+        return AsyncPartitionedHistoryStore(container)
+    return AsyncMessageHistoryStore(AsyncCosmosContainer(provision=provision))
+
+
+def get_partitioned_container_name() -> str:
+    """
+    ユーザごとにパーティション分割した会話履歴のコンテナ名を取得する
+    """
+    return os.environ.get("COSMOS_HISTORY_CONTAINER_NAME", "avatar-chat-history-by-user")
+
+
+def new_window(user_id: str) -> dict:
+    """
+    まだ会話履歴がないユーザの、直近の会話履歴のアイテムを生成する
+    """
+    return {"id": WINDOW_ITEM_ID, "user_id": user_id, "messages": []}
+
+
+def new_turn_item(user_id: str, messages: list[dict]) -> dict:
+    """
+    1ターン分のメッセージ (遅延書き込みでまとめた場合は複数ターン分) を、従来のコンテナに格納する1アイテムに変換する
+    アイテムIDは最初のメッセージの ID とし、同じメッセージを書き込み直した場合は同じアイテムを上書きする
+    """
+    messages = with_message_ids(messages)
+    return {"id": messages[0]["id"], "user_id": user_id, "messages": messages}
+
+
+def append_window(doc: dict, messages: list[dict], max_messages: int) -> dict:
+    """
+    直近の会話履歴のアイテムにメッセージを追加し、上限を超えた古いメッセージを削除する
+
+    Args:
+        doc (dict): 直近の会話履歴のアイテム
+        messages (list[dict]): 追加するメッセージ (古い順)
+        max_messages (int): 保持するメッセージ数の上限
+
+    Returns:
+        dict: 更新後のアイテム
+    """
+    ts = int(time.time())
+    # 書き込み直した場合に同じメッセージを重複して追加しないよう、追加済みの ID のメッセージは除く
+    ids = {m["id"] for m in doc["messages"]}
+    items = [{**m, "ts": ts} for m in with_message_ids(messages) if m["id"] not in ids]
+    return {"id": WINDOW_ITEM_ID, "user_id": doc["user_id"], "messages": (doc["messages"] + items)[-max_messages:]}
+
+
+def to_window_messages(doc: dict, recent_count: int) -> list[dict]:
+    """
+    直近の会話履歴のアイテムから、プロンプトに含める会話履歴を ID を含めて取得する
+    """
+    return [{"id": m["id"], "role": m["role"], "content": m["content"]} for m in doc["messages"][-recent_count:]]
+
+
+def to_window_items(doc: dict, ts: int) -> list[dict]:
+    """
+    直近の会話履歴のアイテムから、指定した時刻以降のメッセージを従来の形式のアイテムとして取得する
+    """
+    return [{"id": m["id"], "role": m["role"], "content": m["content"], "_ts": m["ts"]} for m in doc["messages"] if m["ts"] >= ts]
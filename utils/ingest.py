@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import random
+import threading
+from typing import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+from azure.core.exceptions import HttpResponseError
+from utils.logger import logger
+
+# Azure AI Search の1回のリクエストで送信できるドキュメント数の上限
+MAX_BATCH_DOCUMENTS = 1000
+
+# 混雑 (スロットリング) を表す HTTP ステータスコード
+THROTTLING_STATUS_CODES = (429, 503)
+
+# ドキュメント単位の失敗のうち、リトライすれば成功する可能性があるもの
+RETRIABLE_STATUS_CODES = (409, 422, 429, 500, 503)
+
+
+class AdaptiveConcurrency:
+    """
+    スロットリングの応答に応じて、同時に送信するリクエスト数を調整する
+    スロットリングされた場合は半分に減らし、成功が続いた場合は1ずつ増やす (AIMD)
+    同時に送信していたリクエストがまとめてスロットリングされた場合に何度も減らさないよう、減らした直後の一定時間は減らさない
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = None, cooldown: float = 1.0):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.value = max(minimum, min(initial, self.maximum))
+        self.successes = 0
+        self.cooldown = cooldown
+        self.decreased_at = None
+        self.lock = threading.Lock()
+
+    def on_success(self):
+        """
+        リクエストが成功したことを記録する
+        """
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.value and self.value < self.maximum:
+                self.value += 1
+                self.successes = 0
+
+    def on_throttle(self):
+        """
+        リクエストがスロットリングされたことを記録する
+        """
+        with self.lock:
+            self.successes = 0
+            if self.decreased_at is not None and time.monotonic() - self.decreased_at < self.cooldown:
+                return
+            self.decreased_at = time.monotonic()
+            value = max(self.minimum, self.value // 2)
+            if value != self.value:
+                logger.warning(f"search ingestion throttled, concurrency: {self.value} -> {value}")
+            self.value = value
+
+
+class SearchIngestionPipeline:
+    """
+    ドキュメントを逐次読み込みながら、サイズ (バイト数) で区切ったバッチ単位で Azure AI Search のインデックスへ登録する
+    同時に送信中のバッチ数を上限とするため、ドキュメント数が多くてもメモリ使用量は一定に収まる
+    """
+
+    def __init__(
+        self,
+        search_client,
+        key_field: str = "id",
+        max_batch_bytes: int = None,
+        max_batch_documents: int = None,
+        max_concurrency: int = None,
+        max_retries: int = None,
+    ):
+        """
+        Args:
+            search_client: azure.search.documents.SearchClient
+            key_field (str): インデックスのキーのフィールド名
+            max_batch_bytes (int): 1つのバッチの JSON のバイト数の上限
+            max_batch_documents (int): 1つのバッチのドキュメント数の上限
+            max_concurrency (int): 同時に送信するバッチ数の上限
+            max_retries (int): 失敗したドキュメントをリトライする回数
+        """
+        self.search_client = search_client
+        self.key_field = key_field
+        self.max_batch_bytes = max_batch_bytes or int(os.getenv("AI_SEARCH_INGEST_MAX_BATCH_BYTES", 8 * 1024 * 1024))
+        self.max_batch_documents = min(max_batch_documents or int(os.getenv("AI_SEARCH_INGEST_MAX_BATCH_DOCUMENTS", MAX_BATCH_DOCUMENTS)), MAX_BATCH_DOCUMENTS)
+        self.max_concurrency = max_concurrency or int(os.getenv("AI_SEARCH_INGEST_MAX_CONCURRENCY", 8))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("AI_SEARCH_INGEST_MAX_RETRIES", 5))
+        self.concurrency = AdaptiveConcurrency(initial=max(self.max_concurrency // 2, 1), maximum=self.max_concurrency)
+
+    def run(self, docs: Iterable[dict]) -> dict:
+        """
+        ドキュメントをインデックスに登録する
+
+        Args:
+            docs (Iterable[dict]): ドキュメント (リストまたはジェネレータ)
+
+        Returns:
+            dict: 登録したドキュメント数、失敗したドキュメント数、経過時間(秒)、1秒あたりの登録数
+        """
+        stats = {"succeeded": 0, "failed": 0, "batches": 0}
+        started_at = time.monotonic()
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="search-ingest") as executor, tqdm(unit="doc") as progress:
+
+            def collect(futures):
+                for future in futures:
+                    succeeded, failed = future.result()
+                    stats["succeeded"] += succeeded
+                    stats["failed"] += failed
+                    progress.update(succeeded + failed)
+
+            for batch in batch_by_size(docs, self.max_batch_bytes, self.max_batch_documents):
+                # 送信中のバッチ数が上限に達している場合は、どれかが終わるまで待つ
+                while len(in_flight) >= self.concurrency.value:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(executor.submit(self._upload_with_retry, batch))
+                stats["batches"] += 1
+            collect(wait(in_flight).done)
+
+        stats["elapsed"] = round(time.monotonic() - started_at, 3)
+        stats["docs_per_sec"] = round(stats["succeeded"] / stats["elapsed"], 1) if stats["elapsed"] > 0 else 0.0
+        logger.info(f"search ingestion finished: {json.dumps(stats)}")
+        return stats
+
+    def _upload_with_retry(self, batch: list[dict]) -> tuple[int, int]:
+        """
+        バッチを登録し、失敗したドキュメントのみをリトライする
+
+        Args:
+            batch (list[dict]): ドキュメントのバッチ
+
+        Returns:
+            tuple[int, int]: 登録に成功したドキュメント数と、失敗したドキュメント数
+        """
+        succeeded = 0
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(30, 2**attempt)))
+            try:
+                results = self.search_client.upload_documents(documents=pending)
+            except HttpResponseError as e:
+                # リクエストが大きすぎる場合は、バッチを半分に分けて登録する
+                if e.status_code == 413 and len(pending) > 1:
+                    half = len(pending) // 2
+                    first, second = self._upload_with_retry(pending[:half]), self._upload_with_retry(pending[half:])
+                    return succeeded + first[0] + second[0], first[1] + second[1]
+                if e.status_code in THROTTLING_STATUS_CODES:
+                    self.concurrency.on_throttle()
+                    continue
+                raise
+
+            # リトライで成功する可能性がある失敗のみ、そのドキュメントを再送する
+            retry_keys = set()
+            for result in results:
+                if result.succeeded:
+                    succeeded += 1
+                elif result.status_code in RETRIABLE_STATUS_CODES:
+                    retry_keys.add(result.key)
+                else:
+                    logger.error(f"failed to index document: key={result.key}, status={result.status_code}, error={result.error_message}")
+            if any(r.status_code in THROTTLING_STATUS_CODES for r in results if not r.succeeded):
+                self.concurrency.on_throttle()
+            else:
+                self.concurrency.on_success()
+
+            pending = [d for d in pending if d[self.key_field] in retry_keys]
+            if not pending:
+                break
+
+        if pending:
+            logger.error(f"failed to index documents after retries: keys={[d[self.key_field] for d in pending][:10]}, count={len(pending)}")
+        return succeeded, len(batch) - succeeded
+
+
+def batch_by_size(docs: Iterable[dict], max_bytes: int, max_documents: int = MAX_BATCH_DOCUMENTS) -> Iterator[list[dict]]:
+    """
+    ドキュメントを、JSON にした際のバイト数とドキュメント数の上限に収まるバッチに区切る
+
+    Args:
+        docs (Iterable[dict]): ドキュメント
+        max_bytes (int): 1つのバッチのバイト数の上限
+        max_documents (int): 1つのバッチのドキュメント数の上限
+
+    Returns:
+        Iterator[list[dict]]: ドキュメントのバッチ
+    """
+    batch, batch_bytes = [], 0
+    for doc in docs:
+        size = len(json.dumps(doc, ensure_ascii=False).encode("utf-8"))
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_documents):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    """
+    JSON Lines 形式のファイルからドキュメントを1件ずつ読み込む
+
+    Args:
+        path (str): ファイルパス
+
+    Returns:
+        Iterator[dict]: ドキュメント
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
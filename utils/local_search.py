@@ -0,0 +1,430 @@
+import os
+import json
+import mmap
+import asyncio
+import numpy as np
+from collections import Counter
+from openai import AzureOpenAI
+from utils.search import SearchResults, normalize_query
+
+# ローカルのベクトルインデックスを構成するファイル
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.f32"  # 正規化した埋め込みベクトル (float32, ドキュメント数 x 次元数)
+DOCUMENTS_FILE = "documents.jsonl"  # ドキュメント (ベクトル以外のフィールド) を1行1件の JSON で格納する
+DOCUMENTS_INDEX_FILE = "documents.idx"  # documents.jsonl の各行の開始位置 (int64, ドキュメント数 + 1)
+KEYS_FILE = "keys.json"  # ドキュメントのキー -> ドキュメント番号
+TERMS_FILE = "terms.json"  # キーワード検索の検索語 -> postings.i32 内の [開始位置, 件数]
+POSTINGS_FILE = "postings.i32"  # 検索語ごとの (ドキュメント番号, 出現回数) の組 (int32, 検索語の出現数の合計 x 2)
+
+# ハイブリッド検索で、ベクトル検索とキーワード検索の順位を統合する際の定数 (Reciprocal Rank Fusion)
+RRF_K = 60
+
+# ハイブリッド検索で、それぞれの検索から統合の候補とする件数の下限
+HYBRID_CANDIDATES = 50
+
+
+class UnsupportedSearchOperation(Exception):
+    """
+    ローカルのインデックスが対応していない操作 (フィルタ条件を指定した検索) を要求された場合の例外
+    """
+
+
+class LocalVectorSearchClient:
+    """
+    メモリマップしたファイルから埋め込みベクトルとドキュメントを読み込み、NumPy で検索するローカルの検索クライアント
+    AzureSearchClient と同じ検索のインターフェース (SearchBackend) を持ち、ネットワークを経由せずに検索できる
+    ファイルは deploy/export_local_index.py で作成する
+
+    次の操作には対応していない
+    - インデックスの作成・更新・削除 (メソッドを持たない。deploy/export_local_index.py でファイルを作成し直し、
+      ファイルは起動時に開くため、アプリケーションを再起動する)
+    - フィルタ条件を指定した検索 (UnsupportedSearchOperation を送出する)
+
+    検索クエリのベクトル化には Azure OpenAI Service を使用し、設定されていない場合はキーワード検索のみを行う
+    """
+
+    def __init__(self, index_dir: str = None):
+        self.index_dir = index_dir or os.getenv("LOCAL_SEARCH_INDEX_DIR", "local_index")
+        with open(os.path.join(self.index_dir, MANIFEST_FILE), "r") as f:
+            self.manifest = json.load(f)
+        if not os.path.exists(os.path.join(self.index_dir, TERMS_FILE)):
+            raise FileNotFoundError(f"Keyword index not found in {self.index_dir}: re-run deploy/export_local_index.py")
+        self.index_name = self.manifest["index_name"]
+        self.results = SearchResults(self.index_name)
+
+        # ファイルはメモリマップで開き、必要な部分のみを OS がページ単位で読み込む
+        count, dimensions = self.manifest["count"], self.manifest["dimensions"]
+        self.vectors = np.memmap(os.path.join(self.index_dir, VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, dimensions))
+        self.documents = _open_mmap(os.path.join(self.index_dir, DOCUMENTS_FILE))
+        self.document_offsets = np.fromfile(os.path.join(self.index_dir, DOCUMENTS_INDEX_FILE), dtype=np.int64)
+
+        # キーワード検索の転置インデックスと、キーからドキュメント番号を引くための対応表は、起動時に読み込む
+        with open(os.path.join(self.index_dir, TERMS_FILE), "r", encoding="utf-8") as f:
+            self.terms = json.load(f)
+        with open(os.path.join(self.index_dir, KEYS_FILE), "r", encoding="utf-8") as f:
+            self.keys = json.load(f)
+        postings_path = os.path.join(self.index_dir, POSTINGS_FILE)
+        if os.path.getsize(postings_path) > 0:
+            self.postings = np.memmap(postings_path, dtype=np.int32, mode="r").reshape(-1, 2)
+        else:
+            self.postings = np.zeros((0, 2), dtype=np.int32)
+
+        self.embedding_client = EmbeddingClient() if os.getenv("OPENAI_ENDPOINT") else None
+
+    def search(
+        self,
+        query: str = None,
+        query_vector: list[float] = None,
+        top: int = 10,
+        skip: int = 0,
+        filter: str = None,
+        select: list[str] = None,
+    ) -> list[dict]:
+        """
+        ローカルのインデックスでドキュメント検索を実行する
+        ベクトル検索とキーワード検索の両方が可能な場合は、順位を Reciprocal Rank Fusion で統合する (ハイブリッド検索)
+
+        Args:
+            query (str): 検索クエリ
+            query_vector (list[float]): 検索ベクトル
+            top (int): 取得する検索結果の最大数
+            skip (int): 検索結果のオフセット
+            filter (str): フィルタ条件 (ローカルのインデックスでは未対応)
+            select (list[str]): 取得するフィールド (省略した場合は AI_SEARCH_SELECT_FIELDS のフィールド)
+
+        Returns:
+            list[dict]: 検索結果のドキュメント一覧
+
+        Raises:
+            UnsupportedSearchOperation: フィルタ条件を指定した場合
+        """
+        if filter:
+            raise UnsupportedSearchOperation("filter is not supported by the local search index")
+
+        key = self.results.get_cache_key(query, query_vector, top, skip, filter, select)
+        cached = self.results.get_cached(key)
+        if cached is not None:
+            return cached
+
+        generation = self.results.generation
+        if query_vector is None and query and self.embedding_client:
+            query_vector = self.embedding_client.embed([query])[0]
+
+        # ベクトル検索とキーワード検索の結果 (ドキュメント番号, スコア) を取得する
+        count = top + skip
+        candidates = max(count, HYBRID_CANDIDATES)
+        rankings = []
+        if query_vector is not None:
+            rankings.append(self._search_vector(query_vector, candidates))
+        if query:
+            rankings.append(self._search_keyword(query, candidates))
+
+        if len(rankings) == 2:
+            ranked = fuse_rankings(rankings)
+        else:
+            ranked = rankings[0] if rankings else []
+
+        fields = select or self.results.select_fields
+        docs = []
+        for index, score in ranked[skip:count]:
+            doc = self._get_document(index)
+            doc = {name: doc[name] for name in fields if name in doc} if fields else doc
+            docs.append({**doc, "@search.score": float(score)})
+
+        self.results.set_cached(key, docs, generation)
+        return docs
+
+    async def search_async(
+        self,
+        query: str = None,
+        query_vector: list[float] = None,
+        top: int = 10,
+        skip: int = 0,
+        filter: str = None,
+        select: list[str] = None,
+    ) -> list[dict]:
+        """
+        ローカルのインデックスでドキュメント検索を実行する (非同期版、検索はスレッドで行う)
+        """
+        return await asyncio.to_thread(self.search, query, query_vector, top, skip, filter, select)
+
+    async def close_async(self):
+        """
+        ローカルのインデックスには閉じる接続がないため、何もしない
+        """
+
+    def invalidate_cache(self):
+        """
+        検索結果のキャッシュをすべて破棄する
+        """
+        self.results.invalidate()
+
+    def to_tool_documents(self, docs: list[dict]) -> list[dict]:
+        """
+        検索結果を、ツールの実行結果としてプロンプトに含める形に整形する (SearchResults.to_tool_documents を参照)
+        """
+        return self.results.to_tool_documents(docs)
+
+    def get_document(self, key: str) -> dict | None:
+        """
+        指定したキーのドキュメントを取得する
+
+        Args:
+            key (str): ドキュメントのキー
+
+        Returns:
+            dict: ドキュメント (存在しない場合は None を返す)
+        """
+        index = self.keys.get(key)
+        return self._get_document(index) if index is not None else None
+
+    def _search_vector(self, query_vector: list[float], count: int) -> list[tuple[int, float]]:
+        """
+        コサイン類似度が高い順にドキュメント番号を取得する (ベクトルは正規化済みのため内積で計算する)
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self.vectors @ query
+        return _top_k(scores, count)
+
+    def _search_keyword(self, query: str, count: int) -> list[tuple[int, float]]:
+        """
+        検索語の出現回数と IDF (出現するドキュメント数の逆数) から算出したスコアが高い順に、ドキュメント番号を取得する
+        検索語ごとの出現回数は、作成時に集計した転置インデックスから読み込む
+        """
+        doc_count = self.manifest["count"]
+        scores = np.zeros(doc_count, dtype=np.float32)
+        for term in tokenize(query):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            start, length = entry
+            postings = self.postings[start : start + length]
+            idf = np.log(doc_count / (length + 1)) + 1
+            scores[postings[:, 0]] += np.log1p(postings[:, 1]) * idf
+        ranked = _top_k(scores, count)
+        return [(index, score) for index, score in ranked if score > 0]
+
+    def _get_document(self, index: int) -> dict:
+        """
+        ドキュメント番号からドキュメントを取得する
+        """
+        start, end = self.document_offsets[index], self.document_offsets[index + 1]
+        return json.loads(self.documents[start:end])
+
+
+class LocalIndexWriter:
+    """
+    ローカルのベクトルインデックスのファイルを作成する
+    ドキュメントとベクトルは1件ずつ追記し、キーワード検索の転置インデックスとキーの対応表のみを最後までメモリに保持する
+    """
+
+    def __init__(self, index_dir: str, definition: dict, index_name: str = None):
+        """
+        Args:
+            index_dir (str): ファイルを作成するディレクトリ
+            definition (dict): インデックス定義 (deploy/search_index.json の形式)
+            index_name (str): インデックス名
+        """
+        self.index_dir = index_dir
+        self.fields = get_index_fields(definition)
+        self.index_name = index_name or definition.get("name") or os.getenv("AI_SEARCH_INDEX_NAME")
+        self.count = 0
+        os.makedirs(index_dir, exist_ok=True)
+        self.vectors = open(os.path.join(index_dir, VECTORS_FILE), "wb")
+        self.documents = open(os.path.join(index_dir, DOCUMENTS_FILE), "wb")
+        self.document_offsets = [0]
+        self.keys = {}
+        self.postings = {}  # 検索語 -> [(ドキュメント番号, 出現回数)]
+
+    def add(self, doc: dict, vector: list[float]):
+        """
+        ドキュメントと埋め込みベクトルを追加する
+
+        Args:
+            doc (dict): ドキュメント
+            vector (list[float]): 埋め込みベクトル
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (self.fields["dimensions"],):
+            raise ValueError(f"Invalid vector dimensions: {vector.shape}, expected: {self.fields['dimensions']}")
+        vector /= np.linalg.norm(vector) or 1.0
+        self.vectors.write(vector.tobytes())
+
+        doc = {name: doc[name] for name in self.fields["retrievable"] if name in doc}
+        line = json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.documents.write(line)
+        self.document_offsets.append(self.document_offsets[-1] + len(line))
+
+        if doc.get(self.fields["key"]) is not None:
+            self.keys[str(doc[self.fields["key"]])] = self.count
+
+        text = " ".join(str(doc.get(name) or "") for name in self.fields["searchable"])
+        for term, count in Counter(split_terms(text, unigrams=True)).items():
+            self.postings.setdefault(term, []).append((self.count, count))
+        self.count += 1
+
+    def close(self) -> dict:
+        """
+        ファイルを閉じて、インデックスの情報 (manifest.json) を書き込む
+
+        Returns:
+            dict: インデックスの情報
+        """
+        for f in (self.vectors, self.documents):
+            f.close()
+        np.asarray(self.document_offsets, dtype=np.int64).tofile(os.path.join(self.index_dir, DOCUMENTS_INDEX_FILE))
+        with open(os.path.join(self.index_dir, KEYS_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.keys, f, ensure_ascii=False)
+
+        # 検索語ごとの出現回数を1つのファイルに連結し、検索語からその範囲を引く辞書を書き込む
+        terms, start = {}, 0
+        with open(os.path.join(self.index_dir, POSTINGS_FILE), "wb") as f:
+            for term, postings in self.postings.items():
+                f.write(np.asarray(postings, dtype=np.int32).tobytes())
+                terms[term] = [start, len(postings)]
+                start += len(postings)
+        with open(os.path.join(self.index_dir, TERMS_FILE), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        manifest = {
+            "index_name": self.index_name,
+            "key_field": self.fields["key"],
+            "vector_field": self.fields["vector"],
+            "source_field": self.fields["source"],
+            "dimensions": self.fields["dimensions"],
+            "count": self.count,
+            "fields": self.fields["retrievable"],
+        }
+        with open(os.path.join(self.index_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+
+
+class EmbeddingClient:
+    """
+    Azure OpenAI Service でテキストの埋め込みベクトルを生成する (インデックスのベクトル化と同じモデルを使用する)
+    """
+
+    def __init__(self):
+        self.client = AzureOpenAI(
+            azure_endpoint=os.environ.get("OPENAI_ENDPOINT"),
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            api_version=os.environ.get("OPENAI_API_VERSION", "2024-05-01-preview"),
+        )
+        self.model_name = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
+        self.dimensions = int(os.environ.get("OPENAI_EMBEDDING_DIMENSIONS", 0)) or None
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """
+        テキストの埋め込みベクトルを生成する
+
+        Args:
+            texts (list[str]): テキストのリスト
+
+        Returns:
+            list[list[float]]: 埋め込みベクトルのリスト
+        """
+        params = {"dimensions": self.dimensions} if self.dimensions else {}
+        resp = self.client.embeddings.create(model=self.model_name, input=texts, **params)
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+
+def get_index_fields(definition: dict) -> dict:
+    """
+    インデックス定義から、キー・ベクトル・取得可能・検索可能なフィールドを取得する
+    ベクトルのフィールドの元になるテキストのフィールドは、名前の末尾の "Vector" を除いたもの (例: contentVector -> content) とする
+
+    Args:
+        definition (dict): インデックス定義
+
+    Returns:
+        dict: フィールドの情報
+    """
+    fields = definition["fields"]
+    vector = next(f for f in fields if f["type"] == "Collection(Edm.Single)")
+    names = [f["name"] for f in fields]
+    source = vector["name"][: -len("Vector")] if vector["name"].endswith("Vector") else None
+    return {
+        "key": next(f["name"] for f in fields if f.get("key")),
+        "vector": vector["name"],
+        "source": source if source in names else None,
+        "dimensions": vector["dimensions"],
+        "retrievable": [f["name"] for f in fields if f["type"] != "Collection(Edm.Single)" and f.get("retrievable", True)],
+        "searchable": [f["name"] for f in fields if f["type"] == "Edm.String" and f.get("searchable") and not f.get("key")],
+    }
+
+
+def tokenize(query: str) -> list[str]:
+    """
+    検索クエリをキーワード検索の検索語に分割する (重複は除く)
+
+    Args:
+        query (str): 検索クエリ
+
+    Returns:
+        list[str]: 検索語のリスト
+    """
+    return list(dict.fromkeys(split_terms(query)))
+
+
+def split_terms(text: str, unigrams: bool = False) -> list[str]:
+    """
+    テキストを正規化して検索語に分割する
+    空白で区切り、英数字以外 (日本語等) を含む語は2文字ずつの組 (bigram) に分割する
+
+    Args:
+        text (str): テキスト
+        unigrams (bool): 英数字以外を含む語の1文字ずつの語も含めるか
+                         (ドキュメントの転置インデックスを作成する際に指定し、2文字以下の検索語にも一致させる)
+
+    Returns:
+        list[str]: 検索語のリスト (出現順, 重複を含む)
+    """
+    terms = []
+    for word in normalize_query(text).split():
+        if word.isascii() or len(word) <= 2:
+            terms.append(word)
+        else:
+            terms += [word[i : i + 2] for i in range(len(word) - 1)]
+        if unigrams and not word.isascii() and len(word) > 1:
+            terms += list(word)
+    return terms
+
+
+def fuse_rankings(rankings: list[list[tuple[int, float]]]) -> list[tuple[int, float]]:
+    """
+    複数の検索結果の順位を Reciprocal Rank Fusion で統合する
+
+    Args:
+        rankings (list[list[tuple[int, float]]]): 検索結果 (ドキュメント番号, スコア) のリスト
+
+    Returns:
+        list[tuple[int, float]]: 統合した検索結果 (ドキュメント番号, スコア)
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, (index, _) in enumerate(ranking):
+            scores[index] = scores.get(index, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def _top_k(scores: np.ndarray, count: int) -> list[tuple[int, float]]:
+    """
+    スコアが高い順に、上位のドキュメント番号とスコアを取得する (全体をソートせずに上位のみを選ぶ)
+    """
+    count = min(count, len(scores))
+    if count == 0:
+        return []
+    indexes = np.argpartition(-scores, count - 1)[:count]
+    indexes = indexes[np.argsort(-scores[indexes])]
+    return [(int(i), float(scores[i])) for i in indexes]
+
+
+def _open_mmap(path: str) -> mmap.mmap | bytes:
+    """
+    ファイルを読み取り専用でメモリマップする (空のファイルはメモリマップできないため、空のバイト列を返す)
+    """
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
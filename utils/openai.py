@@ -1,7 +1,11 @@
 import os
-import json
 from openai import AzureOpenAI
 from utils.openai_tools import OpenAITools
+from utils.openai_stream import CompletionStreamAssembler
+from utils.openai_router import OpenAIRouter
+from utils.context import ContextBuilder, add_completion_usage, log_context_usage
+from utils.cancel import CancelToken
+from utils.timing import TurnTimer
 
 
 class OpenAIClient:
@@ -17,109 +21,140 @@ class OpenAIClient:
         self.chat_model_name = os.environ.get("OPENAI_CHAT_MODEL", "gpt-4o")
         self.temperature = float(os.environ.get("OPENAI_TEMPERATURE", 0.0))
         self.max_tokens = int(os.environ.get("OPENAI_MAX_TOKENS", 4096))
+        self.embedding_model_name = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
+        self.embedding_dimensions = int(os.environ.get("OPENAI_EMBEDDING_DIMENSIONS", 0)) or None
+
+        # ストリームの最後にトークン数 (プロンプトキャッシュから読み込んだトークン数を含む) を返すよう指定するか
+        # (API バージョン 2024-09-01-preview 以降で指定できる)
+        self.stream_include_usage = os.environ.get("OPENAI_STREAM_INCLUDE_USAGE", "false").lower() == "true"
+
+        # Chat Completion API のリクエストを複数のデプロイに振り分けるルータを初期化 (OPENAI_ENDPOINTS を参照)
+        self.router = OpenAIRouter()
 
         # Function Calling 用のツールを初期化
         self.tools = OpenAITools()
 
-    def get_completion_with_tools(self, messages: list[dict]) -> any:
+        # 入力トークン数の上限に収まるようにメッセージを組み立てるクラスを初期化
+        self.context = ContextBuilder(self.tools.tools_definition)
+
+    def get_completion(self, messages: list[dict], max_tokens: int = None) -> str:
         """
-        Azure OpenAI Service で回答を生成する (Function Calling 対応)
+        Azure OpenAI Service で回答を生成する (ストリーム形式ではなく、ツールも使用しない)
 
         Args:
             messages (list[dict]): チャットメッセージのリスト
-            system_message (str): システムメッセージ
+            max_tokens (int): 生成するトークン数の上限
+
+        Returns:
+            str: 生成された回答
         """
+        resp = self.router.create_chat_completion(
+            messages=messages,
+            max_tokens=max_tokens or self.max_tokens,
+            temperature=self.temperature,
+        )
+        return resp.choices[0].message.content
+
+    def get_embedding(self, text: str) -> list[float]:
+        """
+        Azure OpenAI Service でテキストの埋め込みベクトルを生成する
+
+        Args:
+            text (str): テキスト
+
+        Returns:
+            list[float]: 埋め込みベクトル
+        """
+        params = {"dimensions": self.embedding_dimensions} if self.embedding_dimensions else {}
+        resp = self.client.embeddings.create(model=self.embedding_model_name, input=text, **params)
+        return resp.data[0].embedding
+
+    def get_completion_with_tools(self, messages: list[dict], usage: dict = None, cancel_token: CancelToken = None, timer: TurnTimer = None) -> any:
+        """
+        Azure OpenAI Service で回答を生成する (Function Calling 対応)
+        途中で閉じられた場合 (クライアントの切断や中止) は、上流のストリームを閉じて実行中のツール呼び出しを取り消す
+
+        Args:
+            messages (list[dict]): チャットメッセージのリスト (ツール呼び出しとその実行結果を末尾に追加する)
+            usage (dict): ContextBuilder.build が返した構成要素ごとのトークン数 (ツールの実行結果の分を加算する)
+            cancel_token (CancelToken): 回答の生成を中止するためのトークン (ツールの実行結果を待っている間も中止できる)
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス (LLM のリクエストとツール呼び出しごとに記録する)
+        """
+        timer = timer or TurnTimer(enabled=False)
+
+        # 送信するメッセージ (予算に収まるように会話履歴を除く場合があるため、呼び出し元のリストとは分けて保持する)
+        # 呼び出し元のリストには、ツール呼び出しのループで追加したメッセージのみを末尾に追加する
+        request_messages = list(messages)
         while True:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
 
             # Azure OpenAI Service にリクエストを送信
-            resp = self.client.chat.completions.create(
-                model=self.chat_model_name,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                tools=self.tools.tools_definition,
-                tool_choice="auto" if len(self.tools.tools_definition) > 0 else None,
-                stream=True,
-            )
-
-            # Stream 形式で返される情報から、Completion か Tool Calls かを判定して対応する
-            role = ""
-            tool_calls = []
-            is_tool_calling = False
-            for chunk in resp:
-
-                # 1つ目は選択肢(choices)がないのでスキップ
-                if not chunk.choices:
-                    continue
-
-                # choice を1つに絞る
-                choice = chunk.choices[0]
-
-                # ロールを取得
-                role = choice.delta.role if choice.delta.role else role
-
-                # ツール呼び出し(Function Calling)かどうかを判定
-                if choice.delta.tool_calls:
-                    is_tool_calling = True
-
-                # ツール呼び出しがある場合は、ツール呼び出しの内容を取得
-                if is_tool_calling:
-
-                    # 最後はツール呼び出し情報はない
-                    if not choice.delta.tool_calls:
-                        continue
-
-                    # ツール呼び出し情報を取得
-                    for tool_call in choice.delta.tool_calls:
-                        if tool_call.function.arguments:
-                            tool_calls[-1]["function"]["arguments"] += tool_call.function.arguments
-                        else:
-                            tool_calls.append(
-                                {
-                                    "id": tool_call.id,
-                                    "type": tool_call.type,
-                                    "function": {
-                                        "name": tool_call.function.name,
-                                        "arguments": "",
-                                    },
-                                }
-                            )
-
-                # ツール呼び出しでない場合は順次ユーザに返信
-                elif choice.delta.content:
-                    yield choice.delta.content
-
-            # ツール呼び出しの場合は、ツールを呼び出してその結果をメッセージに含める
-            if is_tool_calling:
-
-                messages.append(
-                    {
-                        "role": role,
-                        "tool_calls": [
-                            {
-                                "id": call["id"],
-                                "type": call["type"],
-                                "function": {"name": call["function"]["name"], "arguments": call["function"]["arguments"]},
-                            }
-                            for call in tool_calls
-                        ],
-                    }
+            round_timer = timer.start_llm_round()
+            try:
+                resp = self.router.create_chat_completion(
+                    messages=request_messages,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    tools=self.tools.tools_definition,
+                    tool_choice="auto" if len(self.tools.tools_definition) > 0 else None,
+                    stream=True,
+                    **self._get_stream_options(),
                 )
+            except BaseException as e:
+                round_timer.end(error=e)
+                raise
 
-                # 関数呼び出しを行う
-                for tool_call in tool_calls:
-                    func_name = tool_call["function"]["name"]
-                    func_args = json.loads(tool_call["function"]["arguments"])
-                    func_response = eval(f"self.tools.{func_name}(**func_args)")
-                    messages.append(
-                        {
-                            "tool_call_id": tool_call["id"],
-                            "role": "tool",
-                            "name": func_name,
-                            "content": func_response,
-                        }
-                    )
+            # Stream 形式で返される情報から、Completion か Tool Calls かを判定して対応する
+            # 引数が揃ったツール呼び出しは、ストリームの受信中でも先に開始する
+            assembler = CompletionStreamAssembler()
+            pending = {}
+            error = None
+            try:
+                for chunk in resp:
+                    content = assembler.feed(chunk)
+                    round_timer.on_chunk(content, assembler.is_tool_calling)
+                    if content:
+                        yield content
+                    for tool_call in assembler.pop_completed_tool_calls():
+                        pending[tool_call["id"]] = self.tools.submit_tool_call(tool_call, timer)
+                round_timer.end(assembler.usage, len(assembler.tool_calls))
+
+                # ツール呼び出しの場合は、ツールを呼び出してその結果をメッセージに含める
+                if assembler.is_tool_calling:
+                    tool_calls = assembler.get_tool_calls()
+                    assistant_message = assembler.to_assistant_message()
+                    messages.append(assistant_message)
+                    request_messages.append(assistant_message)
+
+                    # 関数呼び出しを並列に行い、呼び出し順に結果を予算に収まるように圧縮してメッセージに含める
+                    with timer.stage("tools", iteration=round_timer.index):
+                        results = self.tools.run_tool_calls(tool_calls, pending, cancel_token, timer)
+                    request_messages, results = self.context.fit_tool_results(request_messages, results, usage)
+                    messages.extend(results)
+                    request_messages.extend(results)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                resp.close()
+                self.tools.cancel_tool_calls(pending)
+                round_timer.end(assembler.usage, len(assembler.tool_calls), error)
+
+            if usage is not None and assembler.usage:
+                add_completion_usage(usage, assembler.usage)
 
             # 一連のチャット処理が終わったら終了
-            else:
+            if not assembler.is_tool_calling:
+                if usage:
+                    log_context_usage(usage)
                 break
+
+    def _get_stream_options(self) -> dict:
+        """
+        ストリームの最後にトークン数を返すよう指定するパラメータを取得する
+        (使用している openai パッケージには stream_options の引数がないため、extra_body で指定する)
+        """
+        if not self.stream_include_usage:
+            return {}
+        return {"extra_body": {"stream_options": {"include_usage": True}}}
@@ -0,0 +1,167 @@
+import os
+from openai import AsyncAzureOpenAI
+from utils.openai_tools import OpenAITools
+from utils.openai_stream import CompletionStreamAssembler
+from utils.openai_router import AsyncOpenAIRouter
+from utils.context import ContextBuilder, add_completion_usage, log_context_usage
+from utils.cancel import CancelToken
+from utils.timing import TurnTimer
+
+
+class AsyncOpenAIClient:
+
+    def __init__(self):
+        self.client = AsyncAzureOpenAI(
+            azure_endpoint=os.environ.get("OPENAI_ENDPOINT"),
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            api_version=os.environ.get("OPENAI_API_VERSION", "2024-05-01-preview"),
+        )
+
+        # 各種設定値を環境変数から取得
+        self.chat_model_name = os.environ.get("OPENAI_CHAT_MODEL", "gpt-4o")
+        self.temperature = float(os.environ.get("OPENAI_TEMPERATURE", 0.0))
+        self.max_tokens = int(os.environ.get("OPENAI_MAX_TOKENS", 4096))
+        self.embedding_model_name = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
+        self.embedding_dimensions = int(os.environ.get("OPENAI_EMBEDDING_DIMENSIONS", 0)) or None
+
+        # ストリームの最後にトークン数 (プロンプトキャッシュから読み込んだトークン数を含む) を返すよう指定するか
+        # (API バージョン 2024-09-01-preview 以降で指定できる)
+        self.stream_include_usage = os.environ.get("OPENAI_STREAM_INCLUDE_USAGE", "false").lower() == "true"
+
+        # Chat Completion API のリクエストを複数のデプロイに振り分けるルータを初期化 (OPENAI_ENDPOINTS を参照)
+        self.router = AsyncOpenAIRouter()
+
+        # Function Calling 用のツールを初期化
+        self.tools = OpenAITools()
+
+        # 入力トークン数の上限に収まるようにメッセージを組み立てるクラスを初期化
+        self.context = ContextBuilder(self.tools.tools_definition)
+
+    async def close(self):
+        """
+        クライアントが保持している接続を閉じる
+        """
+        await self.client.close()
+        await self.router.close()
+        await self.tools.close_async()
+
+    async def get_completion(self, messages: list[dict], max_tokens: int = None) -> str:
+        """
+        Azure OpenAI Service で回答を生成する (ストリーム形式ではなく、ツールも使用しない、非同期版)
+
+        Args:
+            messages (list[dict]): チャットメッセージのリスト
+            max_tokens (int): 生成するトークン数の上限
+
+        Returns:
+            str: 生成された回答
+        """
+        resp = await self.router.create_chat_completion(
+            messages=messages,
+            max_tokens=max_tokens or self.max_tokens,
+            temperature=self.temperature,
+        )
+        return resp.choices[0].message.content
+
+    async def get_embedding(self, text: str) -> list[float]:
+        """
+        Azure OpenAI Service でテキストの埋め込みベクトルを生成する (非同期版)
+
+        Args:
+            text (str): テキスト
+
+        Returns:
+            list[float]: 埋め込みベクトル
+        """
+        params = {"dimensions": self.embedding_dimensions} if self.embedding_dimensions else {}
+        resp = await self.client.embeddings.create(model=self.embedding_model_name, input=text, **params)
+        return resp.data[0].embedding
+
+    async def get_completion_with_tools(self, messages: list[dict], usage: dict = None, cancel_token: CancelToken = None, timer: TurnTimer = None):
+        """
+        Azure OpenAI Service で回答を生成する (Function Calling 対応, 非同期版)
+        途中で閉じられた場合 (クライアントの切断や中止) は、上流のストリームを閉じて実行中のツール呼び出しを取り消す
+
+        Args:
+            messages (list[dict]): チャットメッセージのリスト (ツール呼び出しとその実行結果を末尾に追加する)
+            usage (dict): ContextBuilder.build が返した構成要素ごとのトークン数 (ツールの実行結果の分を加算する)
+            cancel_token (CancelToken): 回答の生成を中止するためのトークン (ツールの実行結果を待っている間も中止できる)
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス (LLM のリクエストとツール呼び出しごとに記録する)
+        """
+        timer = timer or TurnTimer(enabled=False)
+
+        # 送信するメッセージ (予算に収まるように会話履歴を除く場合があるため、呼び出し元のリストとは分けて保持する)
+        # 呼び出し元のリストには、ツール呼び出しのループで追加したメッセージのみを末尾に追加する
+        request_messages = list(messages)
+        while True:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+
+            # Azure OpenAI Service にリクエストを送信
+            round_timer = timer.start_llm_round()
+            try:
+                resp = await self.router.create_chat_completion(
+                    messages=request_messages,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    tools=self.tools.tools_definition,
+                    tool_choice="auto" if len(self.tools.tools_definition) > 0 else None,
+                    stream=True,
+                    **self._get_stream_options(),
+                )
+            except BaseException as e:
+                round_timer.end(error=e)
+                raise
+
+            # Stream 形式で返される情報から、Completion か Tool Calls かを判定して対応する
+            # 引数が揃ったツール呼び出しは、ストリームの受信中でも先に開始する
+            assembler = CompletionStreamAssembler()
+            pending = {}
+            error = None
+            try:
+                async for chunk in resp:
+                    content = assembler.feed(chunk)
+                    round_timer.on_chunk(content, assembler.is_tool_calling)
+                    if content:
+                        yield content
+                    for tool_call in assembler.pop_completed_tool_calls():
+                        pending[tool_call["id"]] = self.tools.start_tool_call_async(tool_call, timer)
+                round_timer.end(assembler.usage, len(assembler.tool_calls))
+
+                # ツール呼び出しの場合は、ツールを並列に呼び出して、呼び出し順に結果をメッセージに含める
+                if assembler.is_tool_calling:
+                    tool_calls = assembler.get_tool_calls()
+                    assistant_message = assembler.to_assistant_message()
+                    messages.append(assistant_message)
+                    request_messages.append(assistant_message)
+                    with timer.stage("tools", iteration=round_timer.index):
+                        results = await self.tools.run_tool_calls_async(tool_calls, pending, cancel_token, timer)
+                    request_messages, results = self.context.fit_tool_results(request_messages, results, usage)
+                    messages.extend(results)
+                    request_messages.extend(results)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                await resp.aclose()
+                for task in pending.values():
+                    task.cancel()
+                round_timer.end(assembler.usage, len(assembler.tool_calls), error)
+
+            if usage is not None and assembler.usage:
+                add_completion_usage(usage, assembler.usage)
+
+            # 一連のチャット処理が終わったら終了
+            if not assembler.is_tool_calling:
+                if usage:
+                    log_context_usage(usage)
+                break
+
+    def _get_stream_options(self) -> dict:
+        """
+        ストリームの最後にトークン数を返すよう指定するパラメータを取得する
+        (使用している openai パッケージには stream_options の引数がないため、extra_body で指定する)
+        """
+        if not self.stream_include_usage:
+            return {}
+        return {"extra_body": {"stream_options": {"include_usage": True}}}
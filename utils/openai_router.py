@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import asyncio
+import random
+import threading
+import openai
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from utils.logger import logger
+
+# 応答のヘッダーが示すレート制限の残量 (Azure OpenAI Service が返すヘッダー名)
+REMAINING_REQUESTS_HEADER = "x-ratelimit-remaining-requests"
+REMAINING_TOKENS_HEADER = "x-ratelimit-remaining-tokens"
+
+# retry-after ヘッダーがない 429 の場合に、デプロイを使用しない時間(秒)
+DEFAULT_THROTTLE_SECONDS = 10
+
+# 別のデプロイへ切り替える対象のエラー (レート制限、サーバエラー、接続エラー)
+FAILOVER_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+# すべてのデプロイで失敗した場合に、リトライするまでの待ち時間(秒)の初期値と上限 (openai の SDK と同じ指数バックオフ)
+INITIAL_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 8.0
+
+
+class OpenAIDeployment:
+    """
+    Azure OpenAI Service のデプロイ (エンドポイントとモデル) と、その混雑状況
+    """
+
+    def __init__(self, endpoint: str, api_key: str, model: str, weight: float = 1.0, api_version: str = None, name: str = None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.model = model
+        self.weight = weight
+        self.api_version = api_version or os.environ.get("OPENAI_API_VERSION", "2024-05-01-preview")
+        self.name = name or f"{endpoint}#{model}"
+
+        # 混雑状況 (応答のヘッダーから更新する)
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.max_remaining_requests = None
+        self.max_remaining_tokens = None
+        self.throttled_until = 0.0
+        self.in_flight = 0
+
+    def create_client(self) -> AzureOpenAI:
+        # 429 の場合は SDK で同じデプロイにリトライせず、ルータが別のデプロイへ切り替える
+        # (すべてのデプロイで失敗した場合は、ルータが retry-after の時間だけ待ってリトライする)
+        return AzureOpenAI(azure_endpoint=self.endpoint, api_key=self.api_key, api_version=self.api_version, max_retries=0)
+
+    def create_async_client(self) -> AsyncAzureOpenAI:
+        return AsyncAzureOpenAI(azure_endpoint=self.endpoint, api_key=self.api_key, api_version=self.api_version, max_retries=0)
+
+    def is_throttled(self, now: float) -> bool:
+        return self.throttled_until > now
+
+    def get_score(self) -> float:
+        """
+        新しいリクエストを割り当てる優先度を取得する
+        重みに、レート制限の残量の割合 (これまでに観測した最大値との比) を掛け、処理中のリクエスト数で割る
+        """
+        headroom = 1.0
+        if self.remaining_requests is not None and self.max_remaining_requests:
+            headroom = min(headroom, self.remaining_requests / self.max_remaining_requests)
+        if self.remaining_tokens is not None and self.max_remaining_tokens:
+            headroom = min(headroom, self.remaining_tokens / self.max_remaining_tokens)
+        return self.weight * max(headroom, 0.01) / (1 + self.in_flight)
+
+    def update_from_headers(self, headers):
+        """
+        応答のヘッダーから、レート制限の残量を更新する
+        """
+        remaining_requests = _to_int(headers.get(REMAINING_REQUESTS_HEADER))
+        if remaining_requests is not None:
+            self.remaining_requests = remaining_requests
+            self.max_remaining_requests = max(self.max_remaining_requests or 0, remaining_requests)
+        remaining_tokens = _to_int(headers.get(REMAINING_TOKENS_HEADER))
+        if remaining_tokens is not None:
+            self.remaining_tokens = remaining_tokens
+            self.max_remaining_tokens = max(self.max_remaining_tokens or 0, remaining_tokens)
+
+    def mark_throttled(self, headers):
+        """
+        429 を受け取った場合に、retry-after ヘッダーが示す時間だけデプロイを使用しないようにする
+        """
+        seconds = get_retry_after(headers)
+        self.throttled_until = time.monotonic() + seconds
+        self.remaining_requests = 0
+        logger.warning(f"openai deployment throttled: {self.name}, retry_after={seconds}")
+
+
+class OpenAIRouter:
+    """
+    複数の Azure OpenAI Service のデプロイに Chat Completion API のリクエストを振り分ける
+    レート制限の残量が多く処理中のリクエストが少ないデプロイを優先し、429 やサーバエラーの場合は
+    最初のチャンクを受け取る前に別のデプロイへ切り替える (回答の途中で切り替えることはない)
+    すべてのデプロイで失敗した場合は、最も早くレート制限が解除されるまで (retry-after) 待って、max_retries 回までリトライする
+    """
+
+    def __init__(self, deployments: list[OpenAIDeployment] = None, max_retries: int = None, max_retry_wait: float = None):
+        self.deployments = deployments or load_deployments()
+        self.clients = {d.name: d.create_client() for d in self.deployments}
+        self.lock = threading.Lock()
+        self._init_retry(max_retries, max_retry_wait)
+
+    def _init_retry(self, max_retries: int = None, max_retry_wait: float = None):
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("OPENAI_MAX_RETRIES", 2))
+        self.max_retry_wait = max_retry_wait if max_retry_wait is not None else float(os.environ.get("OPENAI_MAX_RETRY_WAIT", 30))
+
+    def create_chat_completion(self, **kwargs):
+        """
+        Chat Completion API を呼び出す (引数は openai の chat.completions.create と同じ、model はデプロイごとの値を使用する)
+
+        Returns:
+            ChatCompletion または (stream=True の場合) チャンクのイテレータ
+        """
+        tried = set()
+        retries = 0
+        while True:
+            deployment = self._choose(tried)
+            tried.add(deployment.name)
+            self._begin(deployment)
+            resp = None
+            try:
+                raw = self.clients[deployment.name].chat.completions.with_raw_response.create(**{**kwargs, "model": deployment.model})
+                deployment.update_from_headers(raw.headers)
+                resp = raw.parse()
+                if not kwargs.get("stream"):
+                    self._end(deployment)
+                    return resp
+
+                # 最初のチャンクを受け取るまでに失敗した場合も、別のデプロイへ切り替える
+                iterator = iter(resp)
+                first = next(iterator, None)
+                return self._iterate(deployment, resp, first, iterator)
+            except FAILOVER_ERRORS as e:
+                _close_stream(resp)
+                self._end(deployment)
+                self._on_error(deployment, e)
+                if len(tried) < len(self.deployments):
+                    continue
+
+                # すべてのデプロイで失敗した場合は、待ってからすべてのデプロイを対象にリトライする
+                delay = self._get_retry_delay(retries)
+                if delay is None:
+                    raise
+                retries += 1
+                tried.clear()
+                time.sleep(delay)
+            except BaseException:
+                _close_stream(resp)
+                self._end(deployment)
+                raise
+
+    def _iterate(self, deployment: OpenAIDeployment, resp, first, iterator):
+        try:
+            if first is not None:
+                yield first
+            yield from iterator
+        finally:
+            # 途中で閉じられた (回答の生成が中止された) 場合も、接続を閉じて上流の生成を止める
+            resp.close()
+            self._end(deployment)
+
+    def _choose(self, exclude: set) -> OpenAIDeployment:
+        """
+        リクエストを割り当てるデプロイを選ぶ
+        レート制限中でないデプロイから優先度が最も高いものを選び、すべてレート制限中の場合は最も早く解除されるものを選ぶ
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [d for d in self.deployments if d.name not in exclude]
+            available = [d for d in candidates if not d.is_throttled(now)]
+            if not available:
+                return min(candidates, key=lambda d: d.throttled_until)
+
+            # 優先度が同程度のデプロイには、偏らないようにランダムに割り当てる
+            best = max(d.get_score() for d in available)
+            return random.choice([d for d in available if d.get_score() >= best * 0.9])
+
+    def _begin(self, deployment: OpenAIDeployment):
+        with self.lock:
+            deployment.in_flight += 1
+
+    def _end(self, deployment: OpenAIDeployment):
+        with self.lock:
+            deployment.in_flight -= 1
+
+    def _get_retry_delay(self, retries: int) -> float | None:
+        """
+        すべてのデプロイで失敗した場合に、リトライするまでの待ち時間を取得する
+        最も早くレート制限が解除されるまでの時間と、指数バックオフの時間のうち長い方を待つ
+
+        Args:
+            retries (int): これまでにリトライした回数
+
+        Returns:
+            float | None: 待ち時間(秒) (リトライの回数の上限に達した場合や、待ち時間が上限を超える場合は None)
+        """
+        if retries >= self.max_retries:
+            return None
+        with self.lock:
+            throttled = min(d.throttled_until for d in self.deployments) - time.monotonic()
+        backoff = min(INITIAL_RETRY_DELAY * 2**retries, MAX_RETRY_DELAY) * random.uniform(0.75, 1.0)
+        delay = max(throttled, backoff)
+        if delay > self.max_retry_wait:
+            return None
+        logger.warning(f"all openai deployments failed, retrying in {delay:.1f}s (retry {retries + 1}/{self.max_retries})")
+        return delay
+
+    def _on_error(self, deployment: OpenAIDeployment, error: Exception):
+        response = getattr(error, "response", None)
+        headers = response.headers if response is not None else {}
+        if isinstance(error, openai.RateLimitError):
+            deployment.mark_throttled(headers)
+        else:
+            # サーバエラーや接続エラーの場合は、短時間だけ使用しない
+            deployment.throttled_until = time.monotonic() + 1
+            logger.warning(f"openai deployment failed: {deployment.name}, error={type(error).__name__}")
+
+
+class AsyncOpenAIRouter(OpenAIRouter):
+    """
+    OpenAIRouter の非同期版
+    """
+
+    def __init__(self, deployments: list[OpenAIDeployment] = None, max_retries: int = None, max_retry_wait: float = None):
+        self.deployments = deployments or load_deployments()
+        self.clients = {d.name: d.create_async_client() for d in self.deployments}
+        self.lock = threading.Lock()
+        self._init_retry(max_retries, max_retry_wait)
+
+    async def create_chat_completion(self, **kwargs):
+        """
+        Chat Completion API を呼び出す (非同期版)
+
+        Returns:
+            ChatCompletion または (stream=True の場合) チャンクの非同期イテレータ
+        """
+        tried = set()
+        retries = 0
+        while True:
+            deployment = self._choose(tried)
+            tried.add(deployment.name)
+            self._begin(deployment)
+            resp = None
+            try:
+                raw = await self.clients[deployment.name].chat.completions.with_raw_response.create(**{**kwargs, "model": deployment.model})
+                deployment.update_from_headers(raw.headers)
+                resp = raw.parse()
+                if not kwargs.get("stream"):
+                    self._end(deployment)
+                    return resp
+
+                # 最初のチャンクを受け取るまでに失敗した場合も、別のデプロイへ切り替える
+                iterator = resp.__aiter__()
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    first = None
+                return self._iterate_async(deployment, resp, first, iterator)
+            except FAILOVER_ERRORS as e:
+                await _close_stream_async(resp)
+                self._end(deployment)
+                self._on_error(deployment, e)
+                if len(tried) < len(self.deployments):
+                    continue
+
+                # すべてのデプロイで失敗した場合は、待ってからすべてのデプロイを対象にリトライする
+                delay = self._get_retry_delay(retries)
+                if delay is None:
+                    raise
+                retries += 1
+                tried.clear()
+                await asyncio.sleep(delay)
+            except BaseException:
+                await _close_stream_async(resp)
+                self._end(deployment)
+                raise
+
+    async def close(self):
+        """
+        クライアントが保持している接続を閉じる
+        """
+        for client in self.clients.values():
+            await client.close()
+
+    async def _iterate_async(self, deployment: OpenAIDeployment, resp, first, iterator):
+        try:
+            if first is not None:
+                yield first
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            await resp.close()
+            self._end(deployment)
+
+
+def load_deployments() -> list[OpenAIDeployment]:
+    """
+    環境変数から、リクエストを振り分けるデプロイの一覧を取得する
+    OPENAI_ENDPOINTS に JSON 形式で複数のデプロイを指定できる
+    (例: [{"endpoint": "https://xxx.openai.azure.com/", "api_key": "...", "model": "gpt-4o", "weight": 2}])
+    指定されていない場合は、OPENAI_ENDPOINT のデプロイのみを使用する
+
+    Returns:
+        list[OpenAIDeployment]: デプロイの一覧
+    """
+    model = os.environ.get("OPENAI_CHAT_MODEL", "gpt-4o")
+    endpoints = json.loads(os.environ.get("OPENAI_ENDPOINTS") or "[]")
+    if not endpoints:
+        return [OpenAIDeployment(os.environ.get("OPENAI_ENDPOINT"), os.environ.get("OPENAI_API_KEY"), model)]
+    return [
+        OpenAIDeployment(
+            endpoint=e["endpoint"],
+            api_key=e.get("api_key") or os.environ.get("OPENAI_API_KEY"),
+            model=e.get("model", model),
+            weight=float(e.get("weight", 1.0)),
+            api_version=e.get("api_version"),
+            name=e.get("name"),
+        )
+        for e in endpoints
+    ]
+
+
+def _close_stream(resp):
+    """
+    最初のチャンクを受け取る前に失敗したストリームの接続を閉じる (ストリームでない場合は何もしない)
+    """
+    if resp is not None and hasattr(resp, "close"):
+        resp.close()
+
+
+async def _close_stream_async(resp):
+    """
+    _close_stream の非同期版
+    """
+    if resp is not None and hasattr(resp, "close"):
+        await resp.close()
+
+
+def get_retry_after(headers) -> float:
+    """
+    retry-after-ms または retry-after ヘッダーから、リトライまでの時間(秒)を取得する
+    """
+    retry_after_ms = _to_int(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    retry_after = _to_int(headers.get("retry-after"))
+    return retry_after if retry_after is not None else DEFAULT_THROTTLE_SECONDS
+
+
+def _to_int(value) -> int | None:
+    try:
+        return int(float(value)) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,118 @@
+import json
+
+
+class CompletionStreamAssembler:
+    """
+    Chat Completion API のストリーム (チャンク) から、回答テキストとツール呼び出し情報を組み立てる
+    """
+
+    def __init__(self):
+        self.role = ""
+        self.tool_calls = {}
+        self.is_tool_calling = False
+        self.completed_indexes = set()
+        self.usage = None
+
+    def feed(self, chunk) -> str | None:
+        """
+        チャンクを1つ読み込む
+
+        Args:
+            chunk: Chat Completion API から返されるチャンク
+
+        Returns:
+            str | None: ユーザへ返信するテキスト (ツール呼び出しの場合は None)
+        """
+        # トークン数は最後のチャンクに含まれる (stream_options の include_usage を指定した場合のみ)
+        if getattr(chunk, "usage", None):
+            self.usage = chunk.usage
+
+        # 1つ目 (と、トークン数を含む最後のチャンク) は選択肢(choices)がないのでスキップ
+        if not chunk.choices:
+            return None
+
+        # choice を1つに絞る
+        choice = chunk.choices[0]
+
+        # ロールを取得
+        self.role = choice.delta.role if choice.delta.role else self.role
+
+        # ツール呼び出し(Function Calling)かどうかを判定
+        if choice.delta.tool_calls:
+            self.is_tool_calling = True
+
+        # ツール呼び出しがある場合は、ツール呼び出しの内容を取得
+        if self.is_tool_calling:
+
+            # 最後はツール呼び出し情報はない
+            if not choice.delta.tool_calls:
+                return None
+
+            # ツール呼び出し情報を取得 (複数のツール呼び出しは index で区別される)
+            for tool_call in choice.delta.tool_calls:
+                index = tool_call.index if tool_call.index is not None else len(self.tool_calls) - (0 if tool_call.id else 1)
+                if index not in self.tool_calls:
+                    self.tool_calls[index] = {
+                        "id": tool_call.id,
+                        "type": tool_call.type,
+                        "function": {"name": tool_call.function.name, "arguments": ""},
+                    }
+                if tool_call.function.arguments:
+                    self.tool_calls[index]["function"]["arguments"] += tool_call.function.arguments
+            return None
+
+        # ツール呼び出しでない場合は順次ユーザに返信
+        return choice.delta.content or None
+
+    def pop_completed_tool_calls(self) -> list[dict]:
+        """
+        ストリームの受信中に、引数が JSON として完結したツール呼び出しを取得する
+        一度返したツール呼び出しは、以降は返さない
+
+        Returns:
+            list[dict]: 引数が揃ったツール呼び出し情報のリスト
+        """
+        completed = []
+        for index, tool_call in self.tool_calls.items():
+            if index in self.completed_indexes:
+                continue
+
+            # 引数の JSON が閉じていない間は、続きの引数を待つ
+            arguments = tool_call["function"]["arguments"].rstrip()
+            if not arguments.endswith("}"):
+                continue
+            try:
+                json.loads(arguments)
+            except json.JSONDecodeError:
+                continue
+            self.completed_indexes.add(index)
+            completed.append(tool_call)
+        return completed
+
+    def get_tool_calls(self) -> list[dict]:
+        """
+        組み立てたツール呼び出し情報を、呼び出し順に取得する
+
+        Returns:
+            list[dict]: ツール呼び出し情報のリスト
+        """
+        return [self.tool_calls[index] for index in sorted(self.tool_calls)]
+
+    def to_assistant_message(self) -> dict:
+        """
+        ツール呼び出しを含むアシスタントのメッセージを生成する
+
+        Returns:
+            dict: メッセージ
+        """
+        return {
+            "role": self.role or "assistant",
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": call["type"],
+                    "function": {"name": call["function"]["name"], "arguments": call["function"]["arguments"]},
+                }
+                for call in self.get_tool_calls()
+            ],
+        }
@@ -1,11 +1,55 @@
 import os
 import json
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from utils.logger import logger
-from utils.search import AzureSearchClient
-from utils.weather import get_weather_in_tokyo
+from utils.cancel import CancelToken, GenerationCancelled
+from utils.timing import TurnTimer, ToolTimer, TOOL_OK, TOOL_ERROR, TOOL_TIMEOUT, TOOL_CANCELLED
+from utils.search import create_search_client
+from utils.weather import WeatherForecastClient, DEFAULT_AREA
 from utils.bing import BingSearchClient, BingSearchNewsCategory
 
 
+@dataclass(frozen=True)
+class ToolEntry:
+    """
+    ツールのディスパッチテーブルの要素
+    """
+
+    name: str
+    func: Callable[..., str]
+    async_func: Callable[..., Awaitable[str]] | None
+    parameters: frozenset[str]
+    timeout: float
+
+
+@dataclass
+class PendingToolCall:
+    """
+    スレッドプールで実行中 (または実行待ち) のツール呼び出し
+    """
+
+    tool_call: dict
+    submitted_at: float
+    timeout: float
+    timer: ToolTimer | None = None
+    future: Future | None = None
+    started_at: float | None = None  # スレッドプールで実行を開始した時刻 (実行待ちの間は None)
+
+    def run(self, func: Callable[..., str], args: dict) -> str:
+        """
+        スレッドプールのワーカーでツールを実行する (タイムアウトは実行を開始した時点から数える)
+        呼び出してからタイムアウトと同じ時間が経過するまで実行を開始できなかった場合は、実行せずにタイムアウトとする
+        """
+        self.started_at = time.monotonic()
+        if self.started_at > self.submitted_at + self.timeout:
+            raise TimeoutError(f"tool call was not started within {self.timeout}s")
+        return func(**args)
+
+
 class OpenAITools:
 
     def __init__(self, tools_definition_path: str = "openai_tools.json"):
@@ -17,14 +61,289 @@ class OpenAITools:
         with open(tools_definition_path, "r") as f:
             self.tools_definition = json.load(f)
 
-        # Bing Search Client と Azure Search Client を初期化
+        # Bing Search Client と Azure Search Client と天気予報のクライアントを初期化
         self.bing_client = BingSearchClient()
-        self.search_client = AzureSearchClient(index_name=os.getenv("AI_SEARCH_INDEX_NAME"))
+        self.search_client = create_search_client(index_name=os.getenv("AI_SEARCH_INDEX_NAME"))
+        self.weather_client = WeatherForecastClient()
 
         # Bing Search API に関する設定がされていない場合は、Web検索とニュース検索の機能を無効化
         if not os.environ.get("BING_SEARCH_API_KEY"):
             self.tools_definition = [t for t in self.tools_definition if t["function"]["name"] != "search_news"]
 
+        # ツールのタイムアウト(秒)を環境変数から取得 (例: OPENAI_TOOL_TIMEOUTS="get_weather=5,search_news=8")
+        self.default_timeout = float(os.environ.get("OPENAI_TOOL_TIMEOUT", 10))
+        timeouts = [t.split("=") for t in os.environ.get("OPENAI_TOOL_TIMEOUTS", "").split(",") if "=" in t]
+        self.timeouts = {name.strip(): float(value) for name, value in timeouts}
+
+        # ツールの定義とメソッドから、ツール名で呼び出すためのディスパッチテーブルを生成する
+        self.dispatch_table = self._build_dispatch_table()
+
+        # 同期版でツールを並列実行するためのスレッドプール (プロセス内のすべてのリクエストで共有する)
+        # 既定では、同時に生成する回答の数の上限 (ADMISSION_MAX_CONCURRENCY) の各ターンが、すべてのツールを同時に呼び出せる数とする
+        # (スレッドが空くのを待っている間はタイムアウトに数えないが、タイムアウトと同じ時間が経過しても開始できなければ取り消す)
+        max_workers = os.environ.get("OPENAI_TOOL_MAX_WORKERS") or int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 16)) * len(self.dispatch_table)
+        self.executor = ThreadPoolExecutor(max_workers=max(int(max_workers), 1), thread_name_prefix="openai-tool")
+
+    def _build_dispatch_table(self) -> dict[str, ToolEntry]:
+        """
+        ツールの定義ファイルに記載されたツールと、対応するメソッドのディスパッチテーブルを生成する
+
+        Returns:
+            dict[str, ToolEntry]: ツール名をキーとしたディスパッチテーブル
+        """
+        table = {}
+        for definition in self.tools_definition:
+            name = definition["function"]["name"]
+            func = getattr(self, name, None)
+            if not callable(func):
+                raise ValueError(f"Tool method not found: {name}")
+            table[name] = ToolEntry(
+                name=name,
+                func=func,
+                async_func=getattr(self, f"{name}_async", None),
+                parameters=frozenset(definition["function"].get("parameters", {}).get("properties", {}).keys()),
+                timeout=self.timeouts.get(name, self.default_timeout),
+            )
+        return table
+
+    def _parse_tool_call(self, tool_call: dict) -> tuple[ToolEntry, dict]:
+        """
+        ツール呼び出し情報から、呼び出すツールと引数を取得する
+
+        Args:
+            tool_call (dict): ツール呼び出し情報
+
+        Returns:
+            tuple[ToolEntry, dict]: 呼び出すツールと引数
+        """
+        name = tool_call["function"]["name"]
+        if name not in self.dispatch_table:
+            raise ValueError(f"Unknown tool: {name}")
+        entry = self.dispatch_table[name]
+        args = json.loads(tool_call["function"]["arguments"] or "{}")
+
+        # ツールの定義にない引数は無視する
+        args = {key: value for key, value in args.items() if key in entry.parameters}
+        return entry, args
+
+    def submit_tool_call(self, tool_call: dict, timer: TurnTimer = None) -> PendingToolCall:
+        """
+        ツール呼び出しをスレッドプールで開始する (結果は待たない)
+
+        Args:
+            tool_call (dict): ツール呼び出し情報
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス (ツール呼び出しの所要時間を記録する)
+
+        Returns:
+            PendingToolCall: 実行中のツール呼び出し
+        """
+        submitted_at = time.monotonic()
+        tool_timer = timer.start_tool(tool_call["function"]["name"]) if timer else None
+        try:
+            entry, args = self._parse_tool_call(tool_call)
+            call = PendingToolCall(tool_call, submitted_at, entry.timeout, tool_timer)
+            call.future = self.executor.submit(call.run, entry.func, args)
+        except Exception as e:
+            call = PendingToolCall(tool_call, submitted_at, 0, tool_timer, Future())
+            call.future.set_exception(e)
+
+        # ツールの実行が終わった時点で所要時間を記録する (タイムアウトや取り消しの場合は、呼び出し元がその時点で理由とともに記録する)
+        if tool_timer:
+            call.future.add_done_callback(lambda future: future.cancelled() or tool_timer.end(_get_future_status(future)))
+        return call
+
+    def run_tool_calls(self, tool_calls: list[dict], pending: dict[str, PendingToolCall] = None, cancel_token: CancelToken = None, timer: TurnTimer = None) -> list[dict]:
+        """
+        1回の応答に含まれるツール呼び出しを並列に実行する
+
+        Args:
+            tool_calls (list[dict]): ツール呼び出し情報のリスト
+            pending (dict[str, PendingToolCall]): ストリームの受信中に開始済みのツール呼び出し (キーはツール呼び出しID)
+            cancel_token (CancelToken): 回答の生成を中止するためのトークン
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス
+
+        Returns:
+            list[dict]: ツールの実行結果のメッセージ (tool_calls と同じ順序)
+
+        Raises:
+            GenerationCancelled: 実行結果を待っている間に回答の生成が中止された場合
+        """
+        pending = pending or {}
+        calls = [pending.get(tool_call["id"]) or self.submit_tool_call(tool_call, timer) for tool_call in tool_calls]
+
+        results = []
+        for call in calls:
+            try:
+                content = self._wait_tool_call(call, cancel_token)
+            except GenerationCancelled:
+                self.cancel_tool_calls({c.tool_call["id"]: c for c in calls})
+                raise
+            except Exception as e:
+                if call.timer and isinstance(e, TimeoutError):
+                    call.timer.end(TOOL_TIMEOUT)
+                content = self._to_error_content(call.tool_call, e)
+            results.append(self._to_tool_message(call.tool_call, content))
+        return results
+
+    def _wait_tool_call(self, call: PendingToolCall, cancel_token: CancelToken = None) -> str:
+        """
+        ツール呼び出しの結果を、タイムアウトまたは回答の生成が中止されるまで待つ
+        タイムアウトはツールの実行を開始した時点から数える (スレッドプールの待ち時間は含めない)
+        ただし、呼び出してからタイムアウトと同じ時間が経過しても実行を開始できていない場合は、取り消してタイムアウトとする
+        """
+        futures = [call.future, cancel_token.cancelled_future] if cancel_token else [call.future]
+        deadline = call.submitted_at + call.timeout
+        while True:
+            wait(futures, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            if call.future.done():
+                return call.future.result(timeout=0)
+
+            # 実行待ちのまま期限を過ぎた場合は取り消す (取り消せなかった場合は、実行を開始した時点から期限を数え直す)
+            if call.started_at is None:
+                if call.future.cancel():
+                    raise TimeoutError(f"tool call was not started within {call.timeout}s")
+            run_deadline = (call.started_at or time.monotonic()) + call.timeout
+            if run_deadline <= deadline:
+                raise TimeoutError(f"tool call did not finish within {call.timeout}s")
+            deadline = run_deadline
+
+    def cancel_tool_calls(self, pending: dict[str, PendingToolCall]):
+        """
+        まだ開始していないツール呼び出しを取り消す (実行中のものは完了を待たずに結果を破棄する)
+
+        Args:
+            pending (dict[str, PendingToolCall]): ツール呼び出し (キーはツール呼び出しID)
+        """
+        for call in pending.values():
+            call.future.cancel()
+            if call.timer:
+                call.timer.end(TOOL_CANCELLED)
+
+    def start_tool_call_async(self, tool_call: dict, timer: TurnTimer = None) -> asyncio.Task:
+        """
+        ツール呼び出しをタスクとして開始する (結果は待たない, 非同期版)
+
+        Args:
+            tool_call (dict): ツール呼び出し情報
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス (ツール呼び出しの所要時間を記録する)
+
+        Returns:
+            asyncio.Task: ツールの実行結果を返すタスク
+        """
+        return asyncio.create_task(self.invoke_async(tool_call, timer))
+
+    async def run_tool_calls_async(self, tool_calls: list[dict], pending: dict[str, asyncio.Task] = None, cancel_token: CancelToken = None, timer: TurnTimer = None) -> list[dict]:
+        """
+        1回の応答に含まれるツール呼び出しを並列に実行する (非同期版)
+
+        Args:
+            tool_calls (list[dict]): ツール呼び出し情報のリスト
+            pending (dict[str, asyncio.Task]): ストリームの受信中に開始済みのツール呼び出し (キーはツール呼び出しID)
+            cancel_token (CancelToken): 回答の生成を中止するためのトークン
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス
+
+        Returns:
+            list[dict]: ツールの実行結果のメッセージ (tool_calls と同じ順序)
+
+        Raises:
+            GenerationCancelled: 実行結果を待っている間に回答の生成が中止された場合
+        """
+        pending = pending or {}
+        tasks = [pending.get(tool_call["id"]) or self.start_tool_call_async(tool_call, timer) for tool_call in tool_calls]
+
+        # 中止された場合 (またはこのタスク自体がキャンセルされた場合) は、実行中のツール呼び出しもキャンセルする
+        # (invoke_async は例外を返さないため、return_exceptions はキャンセルした結果を参照しないためにのみ指定する)
+        gathered = asyncio.gather(*tasks, return_exceptions=True)
+        waiters = [gathered]
+        if cancel_token:
+            waiters.append(asyncio.ensure_future(cancel_token.wait_cancelled_async()))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            contents = gathered.result()
+        finally:
+            for task in tasks + waiters[1:]:
+                task.cancel()
+        return [self._to_tool_message(tool_call, content) for tool_call, content in zip(tool_calls, contents)]
+
+    async def invoke_async(self, tool_call: dict, timer: TurnTimer = None) -> str:
+        """
+        ツールを非同期に呼び出す
+        非同期版の実装 (<ツール名>_async) があればそれを使用し、なければ別スレッドで同期版を実行する
+
+        Args:
+            tool_call (dict): ツール呼び出し情報
+            timer (TurnTimer): 段階ごとの所要時間を計測するクラス (ツール呼び出しの所要時間を記録する)
+
+        Returns:
+            str: ツールの実行結果 (失敗した場合はエラー内容)
+        """
+        tool_timer = timer.start_tool(tool_call["function"]["name"]) if timer else None
+        status = TOOL_OK
+        try:
+            entry, args = self._parse_tool_call(tool_call)
+            if entry.async_func:
+                return await asyncio.wait_for(entry.async_func(**args), timeout=entry.timeout)
+            return await self._run_in_executor_async(PendingToolCall(tool_call, time.monotonic(), entry.timeout), entry.func, args)
+        except asyncio.CancelledError:
+            status = TOOL_CANCELLED
+            raise
+        except Exception as e:
+            status = TOOL_TIMEOUT if isinstance(e, (TimeoutError, asyncio.TimeoutError)) else TOOL_ERROR
+            return self._to_error_content(tool_call, e)
+        finally:
+            if tool_timer:
+                tool_timer.end(status)
+
+    async def _run_in_executor_async(self, call: PendingToolCall, func: Callable[..., str], args: dict) -> str:
+        """
+        同期版のツールをスレッドプールで実行し、結果を待つ (非同期版)
+        同期版と同様に、タイムアウトは実行を開始した時点から数え、期限までに実行を開始できなければ取り消す
+        """
+        call.future = self.executor.submit(call.run, func, args)
+        future = asyncio.wrap_future(call.future)
+        try:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout=call.timeout)
+            except asyncio.TimeoutError:
+                if call.started_at is None and call.future.cancel():
+                    raise
+            return await asyncio.wait_for(asyncio.shield(future), timeout=max(0, (call.started_at or time.monotonic()) + call.timeout - time.monotonic()))
+        except asyncio.CancelledError:
+            call.future.cancel()
+            raise
+
+    def _to_error_content(self, tool_call: dict, error: Exception) -> str:
+        """
+        ツールの実行に失敗した場合に、モデルへ返すエラー内容を生成する
+        """
+        name = tool_call["function"]["name"]
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+            logger.warning(f"tool call timed out: {name}")
+            return json.dumps({"error": "timeout"})
+        logger.exception(f"tool call failed: {name}", exc_info=error)
+        return json.dumps({"error": str(error)}, ensure_ascii=False)
+
+    def _to_tool_message(self, tool_call: dict, content: str) -> dict:
+        """
+        ツールの実行結果をメッセージに変換する
+        """
+        return {
+            "tool_call_id": tool_call["id"],
+            "role": "tool",
+            "name": tool_call["function"]["name"],
+            "content": content,
+        }
+
+    async def close_async(self):
+        """
+        非同期版のクライアントが保持している接続を閉じる
+        """
+        await self.search_client.close_async()
+
     def search_documents(self, query: str, count: int = 3, offset: int = 0) -> str:
         """
         Azure AI Search を使って、指定されたクエリに一致するドキュメントを検索する。
@@ -39,6 +358,24 @@ class OpenAITools:
         """
         logger.info(f"search_documents: query={query}, count={count}, offset={offset}")
         docs = self.search_client.search(query, top=count, skip=offset)
+        docs = self.search_client.to_tool_documents(docs)
+        return json.dumps(docs, ensure_ascii=False)
+
+    async def search_documents_async(self, query: str, count: int = 3, offset: int = 0) -> str:
+        """
+        Azure AI Search を使って、指定されたクエリに一致するドキュメントを検索する。(非同期版)
+
+        Args:
+            query (str): 検索クエリ
+            count (int): 取得する検索結果の最大数
+            offset (int): 検索結果のオフセット
+
+        Returns:
+            str: 検索結果のJSON文字列
+        """
+        logger.info(f"search_documents_async: query={query}, count={count}, offset={offset}")
+        docs = await self.search_client.search_async(query, top=count, skip=offset)
+        docs = self.search_client.to_tool_documents(docs)
         return json.dumps(docs, ensure_ascii=False)
 
     def search_news(self, category: str = "Entertainment", count: int = 3, offset: int = 0) -> str:
@@ -62,13 +399,28 @@ class OpenAITools:
         news = [{"title": n["name"], "description": n["description"]} for n in news]
         return json.dumps(news, ensure_ascii=False)
 
-    def get_weather(self) -> str:
+    def get_weather(self, area: str = DEFAULT_AREA) -> str:
         """
-        東京の天気情報を取得する。
+        指定された地域の天気情報を取得する。
+
+        Args:
+            area (str): 地域名 (例: 東京、大阪)
 
         Returns:
             str: 天気情報のJSON文字列
         """
-        logger.info(f"get_weather:")
-        result = get_weather_in_tokyo()
+        logger.info(f"get_weather: area={area}")
+        result = self.weather_client.get_forecast(area)
+        if result is None:
+            result = {"error": f"unknown area: {area}", "areas": self.weather_client.get_area_names()}
         return json.dumps(result, ensure_ascii=False)
+
+
+def _get_future_status(future: Future) -> str:
+    """
+    スレッドプールで実行したツール呼び出しの結果 (ok, error, timeout) を取得する
+    """
+    error = future.exception()
+    if error is None:
+        return TOOL_OK
+    return TOOL_TIMEOUT if isinstance(error, TimeoutError) else TOOL_ERROR
@@ -0,0 +1,324 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import threading
+from typing import Awaitable, Callable
+from utils.logger import logger
+from utils.chat import with_message_ids
+
+
+class WriteBehindConfig:
+    """
+    会話履歴の遅延書き込みの設定 (環境変数から取得する)
+    """
+
+    def __init__(self):
+        self.queue_size = int(os.environ.get("HISTORY_WRITE_QUEUE_SIZE", 1000))
+        self.batch_size = int(os.environ.get("HISTORY_WRITE_BATCH_SIZE", 50))
+        self.max_retries = int(os.environ.get("HISTORY_WRITE_MAX_RETRIES", 5))
+        self.backoff_base = float(os.environ.get("HISTORY_WRITE_BACKOFF_BASE", 0.5))
+        self.backoff_max = float(os.environ.get("HISTORY_WRITE_BACKOFF_MAX", 30))
+        self.put_timeout = float(os.environ.get("HISTORY_WRITE_PUT_TIMEOUT", 0.1))
+
+    def get_backoff(self, attempt: int) -> float:
+        """
+        リトライまでの待ち時間(秒)を取得する (指数バックオフ + ジッター)
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2**attempt)))
+
+
+class WriteBehindWriter:
+    """
+    会話の1ターン分のメッセージをキューに入れ、バックグラウンドのスレッドでまとめて会話履歴ストアへ書き込む
+    書き込みが完了していないメッセージは get_pending で取得できるため、次のターンのプロンプトに含められる
+    書き込みに失敗した場合は、そのユーザの分だけ待ち時間の後にリトライし、その間も他のユーザの書き込みを続ける
+    """
+
+    def __init__(self, write: Callable[[str, list[dict]], None], on_written: Callable[[str], None] = None, config: WriteBehindConfig = None):
+        self.write = write
+        self.on_written = on_written
+        self.config = config or WriteBehindConfig()
+        self.queue = queue.Queue(maxsize=self.config.queue_size)
+        self.pending = {}
+        self.lock = threading.Lock()
+        # リトライ待ちの書き込み (ユーザID → [メッセージ, リトライの回数, リトライする時刻]、書き込みのスレッドのみが使用する)
+        self.retries = {}
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, user_id: str, messages: list[dict]) -> bool:
+        """
+        書き込むメッセージをキューに入れる (キューが一杯の場合は短時間だけ待ち、それでも空かなければ破棄する)
+
+        Args:
+            user_id (str): ユーザID
+            messages (list[dict]): 1ターン分のメッセージ (古い順)
+
+        Returns:
+            bool: キューに入れられた場合は True
+        """
+        # 書き込みのリトライや書き込み待ちのメッセージとの突き合わせで同じ ID を使うよう、キューに入れる時点で ID を付与する
+        entry = (user_id, with_message_ids(messages))
+        with self.lock:
+            self.pending.setdefault(user_id, []).append(entry)
+        try:
+            self.queue.put(entry, timeout=self.config.put_timeout)
+            return True
+        except queue.Full:
+            logger.error(f"history write queue is full, dropped: user_id={user_id}")
+            self._done([entry])
+            return False
+
+    def get_pending(self, user_id: str) -> list[dict]:
+        """
+        まだ書き込みが完了していないメッセージを取得する
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            list[dict]: 書き込み待ちのメッセージ (古い順, id を含む)
+        """
+        with self.lock:
+            return [m for _, messages in self.pending.get(user_id, []) for m in messages]
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        キューに入っているメッセージの書き込みが完了するまで待つ
+
+        Args:
+            timeout (float): 待つ時間の上限(秒)
+
+        Returns:
+            bool: すべての書き込みが完了した場合は True
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout: float = 10):
+        """
+        アプリケーションの終了時に、キューに残っているメッセージを書き込む
+
+        Args:
+            timeout (float): 待つ時間の上限(秒)
+        """
+        if not self.flush(timeout):
+            logger.error(f"history write queue was not flushed before shutdown: remaining={self.queue.qsize()}")
+
+    def _run(self):
+        while True:
+            # リトライ待ちの書き込みがある場合は、最も早くリトライする時刻までだけ待つ
+            try:
+                batch = [self.queue.get(timeout=get_retry_timeout(self.retries))]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.config.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for user_id, (entries, attempt) in take_writes(batch, self.retries).items():
+                self._write(user_id, entries, attempt)
+
+    def _write(self, user_id: str, entries: list[tuple], attempt: int):
+        messages = [m for _, messages in entries for m in messages]
+        try:
+            self.write(user_id, messages)
+        except Exception:
+            if schedule_retry(self.retries, user_id, entries, attempt, self.config):
+                return
+            logger.exception(f"failed to write history, dropped: user_id={user_id}, messages={len(messages)}")
+            self._finish(entries)
+            return
+        self._finish(entries)
+        if self.on_written:
+            self.on_written(user_id)
+
+    def _finish(self, entries: list[tuple]):
+        self._done(entries)
+        for _ in entries:
+            self.queue.task_done()
+
+    def _done(self, entries: list[tuple]):
+        with self.lock:
+            for user_id, _ in entries:
+                remaining = [e for e in self.pending.get(user_id, []) if not any(e is d for d in entries)]
+                if remaining:
+                    self.pending[user_id] = remaining
+                else:
+                    self.pending.pop(user_id, None)
+
+
+class AsyncWriteBehindWriter:
+    """
+    WriteBehindWriter の非同期版 (書き込みはイベントループ上のタスクで行う)
+    """
+
+    def __init__(self, write: Callable[[str, list[dict]], Awaitable[None]], on_written: Callable[[str], None] = None, config: WriteBehindConfig = None):
+        self.write = write
+        self.on_written = on_written
+        self.config = config or WriteBehindConfig()
+        self.queue = None
+        self.pending = {}
+        self.retries = {}
+        self.task = None
+
+    def start(self):
+        """
+        イベントループ上で書き込みのタスクを開始する
+        """
+        self.queue = asyncio.Queue(maxsize=self.config.queue_size)
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, user_id: str, messages: list[dict]) -> bool:
+        """
+        書き込むメッセージをキューに入れる (キューが一杯の場合は短時間だけ待ち、それでも空かなければ破棄する)
+
+        Args:
+            user_id (str): ユーザID
+            messages (list[dict]): 1ターン分のメッセージ (古い順)
+
+        Returns:
+            bool: キューに入れられた場合は True
+        """
+        # 書き込みのリトライや書き込み待ちのメッセージとの突き合わせで同じ ID を使うよう、キューに入れる時点で ID を付与する
+        entry = (user_id, with_message_ids(messages))
+        self.pending.setdefault(user_id, []).append(entry)
+        try:
+            await asyncio.wait_for(self.queue.put(entry), timeout=self.config.put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.error(f"history write queue is full, dropped: user_id={user_id}")
+            self._done([entry])
+            return False
+
+    def get_pending(self, user_id: str) -> list[dict]:
+        """
+        まだ書き込みが完了していないメッセージを取得する
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            list[dict]: 書き込み待ちのメッセージ (古い順, id を含む)
+        """
+        return [m for _, messages in self.pending.get(user_id, []) for m in messages]
+
+    async def close(self, timeout: float = 10):
+        """
+        アプリケーションの終了時に、キューに残っているメッセージを書き込んでからタスクを停止する
+
+        Args:
+            timeout (float): 待つ時間の上限(秒)
+        """
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"history write queue was not flushed before shutdown: remaining={self.queue.qsize()}")
+        self.task.cancel()
+
+    async def _run(self):
+        while True:
+            # リトライ待ちの書き込みがある場合は、最も早くリトライする時刻までだけ待つ
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), timeout=get_retry_timeout(self.retries))]
+            except asyncio.TimeoutError:
+                batch = []
+            while batch and len(batch) < self.config.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            for user_id, (entries, attempt) in take_writes(batch, self.retries).items():
+                await self._write(user_id, entries, attempt)
+
+    async def _write(self, user_id: str, entries: list[tuple], attempt: int):
+        messages = [m for _, messages in entries for m in messages]
+        try:
+            await self.write(user_id, messages)
+        except Exception:
+            if schedule_retry(self.retries, user_id, entries, attempt, self.config):
+                return
+            logger.exception(f"failed to write history, dropped: user_id={user_id}, messages={len(messages)}")
+            self._finish(entries)
+            return
+        self._finish(entries)
+        if self.on_written:
+            self.on_written(user_id)
+
+    def _finish(self, entries: list[tuple]):
+        self._done(entries)
+        for _ in entries:
+            self.queue.task_done()
+
+    def _done(self, entries: list[tuple]):
+        for user_id, _ in entries:
+            remaining = [e for e in self.pending.get(user_id, []) if not any(e is d for d in entries)]
+            if remaining:
+                self.pending[user_id] = remaining
+            else:
+                self.pending.pop(user_id, None)
+
+
+def group_by_user(batch: list[tuple]) -> dict[str, list[tuple]]:
+    """
+    キューから取り出したメッセージを、ユーザごとに (キューに入れた順序を保って) まとめる
+    """
+    groups = {}
+    for entry in batch:
+        groups.setdefault(entry[0], []).append(entry)
+    return groups
+
+
+def take_writes(batch: list[tuple], retries: dict[str, list]) -> dict[str, tuple[list[tuple], int]]:
+    """
+    キューから取り出したメッセージと、リトライする時刻を過ぎた書き込みから、今回書き込むものをユーザごとにまとめる
+    リトライ待ちのユーザのメッセージは、順序を保つためにリトライ待ちの書き込みに加えて、一緒に書き込む
+
+    Args:
+        batch (list[tuple]): キューから取り出したメッセージ
+        retries (dict[str, list]): リトライ待ちの書き込み (ユーザID → [メッセージ, リトライの回数, リトライする時刻])
+
+    Returns:
+        dict[str, tuple[list[tuple], int]]: ユーザIDごとの、書き込むメッセージとリトライの回数
+    """
+    writes = {}
+    for user_id, entries in group_by_user(batch).items():
+        if user_id in retries:
+            retries[user_id][0].extend(entries)
+        else:
+            writes[user_id] = (entries, 0)
+
+    now = time.monotonic()
+    for user_id, (entries, attempt, retry_at) in list(retries.items()):
+        if retry_at <= now:
+            del retries[user_id]
+            writes[user_id] = (entries, attempt)
+    return writes
+
+
+def schedule_retry(retries: dict[str, list], user_id: str, entries: list[tuple], attempt: int, config: WriteBehindConfig) -> bool:
+    """
+    書き込みに失敗したユーザのメッセージを、待ち時間の後にリトライするように登録する
+
+    Returns:
+        bool: 登録した場合は True (リトライの回数の上限に達した場合は False)
+    """
+    if attempt >= config.max_retries:
+        return False
+    backoff = config.get_backoff(attempt)
+    logger.warning(f"failed to write history, retrying in {backoff:.1f}s: user_id={user_id}, attempt={attempt + 1}")
+    retries[user_id] = [entries, attempt + 1, time.monotonic() + backoff]
+    return True
+
+
+def get_retry_timeout(retries: dict[str, list]) -> float | None:
+    """
+    最も早くリトライする時刻までの時間(秒)を取得する (リトライ待ちの書き込みがない場合は None)
+    """
+    if not retries:
+        return None
+    return max(min(retry_at for _, _, retry_at in retries.values()) - time.monotonic(), 0)
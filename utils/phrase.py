@@ -0,0 +1,165 @@
+import os
+import re
+
+# 文末の区切り文字 (日本語の句点等と改行は、その位置ですぐに区切る)
+JA_SENTENCE_ENDS = "。！？．\n"
+
+# 文末の区切り文字 (英語の終止符等は、小数や URL と区別するため、後ろに空白が続く場合のみ区切る)
+LATIN_SENTENCE_ENDS = ".!?"
+
+# 文中の区切り文字 (最初のフレーズと、最大の長さを超えた場合のみ区切る)
+JA_CLAUSE_ENDS = "、，；："
+LATIN_CLAUSE_ENDS = ",;:"
+
+# 区切り文字の後ろに続く場合は、同じフレーズに含める文字 (閉じ括弧や連続する句読点)
+TRAILING_CHARS = "」』）)】〉》\"'”’。！？!?．、，"
+
+# 読み上げに不要な Markdown 記法と URL
+CODE_FENCE_PATTERN = re.compile(r"```[^\n]*")
+IMAGE_OR_LINK_PATTERN = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+URL_PATTERN = re.compile(r"https?://[^\s)」』]+")
+LINE_PREFIX_PATTERN = re.compile(r"^\s*(#{1,6}|>|[-*+・]|\d+[.)])\s+", re.MULTILINE)
+EMPHASIS_PATTERN = re.compile(r"(\*{1,3}|_{2,3}|~~|`)")
+SPACES_PATTERN = re.compile(r"\s+")
+
+# 記号のみのフレーズは読み上げない
+SPEAKABLE_PATTERN = re.compile(r"\w")
+
+
+class PhraseSegmenter:
+    """
+    逐次生成される回答のテキストを、アバターが読み上げる単位 (フレーズ) に区切る
+    - 句読点 (日本語と英語) で区切り、最小の長さに満たない場合は次の区切りまでつなげる
+    - 最大の長さを超えても区切りがない場合は、読点や空白で区切る
+    - 最初のフレーズは読点でも区切り、読み上げをできるだけ早く開始する
+    - 区切ったフレーズからは、Markdown 記法と URL を取り除く
+    """
+
+    def __init__(self, min_length: int = None, max_length: int = None, first_min_length: int = None):
+        """
+        Args:
+            min_length (int): フレーズの最小の長さ (文字数)
+            max_length (int): フレーズの最大の長さ (文字数)
+            first_min_length (int): 最初のフレーズの最小の長さ (文字数)
+        """
+        self.min_length = min_length if min_length is not None else int(os.environ.get("PHRASE_MIN_LENGTH", 10))
+        self.max_length = max(max_length if max_length is not None else int(os.environ.get("PHRASE_MAX_LENGTH", 100)), self.min_length, 1)
+        self.first_min_length = first_min_length if first_min_length is not None else int(os.environ.get("PHRASE_FIRST_MIN_LENGTH", 4))
+        self.buffer = ""
+        self.consumed = 0  # フレーズとして区切ったテキストの長さ (受け取ったテキストの先頭からの文字数)
+        self.count = 0  # 区切ったフレーズの数
+
+    def feed(self, text: str) -> list[str]:
+        """
+        新しく生成されたテキストを受け取り、区切ることができたフレーズを返す
+
+        Args:
+            text (str): 新しく生成されたテキスト
+
+        Returns:
+            list[str]: 読み上げるフレーズ (区切ることができない場合は空のリスト)
+        """
+        self.buffer += text
+        return self._take_phrases(final=False)
+
+    def flush(self) -> list[str]:
+        """
+        回答の生成が終わった際に、残りのテキストをフレーズとして返す
+
+        Returns:
+            list[str]: 読み上げるフレーズ
+        """
+        phrases = self._take_phrases(final=True)
+        if self.buffer:
+            phrases += self._cut(len(self.buffer))
+        return phrases
+
+    def _take_phrases(self, final: bool) -> list[str]:
+        phrases = []
+        while True:
+            position = self._find_cut(final)
+            if position is None:
+                return phrases
+            phrases += self._cut(position)
+
+    def _cut(self, position: int) -> list[str]:
+        """
+        バッファの先頭から指定した位置までをフレーズとして取り出す (読み上げる文字がない場合は読み上げない)
+        """
+        raw, self.buffer = self.buffer[:position], self.buffer[position:]
+        self.consumed += position
+        phrase = scrub_markdown(raw)
+        if not SPEAKABLE_PATTERN.search(phrase):
+            return []
+        self.count += 1
+        return [phrase]
+
+    def _find_cut(self, final: bool) -> int | None:
+        """
+        バッファのうち、フレーズとして区切る位置を探す
+
+        Args:
+            final (bool): 回答の生成が終わっているか (末尾の英語の終止符でも区切る)
+
+        Returns:
+            int | None: 区切る位置 (区切ることができない場合は None)
+        """
+        first = self.count == 0
+        # 0 を指定した場合は最小の長さを設けない (最初の区切り文字で区切る)
+        min_length = max(self.first_min_length if first else self.min_length, 1)
+        buffer = self.buffer
+        for i in range(min_length - 1, len(buffer)):
+            if self._is_boundary(buffer, i, clause=first, final=final):
+                return self._extend(buffer, i + 1)
+
+        # 最大の長さを超えても区切りがない場合は、読点、空白、最大の長さの順に区切る
+        if len(buffer) < self.max_length:
+            return None
+        window = buffer[: self.max_length]
+        for i in range(len(window) - 1, min_length - 2, -1):
+            if self._is_boundary(buffer, i, clause=True, final=final):
+                return self._extend(buffer, i + 1)
+        for i in range(len(window) - 1, min_length - 2, -1):
+            if window[i].isspace():
+                return i + 1
+        return self.max_length
+
+    def _is_boundary(self, buffer: str, i: int, clause: bool, final: bool) -> bool:
+        """
+        指定した位置の文字で区切れるか判定する
+        """
+        c = buffer[i]
+        if c in JA_SENTENCE_ENDS or (clause and c in JA_CLAUSE_ENDS):
+            return True
+        if c in LATIN_SENTENCE_ENDS or (clause and c in LATIN_CLAUSE_ENDS):
+            # 後ろの文字を受け取るまでは判定できない
+            if i + 1 >= len(buffer):
+                return final
+            return buffer[i + 1].isspace()
+        return False
+
+    def _extend(self, buffer: str, position: int) -> int:
+        """
+        区切り文字の後ろに続く閉じ括弧等を、同じフレーズに含める
+        """
+        while position < len(buffer) and buffer[position] in TRAILING_CHARS:
+            position += 1
+        return position
+
+
+def scrub_markdown(text: str) -> str:
+    """
+    読み上げに不要な Markdown 記法と URL を取り除く
+
+    Args:
+        text (str): テキスト
+
+    Returns:
+        str: 取り除いたテキスト
+    """
+    text = CODE_FENCE_PATTERN.sub("", text)
+    text = IMAGE_OR_LINK_PATTERN.sub(r"\1", text)
+    text = URL_PATTERN.sub("", text)
+    text = LINE_PREFIX_PATTERN.sub("", text)
+    text = EMPHASIS_PATTERN.sub("", text)
+    return SPACES_PATTERN.sub(" ", text).strip()
@@ -0,0 +1,401 @@
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import uuid
+import threading
+from collections import Counter
+from datetime import datetime
+from utils.logger import logger
+
+# プロファイルの対象
+PROFILE_MODE_WINDOW = "window"  # 指定した時間の間、すべてのスレッドをサンプリングする
+PROFILE_MODE_REQUESTS = "requests"  # 指定した数の /api/completion のリクエストを処理している間、そのスレッド (とツールのスレッドプール) をサンプリングする
+
+# プロファイルの状態
+PROFILE_RUNNING = "running"
+PROFILE_FINISHED = "finished"
+
+# 出力形式
+FORMAT_COLLAPSED = "collapsed"  # flamegraph.pl 等で使用する collapsed stacks 形式 (テキスト)
+FORMAT_SPEEDSCOPE = "speedscope"  # https://www.speedscope.app で開くことができる JSON 形式
+
+# サンプリングするスタックの深さの上限
+MAX_STACK_DEPTH = 128
+
+# 標準ライブラリのディレクトリ (表示するファイルパスを短くするために使用する)
+STDLIB_DIR = os.path.dirname(os.__file__) + os.sep
+
+# スレッド名の末尾の番号 (同じ種類のスレッドを1つにまとめて表示する)
+THREAD_NUMBER_PATTERN = re.compile(r"[-_ ]?\d+( \(.*\))?$")
+
+
+class ProfilerBusy(Exception):
+    """
+    実行中のプロファイルがあるため、新しいプロファイルを開始できない場合の例外
+    """
+
+
+class ProfileSession:
+    """
+    1回分のサンプリングの結果 (スタックごとのサンプル数) と状態
+    """
+
+    def __init__(self, mode: str, duration: float, requests: int, interval: float):
+        """
+        Args:
+            mode (str): プロファイルの対象 (window, requests)
+            duration (float): サンプリングする時間(秒) (requests の場合は、リクエストを待つ時間の上限)
+            requests (int): サンプリングするリクエストの数 (requests の場合のみ)
+            interval (float): サンプリングの間隔(秒)
+        """
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.duration = duration
+        self.requests = requests
+        self.interval = interval
+        self.state = PROFILE_RUNNING
+        self.started_at = time.perf_counter()
+        self.started_time = datetime.now()
+        self.finished_at = None
+        self.samples = 0  # サンプリングした回数
+        self.sampling_seconds = 0.0  # サンプリング自体にかかった時間 (オーバーヘッド)
+        self.stacks = Counter()  # スタック (スレッド名, 呼び出し元, ..., 呼び出し先) ごとのサンプル数
+        self.tracked = Counter()  # サンプリング中のリクエストを処理しているスレッドID (とリクエストの数)
+        self.started_requests = 0
+        self.finished_requests = 0
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def get_status(self) -> dict:
+        """
+        プロファイルの状態を取得する
+
+        Returns:
+            dict: プロファイルの設定、サンプル数、オーバーヘッド (サンプリングにかかった時間の割合)
+        """
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "state": self.state,
+            "started_at": self.started_time.isoformat(timespec="seconds"),
+            "elapsed_seconds": round(self.elapsed, 3),
+            "duration_seconds": self.duration,
+            "interval_ms": round(self.interval * 1000, 1),
+            "requests": {"target": self.requests, "started": self.started_requests, "finished": self.finished_requests} if self.mode == PROFILE_MODE_REQUESTS else None,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "overhead": round(self.sampling_seconds / self.elapsed, 4) if self.elapsed > 0 else 0,
+        }
+
+    def to_collapsed(self) -> str:
+        """
+        collapsed stacks 形式 (1行に「呼び出し元;...;呼び出し先 サンプル数」) で出力する
+        """
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def to_speedscope(self) -> dict:
+        """
+        speedscope の sampled 形式で出力する (同じスタックはまとめ、サンプル数 × 間隔を重みとする)
+        """
+        frames, indexes, samples, weights = [], {}, [], []
+        interval_ms = self.interval * 1000
+        for stack, count in self.stacks.most_common():
+            sample = []
+            for name in stack:
+                if name not in indexes:
+                    indexes[name] = len(frames)
+                    frames.append({"name": name})
+                sample.append(indexes[name])
+            samples.append(sample)
+            weights.append(round(count * interval_ms, 3))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"profile {self.started_time.isoformat(timespec='seconds')} ({self.mode})",
+            "exporter": "utils.profiler",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"{self.mode} {self.id}",
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": round(sum(weights), 3),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+        }
+
+
+class SamplingProfiler:
+    """
+    本番環境のワーカーで有効にしたままにできる、低負荷のサンプリングプロファイラ
+    - 別のスレッドから一定の間隔で各スレッドのスタック (sys._current_frames) を取得し、スタックごとのサンプル数を数える
+    - 対象のスレッドの処理を止めずに取得するため、ストリームのジェネレータ、ツールの呼び出し、SDK の呼び出し (通信待ちを含む) がそのまま計上される
+    - 待機中のスレッド (イベントループの select や、タスクを待っているスレッドプール) のサンプルは除く
+    """
+
+    def __init__(self, modes: tuple[str, ...] = (PROFILE_MODE_WINDOW, PROFILE_MODE_REQUESTS)):
+        """
+        Args:
+            modes (tuple[str, ...]): 使用できるプロファイルの対象
+                                     (リクエストをスレッドで識別するため、1つのスレッドで複数のリクエストを処理する非同期版では requests を使用できない)
+        """
+        self.modes = modes
+        self.admin_token = os.environ.get("PROFILER_ADMIN_TOKEN", "")
+        self.default_duration = float(os.environ.get("PROFILER_DURATION", 30))
+        self.max_duration = float(os.environ.get("PROFILER_MAX_DURATION", 300))
+        self.default_interval = float(os.environ.get("PROFILER_INTERVAL_MS", 10)) / 1000
+        self.output_dir = os.environ.get("PROFILER_OUTPUT_DIR", "")
+        self.session = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.labels = {}  # コードオブジェクト -> (表示名, 種類) のキャッシュ
+        self.thread_names = {}
+        self.thread_names_updated_at = 0.0
+
+    def is_authorized(self, token: str | None) -> bool:
+        """
+        管理者用のトークンを確認する (PROFILER_ADMIN_TOKEN が設定されていない場合は常に拒否する)
+        """
+        if not self.admin_token or not token:
+            return False
+        return hmac.compare_digest(self.admin_token.encode(), token.encode())
+
+    def start(self, mode: str = PROFILE_MODE_WINDOW, duration: float = None, requests: int = 1, interval_ms: float = None) -> ProfileSession:
+        """
+        プロファイルを開始する
+
+        Args:
+            mode (str): プロファイルの対象 (window, requests)
+            duration (float): サンプリングする時間(秒) (requests の場合は、リクエストを待つ時間の上限)
+            requests (int): サンプリングするリクエストの数 (requests の場合のみ)
+            interval_ms (float): サンプリングの間隔(ミリ秒)
+
+        Returns:
+            ProfileSession: 開始したプロファイル
+
+        Raises:
+            ValueError: 指定した値が不正な場合
+            ProfilerBusy: 実行中のプロファイルがある場合
+        """
+        if mode not in (PROFILE_MODE_WINDOW, PROFILE_MODE_REQUESTS):
+            raise ValueError(f"unknown profile mode: {mode}")
+        if mode not in self.modes:
+            raise ValueError(f"profile mode is not supported by this server: {mode}")
+        duration = float(duration or self.default_duration)
+        interval = float(interval_ms) / 1000 if interval_ms else self.default_interval
+        requests = int(requests or 1)
+        if not 0 < duration <= self.max_duration:
+            raise ValueError(f"duration must be between 0 and {self.max_duration} seconds")
+        if interval < 0.001:
+            raise ValueError("interval must be at least 1 ms")
+        if requests < 1:
+            raise ValueError("requests must be at least 1")
+
+        with self.lock:
+            if self.session and self.session.state == PROFILE_RUNNING:
+                raise ProfilerBusy(self.session.id)
+            self.session = ProfileSession(mode, duration, requests, interval)
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(self.session,), name="sampling-profiler", daemon=True)
+            self.thread.start()
+        logger.info(f"profiler started: id={self.session.id}, mode={mode}, duration={duration}, requests={requests}, interval_ms={interval * 1000}")
+        return self.session
+
+    def start_from_env(self):
+        """
+        PROFILER_MODE が設定されている場合に、起動時からプロファイルを開始する
+        (結果は /api/admin/profile で取得するか、PROFILER_OUTPUT_DIR を指定してファイルに出力する)
+        """
+        mode = os.environ.get("PROFILER_MODE", "")
+        if not mode or mode == "off":
+            return
+        try:
+            self.start(mode, requests=int(os.environ.get("PROFILER_REQUESTS", 1)))
+        except ValueError as e:
+            logger.warning(f"profiler not started: {e}")
+
+    def stop(self) -> ProfileSession | None:
+        """
+        実行中のプロファイルを終了し、終了するまで待つ
+
+        Returns:
+            ProfileSession | None: 最後に実行したプロファイル
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        return self.session
+
+    def start_request(self) -> ProfileSession | None:
+        """
+        /api/completion のリクエストの処理を開始した際に呼び出す (処理中のスレッドをサンプリングの対象にする)
+        Flask ではストリームのジェネレータもリクエストと同じスレッドで実行されるため、レスポンスを閉じるまで対象にする
+
+        Returns:
+            ProfileSession | None: 対象にした場合はプロファイル (finish_request に渡す)
+        """
+        session = self.session
+        if session is None or session.state != PROFILE_RUNNING or session.mode != PROFILE_MODE_REQUESTS:
+            return None
+        with self.lock:
+            if session.started_requests >= session.requests:
+                return None
+            session.started_requests += 1
+            session.tracked[threading.get_ident()] += 1
+        return session
+
+    def finish_request(self, session: ProfileSession | None, ident: int = None):
+        """
+        /api/completion のリクエストの処理 (ストリームの送信) が終わった際に呼び出す
+
+        Args:
+            session (ProfileSession | None): start_request が返したプロファイル
+            ident (int): start_request を呼び出したスレッドのID (異なるスレッドから呼び出す場合のみ指定する)
+        """
+        if session is None:
+            return
+        ident = ident or threading.get_ident()
+        with self.lock:
+            session.tracked[ident] -= 1
+            if session.tracked[ident] <= 0:
+                del session.tracked[ident]
+            session.finished_requests += 1
+
+    def get_output(self, format: str = FORMAT_SPEEDSCOPE) -> tuple[str, str]:
+        """
+        最後に実行したプロファイルの結果を出力する
+
+        Args:
+            format (str): 出力形式 (collapsed, speedscope)
+
+        Returns:
+            tuple[str, str]: 出力した文字列と MIME タイプ
+        """
+        if format == FORMAT_COLLAPSED:
+            return self.session.to_collapsed(), "text/plain"
+        if format == FORMAT_SPEEDSCOPE:
+            return json.dumps(self.session.to_speedscope(), ensure_ascii=False), "application/json"
+        raise ValueError(f"unknown profile format: {format}")
+
+    def _run(self, session: ProfileSession):
+        own_ident = threading.get_ident()
+        while not self.stop_event.is_set():
+            started_at = time.perf_counter()
+            self._sample(session, own_ident)
+            session.sampling_seconds += time.perf_counter() - started_at
+            if self._is_done(session):
+                break
+            self.stop_event.wait(session.interval)
+
+        session.finished_at = time.perf_counter()
+        session.state = PROFILE_FINISHED
+        status = session.get_status()
+        logger.info(f"profiler finished: id={session.id}, samples={status['samples']}, stacks={status['stacks']}, overhead={status['overhead']}")
+        if self.output_dir:
+            self._write_output(session)
+
+    def _is_done(self, session: ProfileSession) -> bool:
+        if session.elapsed >= session.duration:
+            return True
+        return session.mode == PROFILE_MODE_REQUESTS and session.finished_requests >= session.requests
+
+    def _sample(self, session: ProfileSession, own_ident: int):
+        """
+        各スレッドのスタックを1回分サンプリングする
+        """
+        with self.lock:
+            tracked = set(session.tracked)
+        if session.mode == PROFILE_MODE_REQUESTS and not tracked:
+            return
+
+        frames = sys._current_frames()
+        thread_names = self._get_thread_names(frames)
+        session.samples += 1
+        for ident, frame in frames.items():
+            if ident == own_ident:
+                continue
+
+            # スタックを呼び出し元から順に並べる
+            stack, leaf_kind, in_pool_worker, in_work_item = [], None, False, False
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                label, kind = self._get_label(frame.f_code)
+                if not stack:
+                    leaf_kind = kind
+                in_pool_worker |= kind == "pool_worker"
+                in_work_item |= kind == "work_item"
+                stack.append(label)
+                frame = frame.f_back
+            stack.reverse()
+
+            # 待機中のスレッドは除く (イベントループの select と、タスクを待っているスレッドプールのスレッド)
+            if not stack or leaf_kind == "idle" or (in_pool_worker and not in_work_item):
+                continue
+
+            # requests の場合は、対象のリクエストを処理しているスレッドと、実行中のスレッドプールのスレッドのみを対象にする
+            if session.mode == PROFILE_MODE_REQUESTS and ident not in tracked and not in_work_item:
+                continue
+            name = THREAD_NUMBER_PATTERN.sub("", thread_names.get(ident, "thread")) or "thread"
+            session.stacks[(name, *stack)] += 1
+
+    def _get_label(self, code) -> tuple[str, str | None]:
+        """
+        コードオブジェクトの表示名 (関数名とファイル名、定義の行番号) と種類を取得する
+        """
+        cached = self.labels.get(code)
+        if cached is not None:
+            return cached
+        filename = _shorten_path(code.co_filename)
+        label = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+        kind = None
+        if filename.endswith("selectors.py") and code.co_name in ("select", "poll"):
+            kind = "idle"
+        elif filename.endswith(os.path.join("concurrent", "futures", "thread.py")):
+            kind = {"_worker": "pool_worker", "run": "work_item"}.get(code.co_name)
+        self.labels[code] = (label, kind)
+        return label, kind
+
+    def _get_thread_names(self, idents) -> dict[int, str]:
+        """
+        スレッドID とスレッド名の対応を取得する (1秒ごと、または新しいスレッドがある場合に更新する)
+        """
+        now = time.perf_counter()
+        if now - self.thread_names_updated_at > 1 or any(ident not in self.thread_names for ident in idents):
+            self.thread_names = {t.ident: t.name for t in threading.enumerate()}
+            self.thread_names_updated_at = now
+        return self.thread_names
+
+    def _write_output(self, session: ProfileSession):
+        """
+        プロファイルの結果を PROFILER_OUTPUT_DIR にファイルとして出力する
+        """
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"profile-{session.started_time.strftime('%Y%m%d-%H%M%S')}-{session.id[:8]}")
+            with open(f"{path}.collapsed.txt", "w") as f:
+                f.write(session.to_collapsed())
+            with open(f"{path}.speedscope.json", "w") as f:
+                json.dump(session.to_speedscope(), f, ensure_ascii=False)
+            logger.info(f"profiler output written: {path}.*")
+        except OSError:
+            logger.exception("failed to write profiler output")
+
+
+def _shorten_path(path: str) -> str:
+    """
+    ファイルパスを短くする (パッケージは site-packages 以降、標準ライブラリとアプリケーションはそれぞれのディレクトリからの相対パス)
+    """
+    marker = f"site-packages{os.sep}"
+    if marker in path:
+        return path.split(marker, 1)[1]
+    for directory in (STDLIB_DIR, os.getcwd() + os.sep):
+        if path.startswith(directory):
+            return path[len(directory) :]
+    return path
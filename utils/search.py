@@ -1,13 +1,121 @@
 import os
 import json
 import requests
-from tqdm import tqdm
-from concurrent.futures.thread import ThreadPoolExecutor
+import unicodedata
+from typing import Iterable, Protocol
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from azure.core.exceptions import ResourceNotFoundError
 from azure.core.credentials import AzureKeyCredential, TokenCredential
 from azure.search.documents.indexes import SearchIndexClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
+from utils.cache import LRUCache, MISSING
+from utils.ingest import SearchIngestionPipeline
+
+
+class SearchBackend(Protocol):
+    """
+    ツールから使用する検索クライアントのインターフェース (AzureSearchClient と LocalVectorSearchClient が実装する)
+    インデックスの作成・更新は含まない (Azure AI Search のインデックスの管理は AzureSearchClient を直接使用する)
+    """
+
+    def search(self, query: str = None, query_vector: list[float] = None, top: int = 10, skip: int = 0, filter: str = None, select: list[str] = None) -> list[dict]: ...
+
+    async def search_async(self, query: str = None, query_vector: list[float] = None, top: int = 10, skip: int = 0, filter: str = None, select: list[str] = None) -> list[dict]: ...
+
+    def get_document(self, key: str) -> dict | None: ...
+
+    def to_tool_documents(self, docs: list[dict]) -> list[dict]: ...
+
+    async def close_async(self): ...
+
+
+class SearchResults:
+    """
+    検索結果の整形 (フィールドの選択・文字数の上限・キャプション) とキャッシュ
+    設定は環境変数から取得し、Azure AI Search とローカルのインデックスの検索クライアントで共通に使用する
+    """
+
+    def __init__(self, index_name: str, use_semantic_search: bool = False):
+        self.index_name = index_name
+
+        # 検索結果として取得するフィールド (ベクトルや不要なフィールドを取得しないようにする)
+        self.select_fields = [f.strip() for f in os.getenv("AI_SEARCH_SELECT_FIELDS", "id,content").split(",") if f.strip()]
+
+        # 検索結果のフィールドごとの文字数の上限 (例: AI_SEARCH_FIELD_MAX_LENGTHS="content=800,title=100")
+        self.field_max_length = int(os.getenv("AI_SEARCH_FIELD_MAX_LENGTH", 1000))
+        max_lengths = [f.split("=") for f in os.getenv("AI_SEARCH_FIELD_MAX_LENGTHS", "").split(",") if "=" in f]
+        self.field_max_lengths = {name.strip(): int(value) for name, value in max_lengths}
+
+        # セマンティック検索のキャプション (本文から抽出した要約) を取得するかどうか
+        self.use_captions = use_semantic_search and os.getenv("AI_SEARCH_USE_CAPTIONS", "false") == "true"
+
+        # 検索結果のキャッシュ (AI_SEARCH_CACHE_SIZE が 0 の場合は無効)
+        # このクライアントからインデックスを更新した場合は、キャッシュをすべて破棄する
+        # 別のプロセス (deploy/ のスクリプトや他のインスタンス) がインデックスを更新した場合は通知されないため、
+        # 更新が検索結果に反映されるまでの時間の上限は有効期限 (AI_SEARCH_CACHE_TTL) のみで決まる
+        cache_size = int(os.getenv("AI_SEARCH_CACHE_SIZE", 0))
+        self.cache = LRUCache(maxsize=cache_size, ttl=float(os.getenv("AI_SEARCH_CACHE_TTL", 60))) if cache_size > 0 else None
+        self.generation = 0
+
+    def invalidate(self):
+        """
+        検索結果のキャッシュをすべて破棄する
+        """
+        self.generation += 1
+        if self.cache:
+            self.cache.clear()
+
+    def get_cache_key(self, query: str, query_vector: list[float], top: int, skip: int, filter: str, select: list[str]) -> tuple | None:
+        """
+        検索結果のキャッシュのキーを生成する (ベクトルを指定した検索はキャッシュしない)
+        """
+        if self.cache is None or query_vector is not None:
+            return None
+        return (self.index_name, normalize_query(query), top, skip, filter, tuple(select or self.select_fields))
+
+    def get_cached(self, key: tuple | None) -> list[dict] | None:
+        if key is None:
+            return None
+        docs = self.cache.get(key, MISSING)
+        return None if docs is MISSING else list(docs)
+
+    def set_cached(self, key: tuple | None, docs: list[dict], generation: int):
+        # 検索中にインデックスが更新された場合は、古い検索結果をキャッシュしない
+        if key is not None and generation == self.generation:
+            self.cache.set(key, list(docs))
+
+    def to_tool_documents(self, docs: list[dict]) -> list[dict]:
+        """
+        検索結果を、ツールの実行結果としてプロンプトに含める形に整形する
+        取得したフィールドのみを残して文字数の上限で切り詰め、"@search." で始まるメタデータは除く
+        キャプションを取得した場合は、本文 (content) の代わりにキャプションを含める
+
+        Args:
+            docs (list[dict]): 検索結果のドキュメント一覧
+
+        Returns:
+            list[dict]: 整形したドキュメント一覧
+        """
+        results = []
+        for doc in docs:
+            result = {}
+            for name in self.select_fields:
+                value = doc.get(name)
+                if value is None:
+                    continue
+                max_length = self.field_max_lengths.get(name, self.field_max_length)
+                if isinstance(value, str) and len(value) > max_length:
+                    value = value[:max_length] + "…"
+                result[name] = value
+
+            caption = get_caption(doc) if self.use_captions else None
+            if caption:
+                result.pop("content", None)
+                result["caption"] = caption
+            results.append(result)
+        return results
 
 
 class AzureSearchClient:
@@ -28,10 +136,14 @@ class AzureSearchClient:
         self.vector_field_names = os.getenv("AI_SEARCH_VECTOR_FIELD_NAMES", "")
         self.vector_field_names = self.vector_field_names.split(",") if self.vector_field_names else []
 
+        # 検索結果の整形とキャッシュ
+        self.results = SearchResults(self.index_name, self.use_semantic_search)
+
         if credential:
             credential = DefaultAzureCredential()
         elif self.key:
             credential = AzureKeyCredential(self.key)
+        self.credential = credential
 
         self.index_client = SearchIndexClient(
             endpoint=self.endpoint,
@@ -39,6 +151,7 @@ class AzureSearchClient:
             api_version=self.api_version,
         )
         self.search_client = self.index_client.get_search_client(self.index_name)
+        self.async_search_client = None
 
     def create_index(self, json_file_path: str, vectorizer: dict = None) -> int:
         """
@@ -64,6 +177,7 @@ class AzureSearchClient:
             data["vectorSearch"]["vectorizers"][0]["azureOpenAIParameters"] = vectorizer
 
         # インデックスを作成
+        self.invalidate_cache()
         resp = requests.post(
             f"{self.endpoint}/indexes?api-version={self.api_version}",
             data=json.dumps(data),
@@ -83,6 +197,7 @@ class AzureSearchClient:
         インデックスを削除する
         """
         self.index_client.delete_index(self.index_name)
+        self.invalidate_cache()
 
     def check_index_exists(self) -> bool:
         """
@@ -112,19 +227,24 @@ class AzureSearchClient:
             self.delete_index()
         return self.create_index(json_file_path, vectorizer=vectorizer)
 
-    def index_documents(self, docs: list[dict], chunk_size: int = 250):
+    def index_documents(self, docs: Iterable[dict], chunk_size: int = None, max_concurrency: int = None) -> dict:
         """
         インデックスにドキュメントを追加する
+        ドキュメントはジェネレータでもよく、サイズで区切ったバッチ単位で逐次登録する (utils.ingest を参照)
 
         Args:
-            docs (list[dict]): ドキュメントのリスト
-            chunk_size (int): １つのスレッドで一度にアップロードするドキュメント数
+            docs (Iterable[dict]): ドキュメント (リストまたはジェネレータ)
+            chunk_size (int): 一度にアップロードするドキュメント数の上限
+            max_concurrency (int): 同時にアップロードするバッチ数の上限
+
+        Returns:
+            dict: 登録したドキュメント数、失敗したドキュメント数、1秒あたりの登録数などの統計情報
         """
-        chunks = [docs[i : i + chunk_size] for i in range(0, len(docs), chunk_size)]
-        upload_documents = lambda d: self.search_client.upload_documents(documents=d)
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            threads = [executor.submit(upload_documents, c) for c in chunks]
-            [t.result() for t in tqdm(threads)]
+        pipeline = SearchIngestionPipeline(self.search_client, max_batch_documents=chunk_size, max_concurrency=max_concurrency)
+        try:
+            return pipeline.run(docs)
+        finally:
+            self.invalidate_cache()
 
     def delete_documents(self, ids: list[str]):
         """
@@ -135,6 +255,7 @@ class AzureSearchClient:
         """
         docs = [{"id": id} for id in ids]
         self.search_client.delete_documents(documents=docs)
+        self.invalidate_cache()
 
     def get_document(self, key: str):
         """
@@ -157,7 +278,15 @@ class AzureSearchClient:
         """
         return self.index_client.get_index_statistics(self.index_name)
 
-    def search(self, query: str = None, query_vector: list[float] = None, top: int = 10, skip: int = 0, filter: str = None) -> list[dict]:
+    def search(
+        self,
+        query: str = None,
+        query_vector: list[float] = None,
+        top: int = 10,
+        skip: int = 0,
+        filter: str = None,
+        select: list[str] = None,
+    ) -> list[dict]:
         """
         Azure AI Search によるドキュメント検索を実行する
 
@@ -167,13 +296,100 @@ class AzureSearchClient:
             top (int): 取得する検索結果の最大数
             skip (int): 検索結果のオフセット
             filter (str): フィルタ条件
+            select (list[str]): 取得するフィールド (省略した場合は AI_SEARCH_SELECT_FIELDS のフィールド)
 
         Returns:
             list[dict]: 検索結果のドキュメント一覧
         """
-        docs = self.search_client.search(
+        key = self.results.get_cache_key(query, query_vector, top, skip, filter, select)
+        cached = self.results.get_cached(key)
+        if cached is not None:
+            return cached
+
+        generation = self.results.generation
+        docs = self.search_client.search(**self._build_search_params(query, query_vector, top, skip, filter, select))
+        docs = [d for d in docs]  # Paged item -> list
+        self.results.set_cached(key, docs, generation)
+        return docs
+
+    async def search_async(
+        self,
+        query: str = None,
+        query_vector: list[float] = None,
+        top: int = 10,
+        skip: int = 0,
+        filter: str = None,
+        select: list[str] = None,
+    ) -> list[dict]:
+        """
+        Azure AI Search によるドキュメント検索を実行する (非同期版)
+
+        Args:
+            query (str): 検索クエリ
+            query_vector (list[float]): 検索ベクトル
+            top (int): 取得する検索結果の最大数
+            skip (int): 検索結果のオフセット
+            filter (str): フィルタ条件
+            select (list[str]): 取得するフィールド (省略した場合は AI_SEARCH_SELECT_FIELDS のフィールド)
+
+        Returns:
+            list[dict]: 検索結果のドキュメント一覧
+        """
+        key = self.results.get_cache_key(query, query_vector, top, skip, filter, select)
+        cached = self.results.get_cached(key)
+        if cached is not None:
+            return cached
+
+        generation = self.results.generation
+        docs = await self._get_async_search_client().search(**self._build_search_params(query, query_vector, top, skip, filter, select))
+        docs = [d async for d in docs]  # Paged item -> list
+        self.results.set_cached(key, docs, generation)
+        return docs
+
+    async def close_async(self):
+        """
+        非同期版の検索クライアントが保持している接続を閉じる
+        """
+        if self.async_search_client:
+            await self.async_search_client.close()
+            self.async_search_client = None
+
+    def _get_async_search_client(self) -> AsyncSearchClient:
+        """
+        非同期版の検索クライアントを取得する (イベントループ上で初めて使用する際に生成する)
+        """
+        if not self.async_search_client:
+            # トークン認証の場合は、非同期版の資格情報を使用する
+            credential = self.credential if isinstance(self.credential, AzureKeyCredential) else AsyncDefaultAzureCredential()
+            self.async_search_client = AsyncSearchClient(
+                endpoint=self.endpoint,
+                index_name=self.index_name,
+                credential=credential,
+                api_version=self.api_version,
+            )
+        return self.async_search_client
+
+    def invalidate_cache(self):
+        """
+        検索結果のキャッシュをすべて破棄する (インデックスのドキュメントを更新した場合に呼び出す)
+        """
+        self.results.invalidate()
+
+    def to_tool_documents(self, docs: list[dict]) -> list[dict]:
+        """
+        検索結果を、ツールの実行結果としてプロンプトに含める形に整形する (SearchResults.to_tool_documents を参照)
+        """
+        return self.results.to_tool_documents(docs)
+
+    def _build_search_params(self, query: str, query_vector: list[float], top: int, skip: int, filter: str, select: list[str] = None) -> dict:
+        """
+        検索リクエストのパラメータを生成する
+        """
+        return dict(
             search_text=query,
             query_type="semantic" if self.use_semantic_search else "full",
+            query_caption="extractive" if self.results.use_captions else None,
+            select=select or self.results.select_fields or None,
             filter=filter,
             top=top,
             skip=skip,
@@ -196,4 +412,50 @@ class AzureSearchClient:
                 ]
             ),
         )
-        return [d for d in docs]  # Paged item -> list
+
+
+def get_caption(doc: dict) -> str | None:
+    """
+    セマンティック検索の結果から、キャプションのテキストを取得する
+
+    Args:
+        doc (dict): 検索結果のドキュメント
+
+    Returns:
+        str | None: キャプション (取得できない場合は None)
+    """
+    captions = doc.get("@search.captions") or []
+    texts = [c.get("text") if isinstance(c, dict) else getattr(c, "text", None) for c in captions]
+    texts = [t for t in texts if t]
+    return " ".join(texts) if texts else None
+
+
+def normalize_query(query: str | None) -> str:
+    """
+    検索クエリの表記の揺れ (全角・半角、大文字・小文字、空白) を取り除く
+
+    Args:
+        query (str | None): 検索クエリ
+
+    Returns:
+        str: 正規化した検索クエリ
+    """
+    return " ".join(unicodedata.normalize("NFKC", query or "").lower().split())
+
+
+def create_search_client(index_name: str = None) -> SearchBackend:
+    """
+    環境変数 AI_SEARCH_BACKEND の設定に従って、検索クライアントを生成する
+    (azure: Azure AI Search, local: メモリマップしたファイルを NumPy で検索するローカルのインデックス)
+
+    Args:
+        index_name (str): インデックス名 (azure の場合のみ使用する)
+
+    Returns:
+        SearchBackend: 検索クライアント
+    """
+    if os.getenv("AI_SEARCH_BACKEND", "azure") == "local":
+        from utils.local_search import LocalVectorSearchClient
+
+        return LocalVectorSearchClient()
+    return AzureSearchClient(index_name=index_name)
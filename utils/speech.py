@@ -0,0 +1,261 @@
+import os
+import time
+import asyncio
+import threading
+import requests
+from utils.cache import SingleFlight, AsyncSingleFlight
+from utils.logger import logger
+
+# 一時アクセストークンの有効期間(秒) (Azure Speech Service の仕様で10分)
+TOKEN_LIFETIME = 600
+
+# TURN サーバ情報の有効期間(秒)
+RELAY_TOKEN_LIFETIME = 3600
+
+# バックグラウンドでの更新に失敗した場合に、次に更新するまでの待ち時間(秒)
+REFRESH_RETRY_DELAY = 10
+
+
+def get_token_url(region: str) -> str:
+    """
+    Azure Speech Service の一時アクセストークンを発行する API の URL を取得する
+
+    Args:
+        region (str): Azure Speech Service のリージョン
+
+    Returns:
+        str: URL
+    """
+    return f"https://{region}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
+
+
+def get_relay_token_url(region: str) -> str:
+    """
+    Text to Speech Avatar 機能で使用する TURN サーバ情報を取得する API の URL を取得する
+
+    Args:
+        region (str): Azure Speech Service のリージョン
+
+    Returns:
+        str: URL
+    """
+    return f"https://{region}.tts.speech.microsoft.com/cognitiveservices/avatar/relay/token/v1"
+
+
+def to_ice_server(resp: dict) -> dict:
+    """
+    TURN サーバ情報を、ブラウザの RTCPeerConnection に渡す ICE サーバの形式へ変換する
+
+    Args:
+        resp (dict): TURN サーバ情報を取得する API のレスポンス
+
+    Returns:
+        dict: ICE サーバ情報
+    """
+    return {"urls": [resp["Urls"][0]], "username": resp["Username"], "credential": resp["Password"]}
+
+
+class SpeechCredentialCache:
+    """
+    Azure Speech Service の一時アクセストークンと TURN サーバ情報をメモリ上に保持し、有効期限が切れる前にバックグラウンドで更新する
+    同時に取得が必要になった場合は、Azure Speech Service へのリクエストを1回にまとめる
+    更新に失敗した場合も、残りの有効期間が min_remaining_ratio 未満の値は返さない (クライアントがすぐに使えなくなるため)
+    """
+
+    def __init__(self, key: str = None, region: str = None, session: requests.Session = None):
+        self.key = key or os.getenv("SPEECH_SERVICE_KEY")
+        self.region = region or os.getenv("SPEECH_SERVICE_REGION")
+        self.session = session or requests.Session()
+
+        # 有効期間のうち、この割合が経過したら更新する (残りの期間はクライアントがそのまま使用できる)
+        self.refresh_ratio = float(os.getenv("SPEECH_CREDENTIAL_REFRESH_RATIO", 0.5))
+        # 更新に失敗した場合に、保持している値を返す残りの有効期間の割合の下限
+        self.min_remaining_ratio = float(os.getenv("SPEECH_CREDENTIAL_MIN_REMAINING_RATIO", 0.25))
+        self.lifetimes = {
+            "token": float(os.getenv("SPEECH_TOKEN_LIFETIME", TOKEN_LIFETIME)),
+            "relay": float(os.getenv("SPEECH_RELAY_TOKEN_LIFETIME", RELAY_TOKEN_LIFETIME)),
+        }
+        self.fetchers = {"token": self._fetch_token, "relay": self._fetch_relay_token}
+
+        # 名前 -> (値, 取得した時刻)
+        self.entries = {}
+        self.single_flight = SingleFlight()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get_token(self) -> tuple[str, float]:
+        """
+        一時アクセストークンを取得する
+
+        Returns:
+            tuple[str, float]: 一時アクセストークンと、残りの有効期間(秒) (クライアントは期限が切れる前に取得し直す)
+        """
+        entry = self._get("token")
+        return entry[0], self._get_expires_in("token", entry)
+
+    def get_ice_server(self) -> dict:
+        """
+        ICE サーバ情報 (TURN サーバ情報) を取得する
+
+        Returns:
+            dict: ICE サーバ情報
+        """
+        return to_ice_server(self._get("relay")[0])
+
+    def start(self):
+        """
+        バックグラウンドで定期的に更新するスレッドを開始する
+        """
+        self.thread = threading.Thread(target=self._run, name="speech-credential", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        バックグラウンドの更新を停止し、HTTP セッションを閉じる
+        """
+        self.stopped.set()
+        self.session.close()
+
+    def _get(self, name: str) -> tuple:
+        entry = self.entries.get(name)
+        if entry and not self._needs_refresh(name, entry):
+            return entry
+        try:
+            return self.single_flight.do(name, lambda: self._refresh(name))
+        except Exception:
+            # 更新に失敗しても、残りの有効期間が十分な値があればそれを返す
+            if entry and self._is_usable(name, entry):
+                logger.exception(f"failed to refresh speech credential, using cached value: {name}")
+                return entry
+            raise
+
+    def _refresh(self, name: str) -> tuple:
+        entry = (self.fetchers[name](), time.monotonic())
+        self.entries[name] = entry
+        return entry
+
+    def _needs_refresh(self, name: str, entry: tuple) -> bool:
+        return time.monotonic() - entry[1] >= self.lifetimes[name] * self.refresh_ratio
+
+    def _is_usable(self, name: str, entry: tuple) -> bool:
+        return self._get_expires_in(name, entry) >= self.lifetimes[name] * self.min_remaining_ratio
+
+    def _get_expires_in(self, name: str, entry: tuple) -> float:
+        return max(entry[1] + self.lifetimes[name] - time.monotonic(), 0)
+
+    def _get_next_refresh_delay(self, failed: bool = False) -> float:
+        now = time.monotonic()
+        delays = [
+            entry[1] + self.lifetimes[name] * self.refresh_ratio - now if entry else 0
+            for name, entry in ((name, self.entries.get(name)) for name in self.fetchers)
+        ]
+        return max(min(delays), REFRESH_RETRY_DELAY if failed else 1)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            failed = False
+            for name in self.fetchers:
+                entry = self.entries.get(name)
+                if entry is None or self._needs_refresh(name, entry):
+                    try:
+                        self.single_flight.do(name, lambda: self._refresh(name))
+                    except Exception:
+                        logger.exception(f"failed to refresh speech credential: {name}")
+                        failed = True
+            self.stopped.wait(self._get_next_refresh_delay(failed))
+
+    def _fetch_token(self) -> str:
+        headers = {"Ocp-Apim-Subscription-Key": self.key, "Content-type": "application/x-www-form-urlencoded"}
+        resp = self.session.post(get_token_url(self.region), headers=headers, timeout=10)
+        resp.raise_for_status()
+        return resp.text
+
+    def _fetch_relay_token(self) -> dict:
+        resp = self.session.get(get_relay_token_url(self.region), headers={"Ocp-Apim-Subscription-Key": self.key}, timeout=10)
+        resp.raise_for_status()
+        return resp.json()
+
+
+class AsyncSpeechCredentialCache(SpeechCredentialCache):
+    """
+    SpeechCredentialCache の非同期版 (aiohttp のセッションを使用し、更新はイベントループ上のタスクで行う)
+    """
+
+    def __init__(self, session, key: str = None, region: str = None):
+        super().__init__(key, region, session=session)
+        self.single_flight = AsyncSingleFlight()
+        self.task = None
+
+    async def get_token(self) -> tuple[str, float]:
+        """
+        一時アクセストークンを取得する
+
+        Returns:
+            tuple[str, float]: 一時アクセストークンと、残りの有効期間(秒) (クライアントは期限が切れる前に取得し直す)
+        """
+        entry = await self._get("token")
+        return entry[0], self._get_expires_in("token", entry)
+
+    async def get_ice_server(self) -> dict:
+        """
+        ICE サーバ情報 (TURN サーバ情報) を取得する
+
+        Returns:
+            dict: ICE サーバ情報
+        """
+        return to_ice_server((await self._get("relay"))[0])
+
+    def start(self):
+        """
+        イベントループ上で定期的に更新するタスクを開始する
+        """
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        バックグラウンドの更新を停止する (HTTP セッションは呼び出し元で閉じる)
+        """
+        if self.task:
+            self.task.cancel()
+
+    async def _get(self, name: str) -> tuple:
+        entry = self.entries.get(name)
+        if entry and not self._needs_refresh(name, entry):
+            return entry
+        try:
+            return await self.single_flight.do(name, lambda: self._refresh(name))
+        except Exception:
+            # 更新に失敗しても、残りの有効期間が十分な値があればそれを返す
+            if entry and self._is_usable(name, entry):
+                logger.exception(f"failed to refresh speech credential, using cached value: {name}")
+                return entry
+            raise
+
+    async def _refresh(self, name: str) -> tuple:
+        entry = (await self.fetchers[name](), time.monotonic())
+        self.entries[name] = entry
+        return entry
+
+    async def _run(self):
+        while True:
+            failed = False
+            for name in self.fetchers:
+                entry = self.entries.get(name)
+                if entry is None or self._needs_refresh(name, entry):
+                    try:
+                        await self.single_flight.do(name, lambda: self._refresh(name))
+                    except Exception:
+                        logger.exception(f"failed to refresh speech credential: {name}")
+                        failed = True
+            await asyncio.sleep(self._get_next_refresh_delay(failed))
+
+    async def _fetch_token(self) -> str:
+        headers = {"Ocp-Apim-Subscription-Key": self.key, "Content-type": "application/x-www-form-urlencoded"}
+        async with self.session.post(get_token_url(self.region), headers=headers) as resp:
+            resp.raise_for_status()
+            return await resp.text()
+
+    async def _fetch_relay_token(self) -> dict:
+        async with self.session.get(get_relay_token_url(self.region), headers={"Ocp-Apim-Subscription-Key": self.key}) as resp:
+            resp.raise_for_status()
+            return await resp.json()
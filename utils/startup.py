@@ -0,0 +1,243 @@
+import os
+import time
+import asyncio
+import threading
+from typing import Awaitable, Callable
+from utils.logger import logger
+
+# 起動モード
+# eager: import 時にすべてのクライアントを生成し、Azure Cosmos DB のデータベースとコンテナを作成する (従来の動作)
+# background: import 時には生成せず、起動後にバックグラウンドで生成する (生成前のリクエストは生成が終わるまで待つ)
+# lazy: 初めて使用した際 (または /api/ready を呼び出した際) に生成する
+STARTUP_MODE_EAGER = "eager"
+STARTUP_MODE_BACKGROUND = "background"
+STARTUP_MODE_LAZY = "lazy"
+
+# 依存先の状態
+STATE_PENDING = "pending"  # 生成していない
+STATE_WARMING = "warming"  # 生成中
+STATE_READY = "ready"  # 生成済み
+STATE_FAILED = "failed"  # 生成に失敗した (次に使用した際に再度生成する)
+
+
+class ResourceState:
+    """
+    依存先の初期化の状態 (/api/ready で表示する)
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = STATE_PENDING
+        self.seconds = None
+        self.error = None
+
+    def get_status(self) -> dict:
+        status = {"state": self.state, "seconds": self.seconds}
+        if self.error:
+            status["error"] = self.error
+        return status
+
+    def _set_state(self, state: str, started_at: float = None, error: Exception = None):
+        self.state = state
+        if started_at is not None:
+            self.seconds = round(time.perf_counter() - started_at, 3)
+        if state == STATE_READY:
+            self.error = None
+            logger.info(f"startup resource ready: {self.name}, seconds={self.seconds}")
+        elif state == STATE_FAILED:
+            self.error = f"{type(error).__name__}: {error}"
+            logger.warning(f"startup resource failed: {self.name}, seconds={self.seconds}, error={self.error}")
+
+
+class LazyResource(ResourceState):
+    """
+    初めて使用した際 (またはウォームアップ時) に生成する依存先のクライアント
+    """
+
+    def __init__(self, name: str, factory: Callable[[], object]):
+        super().__init__(name)
+        self.factory = factory
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        クライアントを取得する (生成していない場合は生成する、生成中の場合は生成が終わるまで待つ)
+        """
+        if self.state == STATE_READY:
+            return self.value
+        with self.lock:
+            if self.state == STATE_READY:
+                return self.value
+            self._set_state(STATE_WARMING)
+            started_at = time.perf_counter()
+            try:
+                self.value = self.factory()
+            except Exception as e:
+                self._set_state(STATE_FAILED, started_at, e)
+                raise
+            self._set_state(STATE_READY, started_at)
+            return self.value
+
+
+class AsyncWarmup(ResourceState):
+    """
+    イベントループ上でのみ行える初期化 (接続の確立等) の状態 (非同期版)
+    サーバ起動時にタスクとして開始し、初期化が終わるまでリクエストを待たせる
+    """
+
+    def __init__(self, name: str, func: Callable[[], Awaitable[None]]):
+        super().__init__(name)
+        self.func = func
+        self.task = None
+
+    def start(self) -> asyncio.Task:
+        """
+        初期化をタスクとして開始する (開始済みの場合は、そのタスクを返す)
+        """
+        if self.task is None or self.state == STATE_FAILED:
+            self.task = asyncio.create_task(self._run())
+        return self.task
+
+    async def wait(self):
+        """
+        初期化が終わるまで待つ (失敗していた場合は再度初期化する)
+        """
+        await asyncio.shield(self.start())
+
+    async def _run(self):
+        self._set_state(STATE_WARMING)
+        started_at = time.perf_counter()
+        try:
+            await self.func()
+        except Exception as e:
+            self._set_state(STATE_FAILED, started_at, e)
+            raise
+        self._set_state(STATE_READY, started_at)
+
+
+class LazyProxy:
+    """
+    LazyResource が生成したクライアントへ、属性へのアクセスを転送する
+    (モジュール変数として従来のクライアントと同じように使用できる)
+    """
+
+    def __init__(self, resource: LazyResource):
+        object.__setattr__(self, "_resource", resource)
+
+    def __getattr__(self, name: str):
+        return getattr(self._resource.get(), name)
+
+
+class StartupTracker:
+    """
+    起動時間 (import にかかった時間) と依存先のクライアントの生成状況を管理する
+    """
+
+    def __init__(self, started_at: float, mode: str = None, budget: float = None):
+        """
+        Args:
+            started_at (float): 起動の開始時刻 (time.perf_counter の値)
+            mode (str): 起動モード (eager, background, lazy)
+            budget (float): import にかかる時間の目標(秒) (超えた場合は警告をログに出力する)
+        """
+        self.started_at = started_at
+        self.mode = mode or os.environ.get("STARTUP_MODE", STARTUP_MODE_EAGER)
+        self.budget = budget or float(os.environ.get("STARTUP_TIME_BUDGET", 2.0))
+        self.import_seconds = None
+        self.resources = {}
+        self.warming = None
+        self.lock = threading.Lock()
+
+    @property
+    def provision(self) -> bool:
+        """
+        起動時に Azure Cosmos DB のデータベースとコンテナを作成するか (eager の場合のみ)
+        それ以外の場合は、デプロイ時に deploy/provision.py で作成しておく
+        """
+        return self.mode == STARTUP_MODE_EAGER
+
+    def lazy(self, name: str, factory: Callable[[], object]):
+        """
+        依存先のクライアントを登録する (eager の場合はすぐに生成する)
+
+        Args:
+            name (str): 依存先の名前 (/api/ready で表示する)
+            factory (Callable[[], object]): クライアントを生成する関数
+
+        Returns:
+            LazyProxy: クライアントの代わりに使用するオブジェクト
+        """
+        resource = LazyResource(name, factory)
+        self.resources[name] = resource
+        if self.mode == STARTUP_MODE_EAGER:
+            resource.get()
+        return LazyProxy(resource)
+
+    def async_warmup(self, name: str, func: Callable[[], Awaitable[None]]) -> AsyncWarmup:
+        """
+        イベントループ上で行う初期化を登録する (サーバ起動時に AsyncWarmup.start で開始する)
+
+        Args:
+            name (str): 依存先の名前 (/api/ready で表示する)
+            func (Callable[[], Awaitable[None]]): 初期化を行う関数
+
+        Returns:
+            AsyncWarmup: 初期化の状態
+        """
+        warmup = AsyncWarmup(name, func)
+        self.resources[name] = warmup
+        return warmup
+
+    def is_ready(self, name: str) -> bool:
+        return self.resources[name].state == STATE_READY
+
+    def finish_import(self):
+        """
+        import にかかった時間を記録し、background の場合はクライアントの生成を開始する
+        """
+        self.import_seconds = round(time.perf_counter() - self.started_at, 3)
+        if self.import_seconds > self.budget:
+            logger.warning(f"startup exceeded time budget: mode={self.mode}, import_seconds={self.import_seconds}, budget={self.budget}")
+        else:
+            logger.info(f"startup finished: mode={self.mode}, import_seconds={self.import_seconds}, budget={self.budget}")
+        if self.mode == STARTUP_MODE_BACKGROUND:
+            self.warm_in_background()
+
+    def warm_in_background(self):
+        """
+        生成していないクライアントを、バックグラウンドのスレッドで順に生成する (実行中の場合は何もしない)
+        """
+        with self.lock:
+            if self.warming and self.warming.is_alive():
+                return
+            resources = [r for r in self.resources.values() if isinstance(r, LazyResource) and r.state != STATE_READY]
+            if not resources:
+                return
+            self.warming = threading.Thread(target=self._warm, args=(resources,), name="startup-warmup", daemon=True)
+            self.warming.start()
+
+    def get_status(self) -> dict:
+        """
+        起動時間と依存先の生成状況を取得する
+
+        Returns:
+            dict: すべての依存先が生成済みかどうか、起動モード、import にかかった時間、依存先ごとの状態
+        """
+        resources = {name: r.get_status() for name, r in self.resources.items()}
+        return {
+            "ready": all(r["state"] == STATE_READY for r in resources.values()),
+            "mode": self.mode,
+            "import_seconds": self.import_seconds,
+            "budget_seconds": self.budget,
+            "uptime_seconds": round(time.perf_counter() - self.started_at, 3),
+            "resources": resources,
+        }
+
+    def _warm(self, resources: list[LazyResource]):
+        for resource in resources:
+            # 失敗した場合は状態に記録されるため、次の依存先の生成へ進む (次に使用した際に再度生成する)
+            try:
+                resource.get()
+            except Exception:
+                continue
@@ -0,0 +1,174 @@
+import json
+from utils.phrase import PhraseSegmenter
+
+# ストリーム形式のバージョン
+# 1: 累積形式 (チャンクごとにそれまでの回答全文を JSON Lines で返す)
+# 2: 差分形式 (新しく生成されたトークンのみを SSE の data フレームで返す)
+# 3: フレーズ形式 (アバターがそのまま読み上げられる単位に区切ったフレーズを SSE の phrase イベントで返す)
+STREAM_VERSION_CUMULATIVE = 1
+STREAM_VERSION_DELTA = 2
+STREAM_VERSION_PHRASE = 3
+
+
+class CumulativeStreamEncoder:
+    """
+    従来の累積形式 (v1) でストリームを生成するエンコーダ
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    def delta(self, text: str) -> str:
+        """
+        新しく生成されたテキストを受け取り、それまでの回答全文を含む行を返す
+
+        Args:
+            text (str): 新しく生成されたテキスト
+
+        Returns:
+            str: クライアントへ送信する文字列
+        """
+        self.parts.append(text)
+        return json.dumps({"content": self.content}).replace("\n", "\\n") + "\n"
+
+    def done(self) -> str:
+        """
+        ストリームの終了時にクライアントへ送信する文字列を返す (v1 では何も送信しない)
+        """
+        return ""
+
+    def timing(self, data: dict) -> str:
+        """
+        段階ごとの所要時間の内訳をクライアントへ送信する文字列を返す (v1 では何も送信しない)
+        """
+        return ""
+
+
+class DeltaStreamEncoder:
+    """
+    差分形式 (v2) で Server-Sent Events のストリームを生成するエンコーダ
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.seq = 0
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    def delta(self, text: str) -> str:
+        """
+        新しく生成されたテキストのみを含む delta イベントを返す
+
+        Args:
+            text (str): 新しく生成されたテキスト
+
+        Returns:
+            str: クライアントへ送信する SSE フレーム
+        """
+        self.parts.append(text)
+        return self.event("delta", {"delta": text})
+
+    def done(self) -> str:
+        """
+        回答全文を含む done イベントを返す
+        """
+        return self.event("done", {"content": self.content})
+
+    def timing(self, data: dict) -> str:
+        """
+        段階ごとの所要時間の内訳 (utils.timing を参照) を含む timing イベントを返す (ストリームの最後に送信する)
+        """
+        return self.event("timing", data)
+
+    def event(self, event: str, data: dict) -> str:
+        """
+        シーケンス番号を付与した SSE フレームを生成する
+
+        Args:
+            event (str): イベント名
+            data (dict): イベントのデータ
+
+        Returns:
+            str: SSE フレーム
+        """
+        self.seq += 1
+        data = json.dumps({"seq": self.seq, **data}, ensure_ascii=False)
+        return f"id: {self.seq}\nevent: {event}\ndata: {data}\n\n"
+
+
+class PhraseStreamEncoder(DeltaStreamEncoder):
+    """
+    フレーズ形式 (v3) で Server-Sent Events のストリームを生成するエンコーダ
+    句読点で区切り、Markdown 記法と URL を取り除いたフレーズを返すため、クライアントは受け取ったフレーズをそのまま読み上げる
+    """
+
+    def __init__(self, segmenter: PhraseSegmenter = None):
+        super().__init__()
+        self.segmenter = segmenter or PhraseSegmenter()
+
+    @property
+    def content(self) -> str:
+        # フレーズとして送信した分の回答 (途中で中止された場合に、まだ送信していない部分を含めない)
+        return "".join(self.parts)[: self.segmenter.consumed]
+
+    def delta(self, text: str) -> str:
+        """
+        新しく生成されたテキストを受け取り、区切ることができたフレーズの phrase イベントを返す
+
+        Args:
+            text (str): 新しく生成されたテキスト
+
+        Returns:
+            str: クライアントへ送信する SSE フレーム (区切ることができない場合は空文字列)
+        """
+        self.parts.append(text)
+        return "".join(self.event("phrase", {"text": phrase}) for phrase in self.segmenter.feed(text))
+
+    def done(self) -> str:
+        """
+        残りのテキストの phrase イベントと、回答全文を含む done イベントを返す
+        """
+        frames = "".join(self.event("phrase", {"text": phrase}) for phrase in self.segmenter.flush())
+        return frames + super().done()
+
+
+def parse_stream_version(value, default: int) -> int:
+    """
+    クライアントが指定したストリーム形式のバージョンを取得する
+    整数でない場合や対応していないバージョンの場合は、エラーにせずに既定のバージョンを使用する
+
+    Args:
+        value: リクエストの stream_version の値 (指定されていない場合は None)
+        default (int): 既定のバージョン
+
+    Returns:
+        int: ストリーム形式のバージョン
+    """
+    try:
+        version = int(value)
+    except (TypeError, ValueError):
+        return default
+    return version if version in (STREAM_VERSION_CUMULATIVE, STREAM_VERSION_DELTA, STREAM_VERSION_PHRASE) else default
+
+
+def get_stream_encoder(version: int) -> CumulativeStreamEncoder | DeltaStreamEncoder | PhraseStreamEncoder:
+    """
+    指定されたバージョンのストリームエンコーダを取得する
+
+    Args:
+        version (int): ストリーム形式のバージョン
+
+    Returns:
+        CumulativeStreamEncoder | DeltaStreamEncoder | PhraseStreamEncoder: ストリームエンコーダ
+    """
+    if version == STREAM_VERSION_PHRASE:
+        return PhraseStreamEncoder()
+    if version == STREAM_VERSION_DELTA:
+        return DeltaStreamEncoder()
+    return CumulativeStreamEncoder()
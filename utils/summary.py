@@ -0,0 +1,203 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+
+# 要約の対象となる (要約済みの時刻以降の) 会話履歴を取得するクエリ
+UNSUMMARIZED_QUERY = "SELECT * FROM c WHERE c.user_id = @user_id AND c._ts >= @ts ORDER BY c._ts ASC"
+
+# 要約を生成する際のシステムメッセージ
+SUMMARY_SYSTEM_MESSAGE = """
+- あなたは、ユーザと AI アバターの会話を要約するアシスタントです。
+- これまでの要約と新しい会話を統合し、以降の会話で必要となる事実 (ユーザの名前・好み・依頼内容・話題・約束) を漏らさずに、簡潔な要約を作成してください。
+- 要約は、ユーザが使用している言語で、箇条書きを使わずに文章で出力してください。
+"""
+
+
+class ConversationSummarizer:
+    """
+    古い会話履歴をユーザごとの要約に畳み込み、要約と直近の会話のみをプロンプトに含められるようにする
+    要約の更新は、会話の返信を遅らせないようにバックグラウンドで行う
+    """
+
+    def __init__(self, openai_client, history_store, recent_count: int = None):
+        self.openai_client = openai_client
+        self.history_store = history_store
+        self.recent_count = recent_count or int(os.environ.get("HISTORY_MESSAGE_COUNT", 4))
+        self.max_tokens = int(os.environ.get("SUMMARY_MAX_TOKENS", 500))
+
+        # 同じユーザの要約を同時に更新しないように、更新中のユーザを管理する
+        self.executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SUMMARY_MAX_WORKERS", 2)), thread_name_prefix="summary")
+        self.updating = set()
+        self.lock = threading.Lock()
+
+    def load_summary(self, user_id: str) -> str:
+        """
+        ユーザの会話の要約を取得する
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            str: 会話の要約 (まだ要約がない場合は空文字)
+        """
+        doc = self.history_store.get_summary(user_id)
+        return doc["summary"] if doc else ""
+
+    def update_in_background(self, user_id: str):
+        """
+        ユーザの会話の要約をバックグラウンドで更新する (同じユーザの更新中は何もしない)
+
+        Args:
+            user_id (str): ユーザID
+        """
+        with self.lock:
+            if user_id in self.updating:
+                return
+            self.updating.add(user_id)
+        self.executor.submit(self._update, user_id)
+
+    def _update(self, user_id: str):
+        try:
+            self.update(user_id)
+        except Exception:
+            logger.exception(f"failed to update conversation summary: user_id={user_id}")
+        finally:
+            with self.lock:
+                self.updating.discard(user_id)
+
+    def update(self, user_id: str):
+        """
+        直近の会話より古い、まだ要約していない会話を要約に畳み込む
+
+        Args:
+            user_id (str): ユーザID
+        """
+        doc = self.history_store.get_summary(user_id) or new_summary_doc(user_id)
+        items = self.history_store.load_since(user_id, doc["last_ts"])
+        items = get_items_to_fold(doc, items, self.recent_count)
+        if not items:
+            return
+
+        messages = build_summary_messages(doc["summary"], items)
+        doc["summary"] = self.openai_client.get_completion(messages, max_tokens=self.max_tokens)
+        self.history_store.save_summary(user_id, advance_summary_doc(doc, items))
+        logger.info(f"conversation summary updated: user_id={user_id}, folded={len(items)}")
+
+
+class AsyncConversationSummarizer:
+    """
+    ConversationSummarizer の非同期版 (要約の更新はイベントループ上のタスクとして行う)
+    """
+
+    def __init__(self, openai_client, history_store, recent_count: int = None):
+        self.openai_client = openai_client
+        self.history_store = history_store
+        self.recent_count = recent_count or int(os.environ.get("HISTORY_MESSAGE_COUNT", 4))
+        self.max_tokens = int(os.environ.get("SUMMARY_MAX_TOKENS", 500))
+        self.tasks = {}
+
+    async def load_summary(self, user_id: str) -> str:
+        """
+        ユーザの会話の要約を取得する
+
+        Args:
+            user_id (str): ユーザID
+
+        Returns:
+            str: 会話の要約 (まだ要約がない場合は空文字)
+        """
+        doc = await self.history_store.get_summary(user_id)
+        return doc["summary"] if doc else ""
+
+    def update_in_background(self, user_id: str):
+        """
+        ユーザの会話の要約をバックグラウンドで更新する (同じユーザの更新中は何もしない)
+
+        Args:
+            user_id (str): ユーザID
+        """
+        if user_id in self.tasks:
+            return
+        self.tasks[user_id] = asyncio.create_task(self._update(user_id))
+
+    async def _update(self, user_id: str):
+        try:
+            await self.update(user_id)
+        except Exception:
+            logger.exception(f"failed to update conversation summary: user_id={user_id}")
+        finally:
+            self.tasks.pop(user_id, None)
+
+    async def update(self, user_id: str):
+        """
+        直近の会話より古い、まだ要約していない会話を要約に畳み込む
+
+        Args:
+            user_id (str): ユーザID
+        """
+        doc = await self.history_store.get_summary(user_id) or new_summary_doc(user_id)
+        items = await self.history_store.load_since(user_id, doc["last_ts"])
+        items = get_items_to_fold(doc, items, self.recent_count)
+        if not items:
+            return
+
+        messages = build_summary_messages(doc["summary"], items)
+        doc["summary"] = await self.openai_client.get_completion(messages, max_tokens=self.max_tokens)
+        await self.history_store.save_summary(user_id, advance_summary_doc(doc, items))
+        logger.info(f"conversation summary updated: user_id={user_id}, folded={len(items)}")
+
+
+def get_summary_id(user_id: str) -> str:
+    """
+    ユーザの会話の要約を格納するアイテムのIDを取得する
+    (会話履歴のクエリに含まれないように、要約のアイテムには user_id を持たせない)
+    """
+    return f"summary-{user_id}"
+
+
+def new_summary_doc(user_id: str) -> dict:
+    """
+    まだ要約がないユーザの要約アイテムを生成する
+    """
+    return {"id": get_summary_id(user_id), "summary_of": user_id, "summary": "", "last_ts": 0, "boundary_ids": []}
+
+
+def get_items_to_fold(doc: dict, items: list[dict], recent_count: int) -> list[dict]:
+    """
+    まだ要約していない会話履歴のうち、直近の会話を除いた要約すべき会話を取得する
+
+    Args:
+        doc (dict): 要約アイテム
+        items (list[dict]): 要約済みの時刻以降の会話履歴 (古い順)
+        recent_count (int): プロンプトにそのまま含める直近の会話の件数
+
+    Returns:
+        list[dict]: 要約すべき会話履歴 (古い順)
+    """
+    # _ts は秒単位のため、要約済みの時刻と同じ時刻の会話は ID で除外する
+    items = [i for i in items if i["id"] not in doc["boundary_ids"]]
+    return items[: max(len(items) - recent_count, 0)]
+
+
+def build_summary_messages(summary: str, items: list[dict]) -> list[dict]:
+    """
+    これまでの要約と新しい会話から、要約を生成するためのメッセージを組み立てる
+    """
+    conversation = "\n".join(f"{item['role']}: {item['content']}" for item in items)
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_MESSAGE},
+        {"role": "user", "content": f"# これまでの要約\n{summary or '(なし)'}\n\n# 新しい会話\n{conversation}"},
+    ]
+
+
+def advance_summary_doc(doc: dict, items: list[dict]) -> dict:
+    """
+    要約済みの時刻を、畳み込んだ会話の最後の時刻まで進める
+    """
+    last_ts = items[-1]["_ts"]
+    boundary_ids = doc["boundary_ids"] if last_ts == doc["last_ts"] else []
+    doc["last_ts"] = last_ts
+    doc["boundary_ids"] = boundary_ids + [i["id"] for i in items if i["_ts"] == last_ts]
+    return doc
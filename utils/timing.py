@@ -0,0 +1,329 @@
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from opentelemetry import metrics, trace
+from opentelemetry.trace import Status, StatusCode
+from utils.logger import logger
+from utils.cancel import GenerationCancelled
+
+# ターンの結果
+TURN_COMPLETED = "completed"  # 回答を最後まで送信した
+TURN_CANCELLED = "cancelled"  # 回答の生成が中止された (またはクライアントが切断した)
+TURN_FAILED = "failed"  # 回答の生成中にエラーが発生した
+TURN_REJECTED = "rejected"  # 混雑中のため受け付けなかった
+
+# ツール呼び出しの結果
+TOOL_OK = "ok"
+TOOL_ERROR = "error"
+TOOL_TIMEOUT = "timeout"
+TOOL_CANCELLED = "cancelled"
+
+
+class TurnMetrics:
+    """
+    ターンの段階ごとの所要時間を記録する OpenTelemetry のメトリクス
+    (configure_azure_monitor の後に生成するため、初めて使用した際に生成する)
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        meter = metrics.get_meter(__name__)
+        self.turn_duration = meter.create_histogram("chat.turn.duration", unit="ms")
+        self.time_to_first_token = meter.create_histogram("chat.turn.time_to_first_token", unit="ms")
+        self.stage_duration = meter.create_histogram("chat.stage.duration", unit="ms")
+        self.llm_time_to_first_token = meter.create_histogram("chat.llm.time_to_first_token", unit="ms")
+        self.llm_tokens_per_second = meter.create_histogram("chat.llm.tokens_per_second", unit="{token}/s")
+        self.tool_duration = meter.create_histogram("chat.tool.duration", unit="ms")
+        self.tool_loop_iterations = meter.create_histogram("chat.tool_loop.iterations", unit="{iteration}")
+
+    @classmethod
+    def get(cls) -> "TurnMetrics":
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = TurnMetrics()
+            return cls._instance
+
+
+class TurnTimer:
+    """
+    1ターン分の回答の生成 (/api/completion) について、段階ごとの所要時間を計測する
+    - 段階ごとに chat.turn の子の span を作成し、所要時間をヒストグラムに記録する
+    - ストリームの送信前に終わった段階は Server-Timing ヘッダで、すべての段階はストリームの最後の timing イベントで返す
+    (ストリームのジェネレータはリクエストのコンテキストの外で実行されるため、親の span は明示的に指定する)
+    """
+
+    def __init__(self, enabled: bool = True, attributes: dict = None):
+        """
+        Args:
+            enabled (bool): span とメトリクスを記録するか (False の場合は所要時間の集計のみ行う)
+            attributes (dict): chat.turn の span の属性
+        """
+        self.enabled = enabled
+        self.started_at = time.perf_counter()
+        self.stages = []  # 段階名と所要時間(ミリ秒)
+        self.marks = {}  # ターンの開始からの経過時間(ミリ秒)
+        self.llm_rounds = []
+        self.tools = []
+        self.status = None
+        self.lock = threading.Lock()
+        self.metrics = TurnMetrics.get() if enabled else None
+        self.span = trace.get_tracer(__name__).start_span("chat.turn", attributes=attributes) if enabled else None
+        self.context = trace.set_span_in_context(self.span) if enabled else None
+
+    def elapsed_ms(self, started_at: float = None) -> float:
+        return round((time.perf_counter() - (started_at or self.started_at)) * 1000, 1)
+
+    def start_span(self, name: str, attributes: dict = None):
+        """
+        chat.turn の子の span を開始する (記録しない場合は None)
+        """
+        if not self.enabled:
+            return None
+        return trace.get_tracer(__name__).start_span(name, context=self.context, attributes=attributes)
+
+    @contextmanager
+    def stage(self, name: str, **attributes):
+        """
+        段階の所要時間を計測する
+
+        Args:
+            name (str): 段階名 (Server-Timing のメトリクス名としても使用する)
+            attributes: span の属性
+        """
+        started_at = time.perf_counter()
+        span = self.start_span(f"chat.{name}", attributes)
+        try:
+            yield span
+        except BaseException as e:
+            _end_span_with_error(span, e)
+            span = None
+            raise
+        finally:
+            duration = self.elapsed_ms(started_at)
+            if span:
+                span.end()
+            self.add_stage(name, duration)
+
+    def add_stage(self, name: str, duration: float):
+        """
+        段階の所要時間を記録する (同じ段階を複数回行った場合は合計する)
+        """
+        with self.lock:
+            self.stages.append((name, duration))
+        if self.metrics:
+            self.metrics.stage_duration.record(duration, {"stage": name})
+
+    def mark(self, name: str):
+        """
+        ターンの開始からの経過時間を記録する (最初の1回のみ)
+        """
+        with self.lock:
+            if name in self.marks:
+                return
+            self.marks[name] = self.elapsed_ms()
+        if self.span:
+            self.span.add_event(name)
+
+    def start_llm_round(self) -> "LLMRoundTimer":
+        """
+        Chat Completion API の1回分のリクエスト (ツール呼び出しのループの1回分) の計測を開始する
+        """
+        return LLMRoundTimer(self, len(self.llm_rounds) + 1)
+
+    def start_tool(self, name: str) -> "ToolTimer":
+        """
+        ツール呼び出しの計測を開始する
+        """
+        return ToolTimer(self, name)
+
+    def get_server_timing(self) -> str:
+        """
+        ここまでに終わった段階の所要時間を Server-Timing ヘッダの形式で取得する
+
+        Returns:
+            str: Server-Timing ヘッダの値 (例: admission;dur=0.1, load_history;dur=35.2)
+        """
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.get_stage_totals().items())
+
+    def get_stage_totals(self) -> dict[str, float]:
+        with self.lock:
+            totals = {}
+            for name, duration in self.stages:
+                totals[name] = round(totals.get(name, 0) + duration, 1)
+            return totals
+
+    def get_summary(self) -> dict:
+        """
+        段階ごとの所要時間の内訳を取得する (timing イベントで返す)
+
+        Returns:
+            dict: ターン全体の経過時間、段階ごとの所要時間、経過時間の記録、LLM のリクエストとツール呼び出しごとの内訳 (時間はミリ秒)
+        """
+        with self.lock:
+            marks, llm_rounds, tools = dict(self.marks), list(self.llm_rounds), list(self.tools)
+        return {
+            "trace_id": self.get_trace_id(),
+            "total": self.elapsed_ms(),
+            "stages": self.get_stage_totals(),
+            "marks": marks,
+            "llm": llm_rounds,
+            "tools": tools,
+            "iterations": len(llm_rounds),
+        }
+
+    def get_trace_id(self) -> str | None:
+        """
+        chat.turn の span のトレースID を取得する (クライアントのログと Application Insights のトレースを突き合わせるために使用する)
+        """
+        if not self.span or not self.span.get_span_context().is_valid:
+            return None
+        return format(self.span.get_span_context().trace_id, "032x")
+
+    def finish(self, status: str):
+        """
+        ターンの計測を終了し、所要時間の内訳をログに出力する (2回目以降は何もしない)
+
+        Args:
+            status (str): ターンの結果 (completed, cancelled, failed, rejected)
+        """
+        with self.lock:
+            if self.status is not None:
+                return
+            self.status = status
+        summary = self.get_summary()
+        logger.info(f"turn timing: status={status}, total={summary['total']}, stages={summary['stages']}, marks={summary['marks']}, iterations={summary['iterations']}")
+        if not self.enabled:
+            return
+        attributes = {"status": status}
+        self.metrics.turn_duration.record(summary["total"], attributes)
+        if "first_token" in summary["marks"]:
+            self.metrics.time_to_first_token.record(summary["marks"]["first_token"], attributes)
+        if summary["iterations"]:
+            self.metrics.tool_loop_iterations.record(summary["iterations"], attributes)
+        self.span.set_attribute("chat.status", status)
+        self.span.set_attribute("chat.iterations", summary["iterations"])
+        for name, duration in summary["marks"].items():
+            self.span.set_attribute(f"chat.{name}_ms", duration)
+        self.span.end()
+
+
+class LLMRoundTimer:
+    """
+    Chat Completion API の1回分のリクエストについて、最初のトークンまでの時間と生成速度を計測する
+    """
+
+    def __init__(self, timer: TurnTimer, index: int):
+        self.timer = timer
+        self.index = index
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.chunks = 0
+        self.ended = False
+        self.span = timer.start_span("chat.llm", {"chat.round": index})
+
+    def on_chunk(self, content: str | None, tool_calling: bool = False):
+        """
+        ストリームのチャンクを受信した際に呼び出す (回答テキストを含むチャンクの数を、トークン数の推定に使用する)
+
+        Args:
+            content (str | None): チャンクに含まれる回答テキスト
+            tool_calling (bool): ツール呼び出しを生成中か (回答テキストと同様に、最初のトークンとして扱う)
+        """
+        if not content and not tool_calling:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            if self.span:
+                self.span.add_event("first_token")
+        if content:
+            self.chunks += 1
+            self.timer.mark("first_token")
+
+    def end(self, usage=None, tool_calls: int = 0, error: BaseException = None):
+        """
+        リクエストの計測を終了する (2回目以降は何もしない)
+
+        Args:
+            usage: ストリームの最後に返されたトークン数 (返されない場合は回答テキストを含むチャンクの数で推定する)
+            tool_calls (int): 応答に含まれたツール呼び出しの数
+            error (BaseException): 途中で中断した場合の例外
+        """
+        if self.ended:
+            return
+        self.ended = True
+        duration = self.timer.elapsed_ms(self.started_at)
+        ttft = round((self.first_token_at - self.started_at) * 1000, 1) if self.first_token_at else None
+        tokens = usage.completion_tokens if usage else self.chunks
+        generation_seconds = time.perf_counter() - self.first_token_at if self.first_token_at else 0
+        tokens_per_second = round(tokens / generation_seconds, 1) if tokens and generation_seconds > 0 else None
+        record = {"round": self.index, "duration": duration, "ttft": ttft, "tokens": tokens, "tokens_per_second": tokens_per_second, "tool_calls": tool_calls}
+        with self.timer.lock:
+            self.timer.llm_rounds.append(record)
+        self.timer.add_stage("llm", duration)
+
+        if self.timer.metrics:
+            attributes = {"round": self.index}
+            if ttft is not None:
+                self.timer.metrics.llm_time_to_first_token.record(ttft, attributes)
+            if tokens_per_second is not None:
+                self.timer.metrics.llm_tokens_per_second.record(tokens_per_second, attributes)
+        if self.span:
+            self.span.set_attributes({f"chat.{key}": value for key, value in record.items() if value is not None})
+            if error:
+                _end_span_with_error(self.span, error)
+            else:
+                self.span.end()
+
+
+class ToolTimer:
+    """
+    ツール呼び出し1回分の所要時間を計測する
+    (同期版ではスレッドプールの Future の完了時に終了するため、終了はどのスレッドから呼び出してもよい)
+    """
+
+    def __init__(self, timer: TurnTimer, name: str):
+        self.timer = timer
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.ended = False
+        self.span = timer.start_span("chat.tool", {"chat.tool": name})
+
+    def end(self, status: str = TOOL_OK):
+        """
+        ツール呼び出しの計測を終了する (2回目以降は何もしない)
+
+        Args:
+            status (str): ツール呼び出しの結果 (ok, error, timeout, cancelled)
+        """
+        duration = self.timer.elapsed_ms(self.started_at)
+        with self.timer.lock:
+            if self.ended:
+                return
+            self.ended = True
+            self.timer.tools.append({"name": self.name, "duration": duration, "status": status})
+        if self.timer.metrics:
+            self.timer.metrics.tool_duration.record(duration, {"tool": self.name, "status": status})
+        if self.span:
+            self.span.set_attribute("chat.status", status)
+            if status != TOOL_OK:
+                self.span.set_status(Status(StatusCode.ERROR, status))
+            self.span.end()
+
+
+def _end_span_with_error(span, error: BaseException):
+    """
+    例外を記録して span を終了する (記録しない場合は何もしない)
+    回答の生成の中止やクライアントの切断による中断は、エラーとして扱わない
+    """
+    if span is None:
+        return
+    if isinstance(error, (GeneratorExit, GenerationCancelled, asyncio.CancelledError)):
+        span.set_attribute("chat.cancelled", True)
+        span.end()
+        return
+    span.record_exception(error)
+    span.set_status(Status(StatusCode.ERROR, type(error).__name__))
+    span.end()
@@ -1,4 +1,150 @@
+import os
+import time
+import threading
 import requests
+from utils.cache import SingleFlight
+from utils.logger import logger
+
+# 気象庁の全国の天気予報データの URL
+FORECAST_URL = "https://www.jma.go.jp/bosai/forecast/data/forecast/010000.json"
+
+# 地域を指定しなかった場合の地域名
+DEFAULT_AREA = "東京"
+
+
+class WeatherForecastClient:
+    """
+    気象庁の天気予報データを取得し、地域名・地域コードをキーとした索引を作成して保持する
+    天気予報データの更新は1日に数回のため、有効期限 (TTL) が切れるまでは取得し直さない
+    有効期限が切れた場合も、条件付きリクエスト (ETag / Last-Modified) で変更がなければ索引をそのまま使用する
+    取得に失敗した場合は、失敗した時刻を記録し、一定時間 (retry_interval) は取得し直さずに以前の索引を使用する
+    """
+
+    def __init__(self, url: str = FORECAST_URL, ttl: float = None, session: requests.Session = None, retry_interval: float = None):
+        self.url = url
+        self.ttl = ttl if ttl is not None else float(os.getenv("WEATHER_CACHE_TTL", 1800))
+        self.retry_interval = retry_interval if retry_interval is not None else float(os.getenv("WEATHER_RETRY_INTERVAL", 60))
+        self.session = session or requests.Session()
+        self.index = {}
+        self.etag = None
+        self.last_modified = None
+        self.fetched_at = None
+        self.failed_at = None
+        self.last_error = None
+        self.single_flight = SingleFlight()
+        self.lock = threading.Lock()
+
+    def get_forecast(self, area: str = DEFAULT_AREA) -> dict | None:
+        """
+        指定した地域の天気予報を取得する
+
+        Args:
+            area (str): 地域名 (例: 東京、大阪) または地域コード (例: 130000)
+
+        Returns:
+            dict | None: 天気予報 (地域が見つからない場合は None)
+        """
+        self._refresh_if_expired()
+        return self.index.get(normalize_area(area))
+
+    def get_area_names(self) -> list[str]:
+        """
+        天気予報を取得できる地域名の一覧を取得する
+
+        Returns:
+            list[str]: 地域名の一覧
+        """
+        self._refresh_if_expired()
+        return sorted({forecast["name"] for forecast in self.index.values()})
+
+    def _refresh_if_expired(self):
+        now = time.monotonic()
+        if self.fetched_at is not None and now - self.fetched_at < self.ttl:
+            return
+
+        # 取得に失敗した直後は、呼び出しのたびにタイムアウトまで待たないよう、一定時間は取得し直さない
+        if self.failed_at is not None and now - self.failed_at < self.retry_interval:
+            if not self.index:
+                raise RuntimeError("weather forecast is unavailable") from self.last_error
+            return
+
+        try:
+            self.single_flight.do("forecast", self._refresh)
+        except Exception as e:
+            self.failed_at, self.last_error = time.monotonic(), e
+            # 取得に失敗しても、以前に取得した天気予報があればそれを使用する
+            if not self.index:
+                raise
+            logger.exception(f"failed to refresh weather forecast, using cached forecast for {self.retry_interval}s")
+
+    def _refresh(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        resp = self.session.get(self.url, headers=headers, timeout=10)
+
+        # 変更がない場合は、索引をそのまま使用する
+        if resp.status_code == 304:
+            self.fetched_at, self.failed_at = time.monotonic(), None
+            return
+        resp.raise_for_status()
+
+        index = build_forecast_index(resp.json())
+        with self.lock:
+            self.index = index
+            self.etag = resp.headers.get("ETag")
+            self.last_modified = resp.headers.get("Last-Modified")
+            self.fetched_at, self.failed_at = time.monotonic(), None
+        logger.info(f"weather forecast refreshed: areas={len(index)}")
+
+
+def build_forecast_index(forecasts: list[dict]) -> dict[str, dict]:
+    """
+    天気予報データから、地域名・地域コードをキーとした索引を作成する
+    府県予報区 (例: 東京) に加えて、その中の一次細分区域 (例: 伊豆諸島北部) の名前とコードでも引けるようにする
+
+    Args:
+        forecasts (list[dict]): 気象庁の全国の天気予報データ
+
+    Returns:
+        dict[str, dict]: 地域名・地域コードをキーとした天気予報
+    """
+    index = {}
+    for forecast in forecasts:
+        for key in (forecast.get("name"), forecast.get("officeCode")):
+            if key:
+                index[normalize_area(key)] = forecast
+
+    # 一次細分区域の名前が府県予報区の名前と重複する場合は、府県予報区を優先する
+    for forecast in forecasts:
+        for time_series in forecast.get("srf", {}).get("timeSeries", []):
+            for area in time_series.get("areas", []):
+                for key in (area.get("area", {}).get("name"), area.get("area", {}).get("code")):
+                    if key:
+                        index.setdefault(normalize_area(key), forecast)
+    return index
+
+
+def normalize_area(area: str) -> str:
+    """
+    地域名の表記の揺れ (前後の空白、都道府県の接尾辞) を取り除く
+
+    Args:
+        area (str): 地域名または地域コード
+
+    Returns:
+        str: 正規化した地域名
+    """
+    area = area.strip()
+    if area.endswith(("都", "府", "県")) and len(area) > 2:
+        area = area[:-1]
+    return area
+
+
+# get_weather_in_tokyo で使用するクライアント (初回の呼び出し時に生成する)
+_default_client: WeatherForecastClient = None
 
 
 def get_weather_in_tokyo() -> dict:
@@ -8,7 +154,7 @@ def get_weather_in_tokyo() -> dict:
     Returns:
         dict: 天気情報
     """
-    url = "https://www.jma.go.jp/bosai/forecast/data/forecast/010000.json"
-    weather = requests.get(url).json()
-    weather = [w for w in weather if w["name"] == "東京"][0]
-    return weather
+    global _default_client
+    if _default_client is None:
+        _default_client = WeatherForecastClient()
+    return _default_client.get_forecast(DEFAULT_AREA)